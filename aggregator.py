@@ -0,0 +1,262 @@
+"""Serve frames from several camera processes through one endpoint.
+
+Each SingleCameraServer process writes outgoing frames into its own
+FrameRing, a ring of frame slots in shared memory. The Aggregator
+process reads frames straight out of the rings, without copying them
+across the process boundary, and sends them to a single client as
+    receiveData('new tagged image', (tags, image), timestamp)
+where tags holds the camera label, serial, dyes and wavelengths from
+cameras.py, and the frame's exposure time. The aggregator also
+forwards control calls to each camera by label, so a client needs only
+one connection.
+"""
+
+import threading
+import time
+from multiprocessing import Process, RawArray, RawValue
+
+import numpy
+import Pyro4
+from framecodec import DTYPES, DTYPE_CODES
+Pyro4.config.SERIALIZER = 'pickle'
+Pyro4.config.SERIALIZERS_ACCEPTED.add('pickle')
+
+try:
+    from cameras import camera_keys as _camera_keys
+    from cameras import cameras as _cameras
+except:
+    CAMERAS = {}
+else:
+    CAMERAS = {camera[0]: dict(zip(_camera_keys, camera)) for camera in _cameras}
+
+
+class FrameRing(object):
+    """A ring of frame slots in shared memory, for one writer and one reader.
+
+    A frame is written into slot (n % slots) and only then published by
+    incrementing the write count, so a reader never sees a frame that is
+    part-written. A reader that falls more than slots frames behind loses
+    the oldest frames.
+
+    Rings must be created before the writing and reading processes are
+    started, and passed to them as Process arguments.
+    """
+    # Per-slot header fields, stored as float64.
+    HEADER = ('sequence', 'timestamp', 'dtype', 'ny', 'nx', 'exposure')
+
+    def __init__(self, slots=8, slot_bytes=1024 * 1024 * 4):
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.data = RawArray('B', slots * slot_bytes)
+        self.headers = RawArray('d', slots * len(self.HEADER))
+        self.written = RawValue('L', 0)
+        # Serial number of the camera writing to this ring.
+        self.serial = RawValue('l', -1)
+        self._views = None
+
+
+    def __getstate__(self):
+        # Views are recreated in each process.
+        state = self.__dict__.copy()
+        state['_views'] = None
+        return state
+
+
+    def views(self):
+        if self._views is None:
+            data = numpy.frombuffer(self.data, dtype=numpy.uint8)
+            headers = numpy.frombuffer(self.headers, dtype=numpy.float64)
+            self._views = (data.reshape(self.slots, self.slot_bytes),
+                           headers.reshape(self.slots, len(self.HEADER)))
+        return self._views
+
+
+    def is_valid(self, n):
+        """Return True if frame n is published and not being overwritten."""
+        return n < self.written.value < n + self.slots
+
+
+    def read(self, n):
+        """Return (image, timestamp, exposure) for frame n, or None if it
+        was lost.
+
+        image is a view onto shared memory: it is only valid until the
+        writer gets slots frames further ahead.
+        """
+        data, headers = self.views()
+        slot = n % self.slots
+        sequence, timestamp, dtype, ny, nx, exposure = headers[slot]
+        if int(sequence) != n or not self.is_valid(n):
+            return None
+        dtype = numpy.dtype(DTYPES[int(dtype)])
+        nbytes = int(ny) * int(nx) * dtype.itemsize
+        image = data[slot, :nbytes].view(dtype).reshape(int(ny), int(nx))
+        return image, timestamp, exposure
+
+
+    def write(self, image, timestamp, exposure=0.):
+        """Copy a 2D image into the next slot and publish it.
+
+        Return False, without writing, if image is too large for a slot.
+        """
+        if image.nbytes > self.slot_bytes:
+            return False
+        data, headers = self.views()
+        n = self.written.value
+        slot = n % self.slots
+        dest = data[slot, :image.nbytes].view(image.dtype).reshape(image.shape)
+        numpy.copyto(dest, image)
+        headers[slot] = (n, timestamp, DTYPE_CODES[image.dtype],
+                         image.shape[0], image.shape[1], exposure)
+        self.written.value = n + 1
+        return True
+
+
+class AggregatorControl(object):
+    """The Pyro object served by the Aggregator.
+
+    Control methods take a camera label and are forwarded to that camera's
+    own server.
+    """
+    def __init__(self, rings):
+        self.rings = rings
+        self.client = None
+        self.read_counts = [ring.written.value for ring in rings]
+        self.lost_counts = [0 for ring in rings]
+        self.sent_count = 0
+        self.run_flag = True
+        self.serial_to_camera = {cam['serial']: cam for cam in CAMERAS.values()}
+
+
+    def _proxy(self, label):
+        cam = CAMERAS[label]
+        # Pyro proxies must not be shared between threads.
+        return Pyro4.Proxy('PYRO:pyroCam@%s:%d' % (cam['ipAddress'], cam['port']))
+
+
+    def call(self, label, method, *args, **kwargs):
+        """Call any Camera method on the camera with this label."""
+        return getattr(self._proxy(label), method)(*args, **kwargs)
+
+
+    def disable(self, label):
+        return self._proxy(label).disable()
+
+
+    def enable(self, label, settings={}):
+        return self._proxy(label).enable(settings)
+
+
+    def get_cameras(self):
+        """Return the labels and tags of cameras with frames in the rings."""
+        return {tags['label']: tags for tags in
+                (self.get_tags(ring) for ring in self.rings) if tags}
+
+
+    def get_stats(self):
+        """Return the number of frames sent, and lost per ring."""
+        lost = {}
+        for i, ring in enumerate(self.rings):
+            tags = self.get_tags(ring) or {'label': i}
+            lost[tags['label']] = self.lost_counts[i]
+        return {'sent': self.sent_count, 'lost': lost}
+
+
+    def get_tags(self, ring):
+        cam = self.serial_to_camera.get(ring.serial.value)
+        if cam is None:
+            return None
+        return {key: cam[key] for key in
+                ('label', 'serial', 'dyes', 'wavelengths')}
+
+
+    def receiveClient(self, uri):
+        """Handle connection request from a client for tagged frames."""
+        if uri is None:
+            self.client = None
+        else:
+            self.client = Pyro4.Proxy(uri)
+
+
+    def update_settings(self, label, settings):
+        return self._proxy(label).update_settings(settings)
+
+
+    def dispatch(self):
+        """Send frames from all rings to the client, oldest first per ring."""
+        while self.run_flag:
+            sent = False
+            for i, ring in enumerate(self.rings):
+                written = ring.written.value
+                behind = written - self.read_counts[i] - (ring.slots - 1)
+                if behind > 0:
+                    # The writer has lapped us.
+                    self.lost_counts[i] += behind
+                    self.read_counts[i] += behind
+                if self.read_counts[i] >= written:
+                    continue
+                n = self.read_counts[i]
+                self.read_counts[i] += 1
+                frame = ring.read(n)
+                client = self.client
+                if frame is None or client is None:
+                    self.lost_counts[i] += frame is None
+                    continue
+                image, timestamp, exposure = frame
+                tags = self.get_tags(ring)
+                if tags is not None:
+                    tags['exposure'] = exposure
+                try:
+                    client.receiveData('new tagged image', (tags, image),
+                                       timestamp)
+                except Pyro4.errors.CommunicationError:
+                    continue
+                if not ring.is_valid(n):
+                    # Overwritten while it was being sent.
+                    self.lost_counts[i] += 1
+                else:
+                    self.sent_count += 1
+                sent = True
+            if not sent:
+                time.sleep(0.001)
+
+
+if hasattr(Pyro4, 'expose'):
+    AggregatorControl = Pyro4.expose(AggregatorControl)
+
+
+class Aggregator(Process):
+    """A process to serve frames and control for several cameras over Pyro."""
+    def __init__(self, rings, host, port):
+        super(Aggregator, self).__init__()
+        self.rings = rings
+        self.host = host
+        self.port = port
+        # Shared object that indicates we should continue running.
+        self.shared_run_flag = RawValue('b', True)
+
+
+    def run(self):
+        control = AggregatorControl(self.rings)
+        daemon = Pyro4.Daemon(port=self.port, host=self.host)
+        pyro_thread = threading.Thread(
+            target=Pyro4.Daemon.serveSimple,
+            args=({control: 'pyroAggregator'},),
+            kwargs={'daemon': daemon, 'ns': False})
+        pyro_thread.daemon = True
+        pyro_thread.start()
+
+        dispatch_thread = threading.Thread(target=control.dispatch)
+        dispatch_thread.daemon = True
+        dispatch_thread.start()
+
+        while self.shared_run_flag.value:
+            time.sleep(1)
+
+        control.run_flag = False
+        dispatch_thread.join()
+        daemon.shutdown()
+
+
+    def stop(self):
+        self.shared_run_flag.value = False
@@ -29,8 +29,17 @@ Function names:
 """
 
 import andorsdk as sdk
+import framecodec
 import functools
 import numpy
+import metrics
+import pipeline
+import planner
+import realtime
+import tracing
+from aggregator import Aggregator, FrameRing
+from cameralog import CameraLogger
+from session import SessionRecorder
 import Pyro4
 Pyro4.config.SERIALIZER = 'pickle'
 Pyro4.config.SERIALIZERS_ACCEPTED.add('pickle')
@@ -39,9 +48,9 @@ import threading
 import time
 import weakref
 from ctypes import byref, c_float, c_int, c_long, c_ulong
-from ctypes import create_string_buffer, c_char, c_bool
+from ctypes import create_string_buffer, c_char, c_bool, POINTER
 from multiprocessing import Process, Value
-from collections import namedtuple
+from collections import deque
 
 try:
     from cameras import camera_keys as _camera_keys
@@ -51,6 +60,16 @@ except:
 else:
     CAMERAS = {camera[0]: dict(zip(_camera_keys, camera)) for camera in _cameras}
 
+try:
+    from cameras import aggregator_port
+except:
+    aggregator_port = None
+
+try:
+    from cameras import metrics_port_offset
+except:
+    metrics_port_offset = None
+
 
 # A list of the camera models this module supports (or should support.)
 SUPPORTED_CAMERAS = ['ixon', 'ixon_plus', 'ixon_ultra']
@@ -62,8 +81,16 @@ TRIGGERS = {-1: 'off',
             10: 'software',
             12: 'ex-chrge'}
 
+# 'accumulate' settings keys, and their defaults. A cycle time of 0
+# asks for the shortest the camera can do.
+ACCUMULATE_DEFAULTS = {'number': 1,             # Exposures summed per frame.
+                       'cycleTime': 0.,         # Time between them.
+                       'kinetics': None,        # Frames per kinetic series.
+                       'kineticCycleTime': 0.}  # Time between frames.
+
 ## A lock to prevent concurrent calls to the DLL by different Cameras.
-dll_lock = threading.Lock()
+# Re-entrant, so that Camera methods can call other Camera methods.
+dll_lock = threading.RLock()
 
 
 # Amplfier modes are defined by the AD channel, amplifier type,
@@ -108,27 +135,24 @@ def with_camera(func):
 
     If there are multiple cameras per process, this decorator obtains a
     lock on the DLL and calls SetCurrentCamera to ensure that the
-    library acts on the correct piece of hardware.
+    library acts on the correct piece of hardware. The lock is held per
+    thread, so a Camera's DataThread and Pyro threads exclude each
+    other as well as other Cameras.
     """
     @functools.wraps(func)
     def wrapper(self, *args, **kwargs):
         if not self.singleton:
             # There may be > 1 cameras per process, so lock the DLL.
-            had_lock_on_entry = self.has_lock
-            if not had_lock_on_entry:
-                dll_lock.acquire()
-                self.has_lock = True
-            try:
+            t0 = framecodec.monotonic()
+            with dll_lock:
+                if self.metrics is not None or self.tracer is not None:
+                    t1 = framecodec.monotonic()
+                    if self.metrics is not None:
+                        self.metrics.lock_wait_seconds.observe(t1 - t0)
+                    if self.tracer is not None:
+                        self.tracer.add('lock wait', t0, t1, 'lock')
                 sdk.SetCurrentCamera(self.handle)
                 result = func(self, *args, **kwargs)
-            except:
-                if dll_lock.locked():
-                    dll_lock.release()
-                    self.has_lock = False
-                raise
-            if dll_lock.locked() and not had_lock_on_entry:
-                dll_lock.release()
-                self.has_lock = False
 
         else:
             # There is only 1 camera per process - no locks required.
@@ -138,17 +162,69 @@ def with_camera(func):
     return wrapper
 
 
+def with_control_lock(func):
+    """A decorator for camera functions that stop or start acquisition.
+
+    The Camera's control lock is held for the whole call, so that the
+    DataThread cannot restart acquisition part way through a client's
+    abort and settings update. With more than one camera per process
+    this is the DLL lock, which with_camera also takes.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.control_lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+def recorded(func):
+    """A decorator for client functions that are recorded in sessions.
+
+    If the Camera is recording, the call is recorded before it is made,
+    and any resulting change to the camera settings afterwards. Calls
+    made from within another recorded call are not recorded.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        depth = getattr(_recorded_calls, 'depth', 0)
+        recorder = self.recorder if depth == 0 else None
+        if recorder is not None:
+            recorder.record_call(func.__name__, args, kwargs)
+        _recorded_calls.depth = depth + 1
+        try:
+            result = func(self, *args, **kwargs)
+        finally:
+            _recorded_calls.depth = depth
+        if recorder is not None:
+            recorder.record_settings(self.settings)
+        return result
+    return wrapper
+
+# Per-thread nesting of recorded calls.
+_recorded_calls = threading.local()
+
+
 def sdk_call(func):
     """A decorator for DLL functions called as methods of Camera.
 
-    This decorator simply passes args to func, without self.
+    This decorator passes args to func, without self, and times the
+    call, on the high-resolution framecodec.monotonic clock, if the
+    Camera has metrics or a tracer.
     """
     @functools.wraps(func)
     def sdk_wrapper(self, *args, **kwargs):
+        metrics, tracer = self.metrics, self.tracer
+        if metrics is None and tracer is None:
+            return func(*args, **kwargs)
+        t0 = framecodec.monotonic()
         try:
             return func(*args, **kwargs)
-        except:
-            raise
+        finally:
+            t1 = framecodec.monotonic()
+            if metrics is not None:
+                metrics.dll_call(func.__name__).observe(t1 - t0)
+            if tracer is not None:
+                tracer.add(func.__name__, t0, t1, 'dll')
     return sdk_wrapper
 
 
@@ -168,25 +244,6 @@ class CameraMeta(type):
         return type.__new__(meta, classname, supers, classdict)
 
 
-class CameraLogger(object):
-    def __init__(self):
-        self.fh = None
-
-    def log(self, message):
-        if self.fh:
-            self.fh.write(time.strftime('%Y-%m-%d %H:%M:%S:  '))
-            self.fh.write(message + '\n')
-            self.fh.flush()
-
-    def open(self, filename):
-        path = os.path.dirname(os.path.abspath(__file__))
-        self.fh = open(os.path.join(path, str(filename) + '.txt'), 'w')
-
-    def close(self):
-        self.fh.close()
-        self.fh = None
-
-
 class Camera(object):
     """Camera class for Andor cameras.
 
@@ -228,14 +285,14 @@ class Camera(object):
         self.count = 0
         # SDK's handle for the camera
         self.handle = handle
-        # Does this camera have the lock on the DLL?
-        self.has_lock = False
         # Detector dimensions in pixels.
         self.nx, self.ny = None, None
         # Detector capabilties.
         self.caps = sdk.AndorCapabilities()
         # Is this the only camera in this process?
         self.singleton = singleton
+        # Held while acquisition is stopped or started: see with_control_lock.
+        self.control_lock = threading.RLock() if singleton else dll_lock
         # Is the camera enabled?
         self.enabled = False
         # Is the camera armed for acquisition?
@@ -247,13 +304,73 @@ class Camera(object):
         self.settings = {}
         self.client = None
         self.logger = CameraLogger()
+        # Camera serial number, cached on first query.
+        self.serial = None
+        # Readout region (hstart, hend, vstart, vend), set on arm.
+        self.roi = None
+        # Master dark and flat frames for each readout configuration.
+        self.calibrations = pipeline.CalibrationCache()
+        # Should frames be dark- and flat-corrected before dispatch?
+        self.correction_enabled = False
+        # Thread to send low-resolution previews to a separate client.
+        self.preview_thread = None
+        # FrameAccumulator arguments, or None if not accumulating.
+        self.accumulation = None
+        # 'accumulate' settings summing frames on the camera, or None.
+        self.hardware_accumulation = None
+        # StatisticsSenders for clients of per-frame statistics, and the
+        # uris of subscribers added to send those clients frames.
+        self.statistics_clients = []
+        self.statistics_subscribers = []
+        # Photon counting or count conversion arguments, or None.
+        self.photon_counting = None
+        # HDRFusion arguments, or None if not fusing exposures.
+        self.hdr_fusion = None
+        # ExposureController for auto-exposure, or None.
+        self.exposure_controller = None
+        # Timings per readout configuration, for frame rate planning.
+        self.timing_model = planner.TimingModel()
+        # Shared-memory FrameRing read by an aggregator process, or None.
+        self.ring = None
+        # SessionRecorder for this camera, or None if not recording.
+        self.recorder = None
+        # CameraMetrics for this camera, or None if not publishing metrics.
+        self.metrics = None
+        # Tracer collecting spans, or None if not tracing.
+        self.tracer = None
+        # SamplingProfiler, or None if not profiling.
+        self.profiler = None
+        # Should the client receive frame headers?
+        self.client_headers = False
+        # Frame encoding for the client, or None for plain arrays, and
+        # options for its encoder.
+        self.client_encoding = None
+        self.client_encoding_options = None
+        # FrameView cropping frames for the client, or None for whole frames.
+        self.client_view = None
+        # Frames the client may have queued or unacknowledged, and should
+        # they be sent as oneway calls?
+        self.client_window = 8
+        self.client_oneway = False
+        # Subscribers receiving their own views of frames.
+        self.subscribers = []
+        # Incremented whenever settings change, and sent in frame headers.
+        self.settings_generation = 0
+        # Real-time scheduling settings, or None: see realtime.
+        self.real_time = None
+        # Exposure times the camera cycles through, one per frame; a single
+        # exposure unless ring exposures are set.
+        self.exposure_times = None
+        # Wall-clock time at monotonic time 0, set on arm.
+        self.clock_anchor = None
 
 
     ### Client functions. ###
+    @with_control_lock
     @with_camera
     def abort(self):
-        self.AbortAcquisition()
         self.acquiring = False
+        self.AbortAcquisition()
 
 
     @with_camera
@@ -271,17 +388,39 @@ class Camera(object):
         # SetReadMode to image.
         self.SetReadMode(4)
         # Set image to full sensor.
-        self.SetImage(1, 1, 1, self.nx, 1, self.ny)
+        self.roi = (1, self.nx, 1, self.ny)
+        self.SetImage(1, 1, *self.roi)
         # Reset image count.
         self.count = 0
+        self.clock_anchor = framecodec.clock_anchor()
 
         # Make sure there is a data thread running.
         if not self.data_thread or not self.data_thread.is_alive():
             self.logger.log('Starting data thread.')
             self.data_thread = DataThread(self, self.client)
+            self.data_thread.set_client(self.client, self.client_headers,
+                                        self.client_encoding,
+                                        self.client_encoding_options,
+                                        self.client_view, self.client_window,
+                                        self.client_oneway)
+            self.data_thread.set_subscribers(self.subscribers)
+            self.data_thread.set_real_time(self.real_time)
+            self.data_thread.set_preview(self.preview_thread)
+            self.data_thread.set_statistics_clients(self.statistics_clients)
+            self.update_readout()
+            self.data_thread.set_exposure_controller(self.exposure_controller)
+            self.data_thread.set_ring(self.ring)
+            self.data_thread.set_recorder(self.recorder)
+            self.data_thread.set_metrics(self.metrics)
+            self.data_thread.set_tracer(self.tracer)
             self.update_transform()
             self.data_thread.start()
 
+        # Pick up calibration frames for the current configuration.
+        self.update_correction()
+        # Start processing stages afresh.
+        self.update_stages()
+
         # Set camera to espond to triggers.
         self.logger.log('Starting acquisition.')
         try:
@@ -292,7 +431,7 @@ class Camera(object):
             self.acquiring = True
 
 
-    @with_camera
+    @recorded
     def disable(self):
         self.logger.log('Disabling camera.')
         self.enabled = False
@@ -307,7 +446,7 @@ class Camera(object):
             self.data_thread = None
 
 
-    @with_camera
+    @recorded
     def enable(self, settings={}):
         # Clear the flag so that our client will poll until it is True.
         self.disable()
@@ -350,6 +489,8 @@ class Camera(object):
         # However, mode 7 is not documented, so here we use mode 5 and
         # determine frame transfer usage with SetFrameTransferMode.
         # In old UCSF code, this was achieved by using acquisition mode 7.
+        # Hardware accumulation is set again from settings, if need be.
+        self.hardware_accumulation = None
         self.set_acquisition_mode(5)
 
 
@@ -368,10 +509,70 @@ class Camera(object):
         return self.enabled
 
 
+    @recorded
+    @with_control_lock
+    @with_camera
+    def apply_live_settings(self, settings):
+        """Apply exposure time and EM gain without disturbing the data stream.
+
+        Unlike update_settings, this leaves the enabled flag, the data thread
+        and its processing stages alone. EM gain is changed during
+        acquisition; a new exposure time needs a quick abort and restart.
+        """
+        unsupported = set(settings.keys()) - set(['exposureTime', 'EMGain'])
+        if unsupported:
+            raise Exception('Cannot apply %s during acquisition.'
+                            % ', '.join(sorted(unsupported)))
+        if 'exposureTime' in settings and self.settings.get('ringExposureTimes'):
+            raise Exception('Cannot set an exposure time with ring exposures.')
+        self.settings_generation += 1
+        if 'EMGain' in settings:
+            self.SetEMCCDGain(int(settings['EMGain']))
+            self.settings['EMGain'] = int(settings['EMGain'])
+        exposure = settings.get('exposureTime')
+        if exposure is not None and exposure != self.settings.get('exposureTime'):
+            restart = self.acquiring
+            if restart:
+                self.AbortAcquisition()
+            self.SetExposureTime(float(exposure))
+            self.set_fastest_vs_speed()
+            self.settings['exposureTime'] = float(exposure)
+            if self.hardware_accumulation:
+                # Cycle times depend on the exposure time.
+                self.set_hardware_accumulation(self.hardware_accumulation)
+            else:
+                self.exposure_times = (float(exposure),)
+            if restart:
+                self.StartAcquisition()
+            self.update_correction()
+
+
     def get_image_size(self):
         return (self.nx, self.ny)
 
 
+    def set_real_time(self, value):
+        """Set real-time scheduling of the data path.
+
+        value is as for the 'realTime' setting: see realtime.parse_settings.
+        The process priority is changed here; each data path thread
+        changes its own scheduling, and the data thread holds off the
+        garbage collector while it runs.
+        """
+        settings = realtime.parse_settings(value)
+        if settings is not None or self.real_time is not None:
+            try:
+                realtime.set_process_priority(
+                    settings is not None and settings['priority'])
+            except Exception as e:
+                self.logger.log('Real-time mode: %s' % e, CameraLogger.WARNING)
+        self.real_time = settings
+        for subscriber in self.subscribers:
+            subscriber.set_real_time(settings)
+        if self.data_thread is not None:
+            self.data_thread.set_real_time(settings)
+
+
     @with_camera
     def get_exposure_time(self):
         (exposure, accumulate, kinetics) = self.get_acquisition_timings()
@@ -407,6 +608,184 @@ class Camera(object):
             return 0.1
 
 
+    @with_control_lock
+    @with_camera
+    def measure_timings(self):
+        """Measure timings for each readout configuration, for planning.
+
+        Each amplifier mode is measured with and without frame transfer,
+        in run till abort mode with the current trigger settings. This
+        pauses any acquisition, then restores the current configuration.
+        """
+        self.logger.log('Measuring readout timings.')
+        restart = self.acquiring
+        if restart:
+            self.abort()
+        model = self.timing_model
+        model.clear()
+        try:
+            self.SetAcquisitionMode(5)
+            for mode in self.get_amplifier_modes():
+                channel = int(mode['channel'])
+                amplifier = int(mode['amplifier'])
+                index = int(mode['index'])
+                self.SetADChannel(channel)
+                self.SetOutputAmplifier(amplifier)
+                self.SetHSSpeed(amplifier, index)
+                hs_speed = c_float()
+                self.GetHSSpeed(channel, amplifier, index, hs_speed)
+                for frame_transfer in (0, 1):
+                    self.SetFrameTransferMode(frame_transfer)
+                    self.set_fastest_vs_speed()
+                    self.SetExposureTime(planner.SHORT_EXPOSURE)
+                    exposure, accumulate, floor = self.get_acquisition_timings()
+                    self.SetExposureTime(planner.LONG_EXPOSURE)
+                    exposure, accumulate, kinetic = self.get_acquisition_timings()
+                    model.add(mode, frame_transfer, hs_speed.value,
+                              self.get_read_out_time(),
+                              self.get_keep_clean_time(),
+                              floor, kinetic - exposure)
+        except Exception:
+            # Don't plan from a partial set of timings.
+            model.clear()
+            raise
+        finally:
+            # Restore the configuration.
+            if self.settings.get('amplifierMode') is not None:
+                self.set_amplifier_mode(self.settings['amplifierMode'])
+            self.SetFrameTransferMode(int(self.settings.get('frameTransfer')
+                                          or 0))
+            self.set_fastest_vs_speed()
+            ring = self.settings.get('ringExposureTimes')
+            if ring:
+                self.set_ring_exposure_times(ring)
+            else:
+                self.set_exposure_time(float(self.settings.get('exposureTime')
+                                             or 0.1))
+            if self.hardware_accumulation:
+                self.set_hardware_accumulation(self.hardware_accumulation)
+            else:
+                self.set_acquisition_mode(self.acquisition_mode or 5)
+            if restart:
+                self.StartAcquisition()
+                self.acquiring = True
+        return len(model.entries)
+
+
+    @recorded
+    @with_control_lock
+    @with_camera
+    def plan_frame_rate(self, fps, exposure=None, amplifier=None, apply=False):
+        """Return the best readout configuration for fps at exposure.
+
+        exposure defaults to the current exposure time, and amplifier to
+        that of the current amplifier mode: pass 0 for EM or 1 for
+        conventional. Plans are made from timings measured on the first
+        call, or by measure_timings: see planner.TimingModel.plan. With
+        apply True, the plan's settings and exposure are also applied:
+        only those, and only if they differ from the current settings.
+        """
+        if exposure is None:
+            exposure = float(self.settings.get('exposureTime') or 0.)
+        if amplifier is None:
+            amplifier = (self.settings.get('amplifierMode') or {}).get('amplifier')
+        if not self.timing_model.entries:
+            self.measure_timings()
+        plan = self.timing_model.plan(fps, exposure, amplifier)
+        if apply:
+            self.apply_plan(dict(plan['settings'], exposureTime=exposure))
+        return plan
+
+
+    @recorded
+    @with_control_lock
+    @with_camera
+    def apply_plan(self, settings):
+        """Apply a plan's amplifierMode, frameTransfer and exposureTime.
+
+        Unlike update_settings, this applies keys not yet in settings,
+        without applying all the others.
+        """
+        changed = set(key for key, value in settings.iteritems()
+                      if self.settings.get(key) != value)
+        if not changed:
+            return
+        self.logger.log('Applying planned settings: %s'
+                        % ', '.join(sorted(changed)))
+        restart = self.acquiring
+        if restart:
+            self.abort()
+        self.enabled = False
+        self.settings.update(settings)
+        self.settings_generation += 1
+        if 'amplifierMode' in changed:
+            self.set_amplifier_mode(settings['amplifierMode'])
+        if 'frameTransfer' in changed:
+            self.SetFrameTransferMode(int(settings['frameTransfer']))
+        if 'exposureTime' in changed:
+            # Ring exposures replace the exposure time.
+            ring = self.settings.get('ringExposureTimes')
+            if ring:
+                self.set_ring_exposure_times(ring)
+            else:
+                self.set_exposure_time(float(settings['exposureTime']))
+            # Accumulation cycle times depend on the exposure time.
+            if self.hardware_accumulation:
+                self.set_hardware_accumulation(self.settings.get('accumulate'))
+        self.set_fastest_vs_speed()
+        # Calibration frames depend on exposure and amplifier mode.
+        if changed.intersection(['exposureTime', 'amplifierMode']):
+            self.update_correction()
+        # Don't mix frames from before and after the update.
+        self.update_stages()
+        self.enabled = True
+        if restart:
+            self.StartAcquisition()
+            self.acquiring = True
+
+
+    def acknowledge(self, frames=1, uri=None):
+        """Acknowledge frames received by a oneway client.
+
+        uri is that of a subscriber, or None for the main client.
+        """
+        if uri is None:
+            if self.data_thread is not None:
+                subscriber = self.data_thread.sender
+            else:
+                subscriber = None
+        else:
+            subscriber = ([s for s in self.subscribers if s.uri == uri]
+                          or [None])[0]
+        if subscriber is not None:
+            subscriber.acknowledge(frames)
+
+
+    def get_delivery_stats(self):
+        """Return frame delivery statistics for the client and subscribers."""
+        stats = {}
+        if self.data_thread is not None and self.data_thread.sender:
+            stats[None] = self.data_thread.sender.get_stats()
+        for subscriber in self.subscribers:
+            stats[subscriber.uri] = subscriber.get_stats()
+        return stats
+
+
+    def get_encoding_stats(self):
+        """Return compression statistics for the client's frame encoding."""
+        if self.data_thread is None or self.data_thread.sender is None:
+            return None
+        encoder = self.data_thread.sender.encoder
+        if not hasattr(encoder, 'get_stats'):
+            return None
+        return encoder.get_stats()
+
+
+    def get_log_stats(self):
+        """Return logger message counts. Useful for Pyro debug."""
+        return self.logger.get_stats()
+
+
     def get_settings(self):
         """Return the current settings dict. Useful for Pyro debug."""
         return self.settings
@@ -432,19 +811,235 @@ class Camera(object):
         self.enabled = False
 
 
-    def receiveClient(self, uri):
-        """Handle connection request from cockpit client."""
+    @recorded
+    def receiveClient(self, uri, headers=False, encoding=None,
+                      encoding_options=None, roi=None, stride=1, binning=1,
+                      window=8, oneway=False):
+        """Handle connection request from cockpit client.
+
+        By default, the client receives
+            receiveData('new image', image, timestamp).
+        If headers is set, it receives
+            receiveData('new frame', (header, image), timestamp)
+        where header is a packed frame header. If encoding is set, to
+        'raw', 'zlib' for compression or 'packed' for bit packing,
+        images are sent encoded and decoded by the client on
+        unpickling, so the client needs framecodec. encoding_options are passed to the encoder: see
+        framecodec.get_encoder.
+        roi, stride and binning select the part of each transformed frame
+        that is sent: see pipeline.FrameView.
+        Frames are sent from their own thread, with at most window frames
+        queued: see Subscriber. If oneway is set, the client must call
+        acknowledge for the frames it receives.
+        """
         if uri is None:
             self.logger.log('Clearing receiveClient.')
             self.client = None
+            if self.data_thread is not None:
+                self.data_thread.set_client(None)
         else:
+            # Check the encoding and view before changing anything.
+            framecodec.get_encoder(encoding, encoding_options)
+            view = pipeline.make_view(roi, stride, binning)
             self.logger.log('Setting receiveClient to ' + uri + '.')
             self.client = Pyro4.Proxy(uri)
+            self.client_headers = headers
+            self.client_encoding = encoding
+            self.client_encoding_options = encoding_options
+            self.client_view = view
+            self.client_window = window
+            self.client_oneway = oneway
             if self.data_thread is not None:
                 self.logger.log('receiveClient set in data_thread.')
-                self.data_thread.set_client(self.client)
+                self.data_thread.set_client(self.client, headers, encoding,
+                                            encoding_options, view, window,
+                                            oneway)
+
 
+    def receivePreviewClient(self, uri, binning=4, method='mean',
+                             scale=True, max_rate=10.):
+        """Handle a request for low-resolution previews of frames.
 
+        Previews are binned ('mean') or decimated ('decimate') by binning,
+        optionally scaled to 8 bits, and sent at no more than max_rate Hz.
+        """
+        if self.preview_thread is not None:
+            self.preview_thread.stop()
+            self.preview_thread.join(5)
+            self.preview_thread = None
+        if uri is None:
+            self.logger.log('Clearing receivePreviewClient.')
+        else:
+            self.logger.log('Setting receivePreviewClient to %s: binning %d '
+                            '(%s), scale %s, %s Hz.'
+                            % (uri, binning, method, scale, max_rate))
+            self.preview_thread = PreviewThread(self, Pyro4.Proxy(uri),
+                                                binning, method, scale,
+                                                max_rate)
+            self.preview_thread.start()
+        if self.data_thread is not None:
+            self.data_thread.set_preview(self.preview_thread)
+
+
+    def receiveStatisticsClient(self, uri, every=1, with_frames=False):
+        """Handle a request for per-frame statistics.
+
+        Statistics are computed on every 'every'th frame and sent as
+        receiveData('new statistics', record, timestamp), from a thread of
+        their own: see StatisticsSender. If with_frames is set, the client
+        also receives frames, as a subscriber. A client with the same uri
+        is replaced. Pass uri=None to clear all statistics clients.
+        """
+        if uri is None:
+            self.logger.log('Clearing statistics clients.')
+            remove = self.statistics_clients
+            self.statistics_clients = []
+        else:
+            self.logger.log('Adding statistics client %s (every %d).'
+                            % (uri, every))
+            sender = StatisticsSender(Pyro4.Proxy(uri), every, self.logger,
+                                      uri)
+            remove = [s for s in self.statistics_clients if s.uri == uri]
+            sender.start()
+            self.statistics_clients = [s for s in self.statistics_clients
+                                       if s.uri != uri] + [sender]
+        for sender in remove:
+            sender.stop()
+            if sender.uri in self.statistics_subscribers:
+                self.statistics_subscribers.remove(sender.uri)
+                self.removeSubscriber(sender.uri)
+        if uri is not None and with_frames:
+            self.receiveSubscriber(uri)
+            self.statistics_subscribers.append(uri)
+        if self.data_thread is not None:
+            self.data_thread.set_statistics_clients(self.statistics_clients)
+
+
+    def receiveSubscriber(self, uri, roi=None, stride=1, binning=1,
+                          headers=False, encoding=None,
+                          encoding_options=None, window=8, oneway=False):
+        """Add a client that receives its own view of each frame.
+
+        Subscribers receive frames as the main client does, but only the
+        part selected by roi, stride and binning (see pipeline.FrameView),
+        so that several clients interested in different parts of the
+        sensor need not each receive whole frames. A subscriber with the
+        same uri is replaced. Pass uri=None to clear all subscribers.
+        """
+        if uri is None:
+            self.logger.log('Clearing subscribers.')
+            self.removeSubscriber(None)
+            return
+        subscriber = Subscriber(
+            Pyro4.Proxy(uri), headers,
+            framecodec.get_encoder(encoding, encoding_options),
+            pipeline.make_view(roi, stride, binning), window, oneway,
+            self.logger, uri)
+        subscriber.set_real_time(self.real_time)
+        self.logger.log('Adding subscriber %s: roi %s, stride %d, '
+                        'binning %d.' % (uri, roi, stride, binning))
+        self.removeSubscriber(uri)
+        subscriber.start()
+        self.subscribers = self.subscribers + [subscriber]
+        if self.data_thread is not None:
+            self.data_thread.set_subscribers(self.subscribers)
+
+
+    def removeSubscriber(self, uri):
+        """Stop sending frames to the subscriber with this uri, or to all
+        subscribers if uri is None."""
+        for subscriber in self.subscribers:
+            if uri is None or subscriber.uri == uri:
+                subscriber.stop()
+        self.subscribers = [s for s in self.subscribers
+                            if uri is not None and s.uri != uri]
+        if self.data_thread is not None:
+            self.data_thread.set_subscribers(self.subscribers)
+
+
+    def enable_metrics(self, registry=metrics.registry):
+        """Publish this camera's metrics on registry, labelled by serial."""
+        self.metrics = metrics.CameraMetrics(self.get_camera_serial_number(),
+                                             registry)
+        self.metrics.temperature.set_function(self.get_temperature)
+        self.metrics.buffer_images.set_function(self.get_number_new_images)
+        if self.data_thread is not None:
+            self.data_thread.set_metrics(self.metrics)
+
+
+    def start_profile(self, duration=10., interval=0.001):
+        """Sample the stacks of all threads for up to duration seconds."""
+        self.stop_profile()
+        self.logger.log('Profiling for %gs.' % duration)
+        self.profiler = tracing.SamplingProfiler(duration, interval)
+        self.profiler.start()
+
+
+    def stop_profile(self):
+        """Stop profiling and return the samples as pstats data.
+
+        Load the data with tracing.load_stats.
+        """
+        profiler = self.profiler
+        if profiler is None:
+            return None
+        self.profiler = None
+        profiler.stop()
+        profiler.join()
+        self.logger.log('Profiled %d samples.' % profiler.samples)
+        return profiler.dumps()
+
+
+    def start_trace(self, duration=10., max_events=100000):
+        """Trace DLL calls, lock waits and frame handling for duration s."""
+        self.logger.log('Tracing for %gs.' % duration)
+        self.tracer = tracing.Tracer(duration, max_events)
+        if self.data_thread is not None:
+            self.data_thread.set_tracer(self.tracer)
+
+
+    def stop_trace(self):
+        """Stop tracing and return the spans as a Chrome trace JSON string."""
+        tracer = self.tracer
+        if tracer is None:
+            return None
+        self.tracer = None
+        if self.data_thread is not None:
+            self.data_thread.set_tracer(None)
+        self.logger.log('Traced %d spans.' % len(tracer.events))
+        return tracer.to_chrome_trace()
+
+
+    def start_recording(self, filename):
+        """Record frames, client calls and settings changes to filename."""
+        self.stop_recording()
+        self.logger.log('Recording session to %s.' % filename)
+        self.recorder = SessionRecorder(filename)
+        self.recorder.record_settings(self.settings)
+        if self.data_thread is not None:
+            self.data_thread.set_recorder(self.recorder)
+
+
+    def stop_recording(self):
+        """Stop recording, and return the recorder's statistics."""
+        recorder = self.recorder
+        if recorder is None:
+            return None
+        self.recorder = None
+        if self.data_thread is not None:
+            self.data_thread.set_recorder(None)
+        recorder.close()
+        self.logger.log('Recorded session to %s: %s.'
+                        % (recorder.filename, recorder.get_stats()))
+        return recorder.get_stats()
+
+
+    def set_log_level(self, level):
+        """Set the minimum level of messages to log, e.g. CameraLogger.DEBUG."""
+        self.logger.level = level
+
+
+    @recorded
     def skip_images(self, next=None, every=None):
         if next:
             self.logger.log('Skipping next %d images.' % next)
@@ -455,6 +1050,192 @@ class Camera(object):
             self.data_thread.skip_every_n_images = every
 
 
+    def clear_calibration(self):
+        """Discard calibration frames for the current configuration."""
+        self.calibrations.remove(self.get_calibration_key())
+        self.update_correction()
+
+
+    def get_calibration_key(self):
+        """Return the calibration cache key for the current configuration."""
+        if self.serial is None:
+            self.get_camera_serial_number()
+        return self.calibrations.make_key(self.serial,
+                                          self.settings.get('amplifierMode'),
+                                          self.settings.get('exposureTime'),
+                                          self.roi)
+
+
+    def set_calibration(self, dark=None, flat=None):
+        """Store a master dark and/or flat for the current configuration."""
+        key = self.get_calibration_key()
+        self.logger.log('Storing calibration for %s.' % (key,))
+        self.calibrations.store(key, dark, flat)
+        self.update_correction()
+
+
+    def set_accumulation(self, n=None, mode='block', average=False,
+                         emit_every=None):
+        """Send only the sum or mean of every n frames.
+
+        mode is 'block' for non-overlapping blocks of n frames, or 'rolling'
+        for a window over the last n frames, sent every emit_every frames.
+        Pass n=None to send every frame.
+        """
+        if n is None or n <= 1:
+            self.logger.log('Clearing accumulation.')
+            self.accumulation = None
+        else:
+            self.accumulation = {'n': n, 'mode': mode, 'average': average,
+                                 'emit_every': emit_every}
+            # Check the arguments before they reach the data thread.
+            pipeline.FrameAccumulator(**self.accumulation)
+            self.logger.log('Setting accumulation to %s.' % self.accumulation)
+        self.update_stages()
+
+
+    def set_hdr_fusion(self, enable=True, saturation=None):
+        """Send one HDR frame per cycle of ring exposures.
+
+        Each group of frames, one per ring exposure time, is fused into
+        a float32 frame of counts above the baseline (see get_baseline), at
+        the longest exposure: see pipeline.HDRFusion. Pixels at or above
+        saturation, by default the top of the camera's bit depth, are
+        excluded from the fusion.
+        """
+        if not enable:
+            self.logger.log('Clearing HDR fusion.')
+            self.hdr_fusion = None
+        elif self.photon_counting:
+            raise Exception('Cannot use HDR fusion with photon counting.')
+        else:
+            self.hdr_fusion = {'saturation': saturation}
+            self.logger.log('Setting HDR fusion to %s.' % self.hdr_fusion)
+        self.update_stages()
+
+
+    def set_photon_counting(self, mode=None, thresholds=None, num_frames=1):
+        """Convert or photon-count frames before they are sent.
+
+        mode is 'electrons' or 'photons' for count conversion using the
+        current baseline, EM gain, sensitivity and QE; 'counting' to score
+        pixels against thresholds, summed over num_frames frames; or None
+        to send counts unchanged.
+        """
+        if mode is None:
+            self.logger.log('Clearing photon counting.')
+            self.photon_counting = None
+        elif mode in ('electrons', 'photons', 'counting'):
+            if self.hdr_fusion:
+                raise Exception('Cannot use photon counting with HDR fusion.')
+            if mode == 'counting' and not thresholds:
+                raise Exception('Photon counting needs at least one threshold.')
+            self.photon_counting = {'mode': mode, 'thresholds': thresholds,
+                                    'num_frames': num_frames}
+            self.logger.log('Setting photon counting to %s.'
+                            % self.photon_counting)
+        else:
+            raise Exception('Bad photon counting mode: %s.' % mode)
+        self.update_stages()
+
+
+    def set_auto_exposure(self, target=None, percentile=99.,
+                          exposure_limits=(0.001, 1.), gain_limits=(0, 0),
+                          tolerance=0.1, min_interval=1.):
+        """Adjust exposure and EM gain to hold a histogram percentile at target.
+
+        target is in counts above the 'baselineOffset' setting. Exposure and
+        EM gain are kept within their limits: the default gain limits fix
+        the gain. Adjustments are made at most every min_interval seconds.
+        Pass target=None to turn auto-exposure off.
+        """
+        if target is None:
+            self.logger.log('Clearing auto-exposure.')
+            self.exposure_controller = None
+        elif self.settings.get('ringExposureTimes'):
+            raise Exception('Cannot use auto-exposure with ring exposures.')
+        elif self.hardware_accumulation:
+            raise Exception('Cannot use auto-exposure with hardware accumulation.')
+        else:
+            self.exposure_controller = pipeline.ExposureController(
+                target, percentile, exposure_limits, gain_limits,
+                self.get_baseline(), tolerance, min_interval)
+            self.logger.log('Setting auto-exposure: %s at %s%%, exposure %s, '
+                            'EM gain %s.' % (target, percentile,
+                                             exposure_limits, gain_limits))
+        if self.data_thread is not None:
+            self.data_thread.set_exposure_controller(self.exposure_controller)
+
+
+    def set_correction(self, enable=True):
+        """Turn dark and flat correction of outgoing frames on or off."""
+        self.logger.log('Setting dark/flat correction to %s.' % enable)
+        self.correction_enabled = bool(enable)
+        self.update_correction()
+
+
+    def update_correction(self):
+        """Set the data_thread correction stage for the current configuration."""
+        if self.data_thread is None:
+            # Nothing to do.
+            return
+        stage = None
+        if self.correction_enabled and self.hardware_accumulation:
+            # Calibration frames are single exposures, not sums.
+            self.logger.log('Hardware accumulation: not correcting.')
+        elif self.correction_enabled:
+            key = self.get_calibration_key()
+            entry = self.calibrations.lookup(key)
+            if entry is None:
+                self.logger.log('No calibration for %s: not correcting.' % (key,))
+            else:
+                stage = pipeline.DarkFlatCorrection(
+                    self.data_thread.image_array.shape,
+                    entry['dark'], entry['flat'],
+                    self.data_thread.image_array.dtype,
+                    self.get_baseline())
+        self.data_thread.set_correction(stage)
+        if self.exposure_controller is not None:
+            self.exposure_controller.baseline = self.get_baseline()
+
+
+    def get_baseline(self):
+        """Return the baseline of frames as processing stages receive them.
+
+        This is the 'baselineOffset' setting, which dark correction adds
+        back as a pedestal after subtracting the dark.
+        """
+        return self.settings.get('baselineOffset', 100)
+
+
+    def update_stages(self):
+        """Set the data_thread processing stages from current settings."""
+        if self.data_thread is None:
+            # Nothing to do.
+            return
+        stages = []
+        baseline = self.get_baseline()
+        if self.hdr_fusion:
+            saturation = self.hdr_fusion['saturation']
+            if saturation is None:
+                saturation = (1 << self.get_bit_depth()) - 1
+            stages.append(pipeline.HDRFusion(
+                len(self.exposure_times or [None]), saturation, baseline))
+        if self.photon_counting:
+            mode = self.photon_counting['mode']
+            if mode == 'counting':
+                stages.append(pipeline.PhotonCounter(
+                    self.photon_counting['thresholds'],
+                    self.photon_counting['num_frames']))
+            else:
+                parameters = self.get_count_convert_parameters()
+                self.logger.log('Count conversion parameters: %s.' % parameters)
+                stages.append(pipeline.CountConverter(mode=mode, **parameters))
+        if self.accumulation:
+            stages.append(pipeline.FrameAccumulator(**self.accumulation))
+        self.data_thread.set_stages(stages)
+
+
     def update_transform(self, transform=None):
         # If there is a data thread, then update its transform
         if self.data_thread is None:
@@ -483,6 +1264,8 @@ class Camera(object):
         logstr += '  result:\t%s\n' % (tprime,)
         self.logger.log(logstr)
 
+    @recorded
+    @with_control_lock
     @with_camera
     def update_settings(self, settings, init=False):
         # Store the triggering state on entry.
@@ -523,6 +1306,7 @@ class Camera(object):
 
         # Update this camera's settings dict.
         self.settings.update(settings)
+        self.settings_generation += 1
 
         # Apply changed settings to the hardware.
         for key in update_keys:
@@ -542,13 +1326,41 @@ class Camera(object):
                 self.update_transform(val)
             elif key == 'fastTrigger':
                 self.SetFastExtTrigger(val)
+                # Timings depend on triggering.
+                self.timing_model.clear()
             elif key == 'triggerMode':
                 self.SetTriggerMode(val)
-
+                self.timing_model.clear()
+            elif key == 'realTime':
+                self.set_real_time(val)
+
+        # Ring exposures replace the exposure time, so are set after it.
+        if update_keys.intersection(['exposureTime', 'ringExposureTimes']):
+            ring = self.settings.get('ringExposureTimes')
+            if ring:
+                self.set_ring_exposure_times(ring)
+            elif 'ringExposureTimes' in update_keys:
+                # Back to a ring of one exposure.
+                exposure = float(self.settings['exposureTime'])
+                self.set_ring_exposure_times([exposure])
+                self.set_exposure_time(exposure)
+
+        # Accumulation cycle times depend on the exposure time.
+        if ('accumulate' in update_keys or self.hardware_accumulation
+                and 'exposureTime' in update_keys):
+            self.set_hardware_accumulation(self.settings.get('accumulate'))
     
         # Recalculate and apply fastest vertical shift speed.
         self.set_fastest_vs_speed()
 
+        # Calibration frames depend on exposure and amplifier mode, and
+        # the correction's pedestal on the baseline.
+        if update_keys.intersection(['exposureTime', 'amplifierMode',
+                                     'accumulate', 'baselineOffset']):
+            self.update_correction()
+        # Don't mix frames from before and after the update.
+        self.update_stages()
+
         # Set enabled indicator flag.
         self.enabled = True
 
@@ -587,11 +1399,23 @@ class Camera(object):
         return modes
 
 
+    @with_camera
+    def get_bit_depth(self, channel=None):
+        """Return the bit depth of an AD channel, by default the current one."""
+        if channel is None:
+            mode = self.settings.get('amplifierMode') or {}
+            channel = mode.get('channel', 0)
+        depth = c_int()
+        sdk.GetBitDepth(int(channel), depth)
+        return depth.value
+
+
     @with_camera
     def get_camera_serial_number(self):
         sn = c_int()
         sdk.GetCameraSerialNumber(sn)
-        return sn.value
+        self.serial = sn.value
+        return self.serial
 
 
     @with_camera
@@ -600,6 +1424,40 @@ class Camera(object):
         return self.caps
 
 
+    @with_camera
+    def get_count_convert_parameters(self):
+        """Return baseline, EM gain, sensitivity and QE for count conversion.
+
+        The baseline and preamp gain index are taken from the 'baselineOffset'
+        and 'preAmpGainIndex' settings; QE is looked up at the
+        'countConvertWavelength' setting, and is 1 if that is not set.
+        """
+        mode = self.settings.get('amplifierMode')
+        if mode is None:
+            mode = self.get_amplifier_modes()[-1]
+        sensitivity = c_float()
+        sdk.GetSensitivity(int(mode['channel']), int(mode['index']),
+                           int(mode['amplifier']),
+                           int(self.settings.get('preAmpGainIndex', 0)),
+                           sensitivity)
+        if int(mode['amplifier']) == 0:
+            em_gain = self.get_emccd_gain()
+        else:
+            # Conventional amplifier: no EM gain.
+            em_gain = 1
+        qe = 1.
+        wavelength = self.settings.get('countConvertWavelength')
+        if wavelength:
+            value = c_float()
+            sdk.GetQE(self.get_head_model(), float(wavelength), 0, value)
+            # The SDK reports QE as a percentage.
+            qe = value.value / 100.
+        return {'baseline': self.settings.get('baselineOffset', 100),
+                'em_gain': em_gain,
+                'sensitivity': sensitivity.value,
+                'qe': qe}
+
+
     @with_camera
     def get_detector(self):
         """Populate nx and ny with the detector geometry."""
@@ -617,6 +1475,16 @@ class Camera(object):
         return state.value
 
 
+    @with_camera
+    def get_number_new_images(self):
+        """Return the number of images waiting in the circular buffer."""
+        first, last = c_long(), c_long()
+        result = sdk.GetNumberNewImages(first, last)
+        if result[0] != sdk.DRV_SUCCESS:
+            return 0
+        return last.value - first.value + 1
+
+
     @with_camera
     def get_emccd_gain(self):
         gain = c_int()
@@ -715,6 +1583,60 @@ class Camera(object):
         return ready
 
 
+    @with_camera
+    def post_process_count_convert(self, images, mode='electrons'):
+        """Count-convert a stack of images with the SDK, using current settings."""
+        images = numpy.array(images, dtype=numpy.int32, ndmin=3)
+        output = numpy.zeros_like(images)
+        p = self.get_count_convert_parameters()
+        sdk.PostProcessCountConvert(
+            images.ctypes.data_as(POINTER(sdk.at_32)),
+            output.ctypes.data_as(POINTER(sdk.at_32)),
+            output.size, images.shape[0], int(p['baseline']),
+            {'electrons': 1, 'photons': 2}[mode], int(p['em_gain']),
+            p['qe'], p['sensitivity'], images.shape[1], images.shape[2])
+        return output
+
+
+    @with_camera
+    def post_process_photon_counting(self, images, thresholds, num_frames=1):
+        """Photon-count a stack of images with the SDK."""
+        images = numpy.array(images, dtype=numpy.int32, ndmin=3)
+        num_images = images.shape[0] // num_frames
+        output = numpy.zeros((num_images,) + images.shape[1:],
+                             dtype=numpy.int32)
+        levels = (c_float * len(thresholds))(*thresholds)
+        sdk.PostProcessPhotonCounting(
+            images.ctypes.data_as(POINTER(sdk.at_32)),
+            output.ctypes.data_as(POINTER(sdk.at_32)),
+            output.size, num_images, num_frames, len(thresholds), levels,
+            images.shape[1], images.shape[2])
+        return output
+
+
+    @with_camera
+    def validate_photon_counting(self, images, thresholds, num_frames=1):
+        """Compare pipeline and SDK post-processing on reference images.
+
+        Returns the largest absolute difference for each mode. The SDK
+        returns whole numbers, so conversions may differ by up to 1.
+        """
+        images = numpy.array(images, dtype=numpy.uint16, ndmin=3)
+        parameters = self.get_count_convert_parameters()
+        result = {}
+        for mode in ('electrons', 'photons'):
+            ours = pipeline.CountConverter(mode=mode, **parameters)
+            theirs = self.post_process_count_convert(images, mode)
+            result[mode] = float(abs(ours.process(images) - theirs).max())
+        ours = pipeline.PhotonCounter(thresholds, num_frames)
+        theirs = self.post_process_photon_counting(images, thresholds,
+                                                   num_frames)
+        result['counting'] = float(abs(ours.count_stack(images).astype(int)
+                                       - theirs).max())
+        self.logger.log('Photon counting validation: %s.' % result)
+        return result
+
+
     @with_camera
     def set_amplifier_mode(self, mode):
         # If no mode was specified, use the first mode."""
@@ -740,6 +1662,107 @@ class Camera(object):
     def set_acquisition_mode(self, mode):
         self.SetAcquisitionMode(mode)
         self.acquisition_mode = mode
+        self.update_readout()
+
+
+    @with_camera
+    def set_hardware_accumulation(self, value):
+        """Sum exposures on the camera, or stop doing so.
+
+        value is as for the 'accumulate' setting: None to run until abort,
+        or a dict overriding ACCUMULATE_DEFAULTS. Each frame is the sum of
+        'number' exposures, read as 32-bit data. With 'kinetics' set, the
+        camera takes series of that many frames; otherwise, one frame at a
+        time. The data thread starts the next frame or series as soon as
+        the last is read. Return the accumulation and kinetic cycle times
+        the camera will use.
+        """
+        if not value:
+            self.hardware_accumulation = None
+            self.set_acquisition_mode(5)
+            exposure, accumulate, kinetic = self.get_acquisition_timings()
+            self.exposure_times = (exposure,)
+            return None
+        unknown = set(value) - set(ACCUMULATE_DEFAULTS)
+        if unknown:
+            raise Exception('Unknown accumulate settings: %s.'
+                            % ', '.join(sorted(unknown)))
+        settings = dict(ACCUMULATE_DEFAULTS)
+        settings.update(value)
+        number = int(settings['number'])
+        kinetics = int(settings['kinetics'] or 0)
+        if number < 1 or kinetics < 0:
+            raise Exception('Bad accumulate settings: %s.' % value)
+        if len(self.exposure_times or ()) > 1:
+            raise Exception('Cannot accumulate ring exposures.')
+        if self.exposure_controller is not None:
+            raise Exception('Cannot use hardware accumulation with auto-exposure.')
+        self.hardware_accumulation = settings
+        if kinetics:
+            # Accumulate within kinetics.
+            self.set_acquisition_mode(3)
+            self.SetNumberKinetics(kinetics)
+            self.SetKineticCycleTime(float(settings['kineticCycleTime']))
+        else:
+            self.set_acquisition_mode(2)
+        self.SetNumberAccumulations(number)
+        self.SetAccumulationCycleTime(float(settings['cycleTime']))
+        self.set_fastest_vs_speed()
+        exposure, accumulate, kinetic = self.get_acquisition_timings()
+        # Each frame stands for number exposures.
+        self.exposure_times = (exposure * number,)
+        self.logger.log('Hardware accumulation: %d x %.4gs every %.4gs%s.'
+                        % (number, exposure, accumulate,
+                           kinetics and ', %d per series every %.4gs'
+                           % (kinetics, kinetic) or ''))
+        return accumulate, kinetic
+
+
+    @with_control_lock
+    @with_camera
+    def read_accumulation(self, array):
+        """Read a completed accumulation into array and start the next.
+
+        Return the number of the frame since arm, or None if the
+        accumulation is not yet complete.
+        """
+        if not self.acquiring:
+            return None
+        status = c_int()
+        self.GetStatus(status)
+        if status.value != sdk.DRV_IDLE:
+            return None
+        self.GetAcquiredData(array, array.size)
+        self.StartAcquisition()
+        return self.count + 1
+
+
+    @with_control_lock
+    @with_camera
+    def restart_series(self):
+        """Start the next kinetic series if the last is complete and read."""
+        if not self.acquiring:
+            return
+        status = c_int()
+        self.GetStatus(status)
+        if status.value != sdk.DRV_IDLE:
+            return
+        first, last = c_long(), c_long()
+        if self.GetNumberNewImages(first, last)[0] == sdk.DRV_SUCCESS:
+            # Images still to read.
+            return
+        self.StartAcquisition()
+
+
+    def update_readout(self):
+        """Set how the data_thread reads frames in the acquisition mode."""
+        if self.data_thread is None:
+            # Nothing to do.
+            return
+        saturation = (1 << self.get_bit_depth()) - 1
+        if self.hardware_accumulation:
+            saturation *= self.hardware_accumulation['number']
+        self.data_thread.set_readout(self.acquisition_mode, saturation)
 
 
     @with_camera
@@ -753,7 +1776,51 @@ class Camera(object):
         self.SetExposureTime(float(exposure_time))
         self.set_fastest_vs_speed()
         exposure, accumulate, kinetic = self.get_acquisition_timings()
+        self.exposure_times = (exposure,)
         return exposure
+
+
+    @with_camera
+    def set_ring_exposure_times(self, times):
+        """Cycle through exposure times in hardware, one per frame.
+
+        Frames are exposed for times[0], times[1], ... in turn from the
+        start of acquisition, with no abort between them. Return the times
+        the camera will use, which it may adjust from those asked for.
+        """
+        times = [float(t) for t in times]
+        if self.exposure_controller is not None and len(times) > 1:
+            raise Exception('Cannot use ring exposures with auto-exposure.')
+        if self.hardware_accumulation and len(times) > 1:
+            raise Exception('Cannot use ring exposures with hardware accumulation.')
+        max_times = c_int()
+        self.GetNumberRingExposureTimes(max_times)
+        if not 0 < len(times) <= max_times.value:
+            raise Exception('Need 1 to %d ring exposure times, not %d.'
+                            % (max_times.value, len(times)))
+        t_min, t_max = c_float(), c_float()
+        self.GetRingExposureRange(t_min, t_max)
+        for t in times:
+            if not t_min.value <= t <= t_max.value:
+                raise Exception('Ring exposure %g s outside range %g to %g s.'
+                                % (t, t_min.value, t_max.value))
+        self.SetRingExposureTimes(len(times), (c_float * len(times))(*times))
+        self.set_fastest_vs_speed()
+        adjusted = (c_float * len(times))()
+        self.GetAdjustedRingExposureTimes(len(times), adjusted)
+        self.exposure_times = tuple(adjusted)
+        self.logger.log('Ring exposures: %s s.'
+                        % ', '.join('%.4g' % t for t in self.exposure_times))
+        return self.exposure_times
+
+
+    def frame_exposure(self, image_index):
+        """Return the exposure time of the SDK image with this index."""
+        times = self.exposure_times
+        if not times:
+            return float(self.settings.get('exposureTime') or 0.)
+        # SDK image indices count from 1 at the start of acquisition.
+        return times[(image_index - 1) % len(times)]
     
 
     @with_camera
@@ -785,16 +1852,49 @@ class DataThread(threading.Thread):
         self.cam = weakref.proxy(cam)
         self.image_array = numpy.zeros((cam.nx, cam.ny), dtype=numpy.uint16)
         self.n_pixels = cam.nx * cam.ny
+        # Acquisition mode, which sets how frames are read.
+        self.acquisition_mode = cam.acquisition_mode
         self.client = client
+        # Subscriber sending frames to the client, or None.
+        self.sender = None
+        # Real-time settings to apply, and those applied: see realtime.
+        self.real_time = None
+        self.applied_real_time = None
+        # Is this thread holding off the garbage collector?
+        self.gc_held = False
+        # Subscribers receiving their own views of frames.
+        self.subscribers = []
         self.run_flag = True
+        # How long to wait for each acquisition event, in ms.
+        self.wait_timeout = 10
         # Transform operation: fliplr, flipud, rot90
         self.transform = (0, 0, 0)
         self.transform_lock = threading.Lock()
+        # Dark/flat correction stage, applied in place to image_array.
+        self.correction = None
+        # PreviewThread to offer frames to.
+        self.preview = None
+        # Processing stages, applied in order to transformed images.
+        # A stage that returns None withholds the frame.
+        self.stages = []
+        # StatisticsSenders for per-frame statistics.
+        self.statistics_clients = []
+        # Pixel value counted as saturated in statistics.
+        self.saturation = None
+        # ExposureController for auto-exposure, or None.
+        self.exposure_controller = None
+        # FrameRing to publish outgoing frames to, or None.
+        self.ring = None
+        # SessionRecorder to record outgoing frames to, or None.
+        self.recorder = None
+        # CameraMetrics to update, or None.
+        self.metrics = None
+        # Tracer to add spans to, or None.
+        self.tracer = None
 
 
     def __del__(self):
-        if self.is_alive:
-            self.should_quit = True
+        self.run_flag = False
 
 
     def get_transformed_image(self):
@@ -812,14 +1912,21 @@ class DataThread(threading.Thread):
     def run(self):
         self.cam.logger.log('    DataThread: entering run loop.')
         while self.run_flag:
+            if self.real_time is not self.applied_real_time:
+                self.apply_real_time()
             try:
-                result = self.cam.GetOldestImage16(self.image_array,
-                                                   self.n_pixels)
+                image_index = self.read_image()
             except:
-                self.cam.logger.log('    DataThread: Exception when tying GetOldestImage16.')
+                self.cam.logger.log('    DataThread: Exception when trying to read image.',
+                                    CameraLogger.ERROR)
                 raise
 
-            if result[0] == sdk.DRV_SUCCESS:
+            new_data = image_index is not None
+            metrics = self.metrics
+            if new_data:
+                # High-resolution receive time for the frame header.
+                received = framecodec.monotonic()
+                exposure = self.cam.frame_exposure(image_index)
                 # increment the camera exposure counter
                 self.cam.count += 1
                 # increment our exposure counter
@@ -830,11 +1937,16 @@ class DataThread(threading.Thread):
                 if self.skip_next_n_images > 0:
                     self.skip_next_n_images -= 1
                     send_data = False
-                    self.cam.logger.log('    DataThread: Skipping image (next N).')
+                    self.cam.logger.count('    DataThread: skipped images (next N)')
 
                 if self.exposure_count % self.skip_every_n_images > 0:
                     send_data = False
-                    self.cam.logger.log('    DataThread: Skipping image (every N).')
+                    self.cam.logger.count('    DataThread: skipped images (every N)')
+
+                if metrics is not None:
+                    metrics.frame_acquired(received)
+                    if not send_data:
+                        metrics.frames_skipped.inc()
             else:
                 send_data = False
 
@@ -842,27 +1954,240 @@ class DataThread(threading.Thread):
                 # Timestamp.  When using external triggering, the camera
                 # offers nothing more accurate than the system time.
                 timestamp = time.time()
-                if self.client is not None:
-                    try:
-                        self.client.receiveData('new image',
-                                                 self.get_transformed_image(),
-                                                 timestamp)
-                    except Pyro4.errors.ConnectionClosedError:
-                        self.cam.logger.log('    DataThread: Data not sent - client not listening.')
-                        # No-one is listening.
-                        self.cam.abort()
-                        self.should_quit = True
-                    # self.cam.logger.log('    DataThread: Data from camera sent to client.')
+                tracer = self.tracer
+                correction = self.correction
+                if correction is not None:
+                    if tracer is not None:
+                        t0 = framecodec.monotonic()
+                    correction.process(self.image_array)
+                    if tracer is not None:
+                        tracer.add('correction', t0, framecodec.monotonic())
+                if self.statistics_clients:
+                    self.send_statistics(timestamp)
+                controller = self.exposure_controller
+                if controller is not None and controller.due(timestamp):
+                    self.auto_expose(controller, timestamp)
+                if tracer is not None:
+                    t0 = framecodec.monotonic()
+                image = self.get_transformed_image()
+                if tracer is not None:
+                    t1 = framecodec.monotonic()
+                    tracer.add('transform', t0, t1)
+                for stage in self.stages:
+                    if getattr(stage, 'needs_exposure', False):
+                        image = stage.process(image, exposure)
+                        # The frame now stands for the stage's exposure.
+                        exposure = stage.reference
+                    else:
+                        image = stage.process(image)
+                    if image is None:
+                        break
+                if tracer is not None and self.stages:
+                    tracer.add('stages', t1, framecodec.monotonic())
+                if image is None:
+                    # A stage is waiting for more frames.
+                    continue
+                preview = self.preview
+                if preview is not None:
+                    preview.offer(image, timestamp)
+                ring = self.ring
+                if ring is not None and not ring.write(image, timestamp,
+                                                       exposure):
+                    self.cam.logger.count('    DataThread: frames not written '
+                                          'to ring - too large for slot')
+                recorder = self.recorder
+                if recorder is not None:
+                    recorder.record_frame(image, timestamp)
+                header_fields = (self.cam.settings_generation, self.cam.count,
+                                 image_index, received, self.cam.clock_anchor,
+                                 exposure)
+                sender = self.sender
+                if sender is not None:
+                    # Queue the frame: the sender thread sends it.
+                    sender.offer(image, timestamp, header_fields,
+                                 self.image_array)
                     self.sent_count += 1
                 else:
-                    self.cam.logger.log('    DataThread: Data not sent - no client to receive data.')
-            else:
-                time.sleep(0.01)
+                    self.cam.logger.count('    DataThread: images not sent - no client to receive data')
+                    if metrics is not None:
+                        metrics.frames_dropped.inc()
+                for subscriber in self.subscribers:
+                    subscriber.offer(image, timestamp, header_fields,
+                                     self.image_array)
+            if not new_data:
+                if self.gc_held:
+                    # Between frames: a good time to collect.
+                    realtime.gc_control.safe_point()
+                self.wait_for_data()
+        if self.gc_held:
+            realtime.gc_control.release()
+            self.gc_held = False
         self.cam.logger.log('    DataThread: exiting run loop.')
 
 
-    def set_client(self, client):
+    def apply_real_time(self):
+        settings = self.real_time
+        for error in realtime.configure_thread(settings, 'readCpus'):
+            self.cam.logger.log('    DataThread: ' + error, CameraLogger.WARNING)
+        hold = settings is not None and settings['holdGC']
+        if hold and not self.gc_held:
+            realtime.gc_control.hold()
+        elif self.gc_held and not hold:
+            realtime.gc_control.release()
+        self.gc_held = hold
+        self.applied_real_time = settings
+
+
+    def read_image(self):
+        """Read the oldest new image into image_array.
+
+        Return the SDK's index of the image, or None if there is none.
+        Accumulated frames are read as 32-bit sums.
+        """
+        mode = self.acquisition_mode
+        if mode == 2:
+            return self.cam.read_accumulation(self.image_array)
+        first, last = c_long(), c_long()
+        result = self.cam.GetNumberNewImages(first, last)
+        if result[0] != sdk.DRV_SUCCESS:
+            if mode == 3:
+                self.cam.restart_series()
+            return None
+        valid_first, valid_last = c_long(), c_long()
+        if mode == 3:
+            self.cam.GetImages(first.value, first.value, self.image_array,
+                               self.n_pixels, valid_first, valid_last)
+        else:
+            self.cam.GetImages16(first.value, first.value, self.image_array,
+                                 self.n_pixels, valid_first, valid_last)
+        return valid_first.value
+
+
+    def auto_expose(self, controller, timestamp):
+        """Apply any exposure and gain change asked for by controller."""
+        settings = self.cam.settings
+        exposure = float(settings.get('exposureTime') or 0.1)
+        gain = int(settings.get('EMGain') or 0)
+        change = controller.update(self.image_array, exposure, gain, timestamp)
+        if change is None:
+            return
+        new_exposure, new_gain = change
+        self.cam.apply_live_settings({'exposureTime': new_exposure,
+                                      'EMGain': new_gain})
+        self.cam.logger.log('    DataThread: auto-exposure from frame %d: '
+                            'exposure %.4gs -> %.4gs, EM gain %d -> %d.'
+                            % (self.exposure_count + 1, exposure,
+                               new_exposure, gain, new_gain))
+
+
+    def wait_for_data(self):
+        """Wait for the camera to acquire another image.
+
+        With several cameras in one process, wait on this camera's handle
+        without the DLL lock, so that other cameras can be read meanwhile.
+        """
+        if self.cam.singleton:
+            time.sleep(0.01)
+            return
+        try:
+            sdk.WaitForAcquisitionByHandleTimeOut(self.cam.handle,
+                                                  self.wait_timeout)
+        except Exception:
+            # Not acquiring: don't spin.
+            time.sleep(0.01)
+
+
+    def send_statistics(self, timestamp):
+        """Compute statistics on image_array for clients they are due to."""
+        due = [sender for sender in self.statistics_clients
+               if self.exposure_count % sender.every == 0]
+        if not due:
+            return
+        record = pipeline.frame_statistics(self.image_array, self.saturation)
+        record['exposureCount'] = self.exposure_count
+        for sender in due:
+            sender.offer(record, timestamp)
+
+
+    def set_client(self, client, headers=False, encoding=None, options=None,
+                   view=None, window=8, oneway=False):
+        if self.sender is not None:
+            self.sender.stop()
         self.client = client
+        if client is None:
+            self.sender = None
+            return
+        sender = Subscriber(client, headers,
+                            framecodec.get_encoder(encoding, options),
+                            view, window, oneway, self.cam.logger)
+        sender.metrics = self.metrics
+        sender.tracer = self.tracer
+        sender.set_real_time(self.real_time)
+        sender.start()
+        self.sender = sender
+
+
+    def set_subscribers(self, subscribers):
+        self.subscribers = list(subscribers)
+
+
+    def set_readout(self, mode, saturation):
+        """Read frames for acquisition mode, with this saturation level."""
+        if mode in (2, 3):
+            # Sums of exposures need the SDK's 32-bit type.
+            dtype = numpy.dtype(sdk.at_32)
+        else:
+            dtype = numpy.dtype(numpy.uint16)
+        if self.image_array.dtype != dtype:
+            self.image_array = numpy.zeros(self.image_array.shape, dtype=dtype)
+        self.acquisition_mode = mode
+        self.saturation = saturation
+
+
+    def set_correction(self, correction):
+        self.correction = correction
+
+
+    def set_exposure_controller(self, controller):
+        self.exposure_controller = controller
+
+
+    def set_preview(self, preview):
+        self.preview = preview
+
+
+    def set_metrics(self, metrics):
+        self.metrics = metrics
+        if self.sender is not None:
+            self.sender.metrics = metrics
+
+
+    def set_real_time(self, settings):
+        self.real_time = settings
+        if self.sender is not None:
+            self.sender.set_real_time(settings)
+
+
+    def set_recorder(self, recorder):
+        self.recorder = recorder
+
+
+    def set_tracer(self, tracer):
+        self.tracer = tracer
+        if self.sender is not None:
+            self.sender.tracer = tracer
+
+
+    def set_ring(self, ring):
+        self.ring = ring
+
+
+    def set_stages(self, stages):
+        self.stages = list(stages)
+
+
+    def set_statistics_clients(self, clients):
+        self.statistics_clients = list(clients)
 
 
     def set_transform(self, transform):
@@ -876,10 +2201,375 @@ class DataThread(threading.Thread):
 
     def stop(self):
         self.run_flag = False
+        if self.sender is not None:
+            # Let the sender finish sending queued frames.
+            self.sender.stop()
         self.cam.logger.log('    DataThread: sent %d of %d exposures.' 
                            % (self.sent_count, self.exposure_count))
 
 
+def package_frame(image, encoder, headers, header_fields):
+    """Return the (tag, data) a client receives for image.
+
+    encoder may be None. header_fields are the pack_header arguments
+    other than flags.
+    """
+    if encoder is not None:
+        image = encoder.encode(image)
+    if headers:
+        header = framecodec.pack_header(*header_fields,
+                                        flags=framecodec.frame_flags(image))
+        return 'new frame', (header, image)
+    return 'new image', image
+
+
+class Subscriber(threading.Thread):
+    """A thread to send a client its own view of frames from a DataThread.
+
+    The DataThread offers frames without waiting. At most window frames
+    are queued, and when the queue is full the oldest is dropped, so a
+    slow or dead client cannot stall acquisition. By default a frame is
+    acknowledged by the return of its receiveData call. If oneway is set,
+    frames are sent as Pyro oneway calls, and no more than window are sent
+    before the client acknowledges them with Camera.acknowledge.
+
+    A frame that fails to send is dropped; the proxy is released, so the
+    next send reconnects, after a backoff that doubles on each failure.
+    Frames unacknowledged for ACK_TIMEOUT are taken to be lost with the
+    connection, which is released likewise.
+    """
+    # Bounds on the wait before resending after a failure, in s.
+    MIN_BACKOFF = 0.1
+    MAX_BACKOFF = 5.
+    # How long to wait for acknowledgements with the window full, in s.
+    ACK_TIMEOUT = 2.
+
+    def __init__(self, client, headers=False, encoder=None, view=None,
+                 window=8, oneway=False, logger=None, uri=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.client = client
+        self.headers = headers
+        self.encoder = encoder
+        self.view = view
+        self.window = max(1, int(window))
+        self.oneway = oneway
+        # Whether receiveData is set oneway on the client's connection.
+        self.bound = False
+        self.logger = logger
+        self.uri = uri
+        # CameraMetrics and Tracer to update, or None.
+        self.metrics = None
+        self.tracer = None
+        # Real-time settings to apply, and those applied: see realtime.
+        self.real_time = None
+        self.applied_real_time = None
+        # Frames to send, as (image, timestamp, header_fields).
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.sent_count = 0
+        self.acknowledged = 0
+        # Time of the last acknowledgement, or of the first send since.
+        self.ack_time = 0.
+        self.dropped_count = 0
+        self.failed_count = 0
+        self.backoff = 0.
+        self.stopped = threading.Event()
+        self.run_flag = True
+
+
+    def offer(self, image, timestamp, header_fields, buffer=None):
+        """Queue this client's view of image to be sent.
+
+        buffer is an array that is about to be reused: the frame is
+        copied if it shares buffer's memory.
+        """
+        frame = image if self.view is None else self.view.apply(image)
+        if buffer is not None and numpy.may_share_memory(frame, buffer):
+            frame = frame.copy()
+        with self.condition:
+            if len(self.queue) >= self.window:
+                self.queue.popleft()
+                self.dropped()
+            self.queue.append((frame, timestamp, header_fields))
+            self.condition.notify()
+
+
+    def acknowledge(self, frames=1):
+        with self.condition:
+            self.acknowledged = min(self.acknowledged + frames,
+                                    self.sent_count)
+            self.ack_time = time.time()
+            self.condition.notify()
+
+
+    def dropped(self):
+        self.dropped_count += 1
+        if self.metrics is not None:
+            self.metrics.frames_dropped.inc()
+
+
+    def get_stats(self):
+        return {'sent': self.sent_count,
+                'queued': len(self.queue),
+                'unacknowledged': self.unacknowledged(),
+                'dropped': self.dropped_count,
+                'failed': self.failed_count}
+
+
+    def unacknowledged(self):
+        if self.oneway:
+            return self.sent_count - self.acknowledged
+        return 0
+
+
+    def ready(self):
+        return self.queue and self.unacknowledged() < self.window
+
+
+    def stalled(self):
+        """Return True if queued frames wait on overdue acknowledgements."""
+        return (self.queue and self.unacknowledged() >= self.window
+                and time.time() - self.ack_time > self.ACK_TIMEOUT)
+
+
+    def run(self):
+        while True:
+            if self.real_time is not self.applied_real_time:
+                self.apply_real_time()
+            with self.condition:
+                while (self.run_flag and not self.ready()
+                       and not self.stalled()
+                       and self.real_time is self.applied_real_time):
+                    if self.queue:
+                        # Waiting for acknowledgements: check for a stall.
+                        self.condition.wait(self.ACK_TIMEOUT / 10)
+                    else:
+                        self.condition.wait()
+                if self.real_time is not self.applied_real_time:
+                    continue
+                if self.stalled():
+                    frame = None
+                elif self.ready():
+                    frame = self.queue.popleft()
+                else:
+                    # Stopped, with nothing that can be sent.
+                    return
+            if frame is None:
+                self.release('    Subscriber: acknowledgements overdue')
+            else:
+                self.send(*frame)
+
+
+    def apply_real_time(self):
+        settings = self.real_time
+        errors = realtime.configure_thread(settings, 'sendCpus')
+        if self.logger is not None:
+            for error in errors:
+                self.logger.log('    Subscriber: ' + error, CameraLogger.WARNING)
+        self.applied_real_time = settings
+
+
+    def set_real_time(self, settings):
+        """Apply real-time settings from this thread, when it next wakes."""
+        with self.condition:
+            self.real_time = settings
+            self.condition.notify()
+
+
+    def release(self, message):
+        """Count message, and close the connection so that the next call
+        reconnects. Frames in flight are lost with the connection."""
+        if self.logger is not None:
+            self.logger.count(message)
+        release = getattr(self.client, '_pyroRelease', None)
+        if release is not None:
+            release()
+        self.bound = False
+        with self.condition:
+            self.acknowledged = self.sent_count
+
+
+    def bind(self):
+        """Connect to the client, and make receiveData oneway.
+
+        Pyro replaces a proxy's oneway methods with the server's when it
+        binds, so this must follow each (re)connection.
+        """
+        self.client._pyroBind()
+        self.client._pyroOneway.add('receiveData')
+        self.bound = True
+
+
+    def send(self, image, timestamp, header_fields):
+        t0 = framecodec.monotonic()
+        action, data = package_frame(image, self.encoder, self.headers,
+                                     header_fields)
+        try:
+            if self.oneway and not self.bound:
+                self.bind()
+            self.client.receiveData(action, data, timestamp)
+        except Pyro4.errors.CommunicationError:
+            self.failed_count += 1
+            self.dropped()
+            self.release('    Subscriber: frames not sent - client not listening')
+            self.backoff = min(max(2 * self.backoff, self.MIN_BACKOFF),
+                               self.MAX_BACKOFF)
+            self.stopped.wait(self.backoff)
+            return
+        except Exception:
+            # The client raised an exception: don't retry this frame.
+            self.dropped()
+            if self.logger is not None:
+                self.logger.count('    Subscriber: frames not sent - client error')
+            return
+        self.backoff = 0.
+        with self.condition:
+            if not self.unacknowledged():
+                self.ack_time = time.time()
+            self.sent_count += 1
+        if self.metrics is not None:
+            self.metrics.send_seconds.observe(framecodec.monotonic() - t0)
+            self.metrics.frames_sent.inc()
+        if self.tracer is not None:
+            # Includes serialization.
+            self.tracer.add('send', t0, framecodec.monotonic())
+
+
+    def stop(self):
+        """Stop, once queued frames that can be sent have been sent."""
+        with self.condition:
+            self.run_flag = False
+            self.condition.notify()
+        self.stopped.set()
+
+
+class StatisticsSender(threading.Thread):
+    """A thread to send per-frame statistics records to a client.
+
+    Records are computed for every 'every'th frame. Only the latest record
+    offered is kept, so a slow client misses records rather than holding
+    up the DataThread.
+    """
+    def __init__(self, client, every=1, logger=None, uri=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.client = client
+        self.every = max(1, int(every))
+        self.logger = logger
+        self.uri = uri
+        # Latest record offered, and a flag to indicate that it is new.
+        self.record = None
+        self.timestamp = None
+        self.record_lock = threading.Lock()
+        self.new_record = threading.Event()
+        self.sent_count = 0
+        self.missed_count = 0
+        self.run_flag = True
+
+
+    def offer(self, record, timestamp):
+        with self.record_lock:
+            if self.record is not None:
+                self.missed_count += 1
+            self.record = record
+            self.timestamp = timestamp
+        self.new_record.set()
+
+
+    def run(self):
+        while self.run_flag:
+            if not self.new_record.wait(0.5):
+                continue
+            self.new_record.clear()
+            with self.record_lock:
+                record, timestamp = self.record, self.timestamp
+                self.record = None
+            if record is None:
+                continue
+            try:
+                self.client.receiveData('new statistics', record, timestamp)
+            except Pyro4.errors.CommunicationError:
+                if self.logger is not None:
+                    self.logger.count('    StatisticsSender: statistics not sent')
+                # Reconnect on the next send.
+                self.client._pyroRelease()
+            else:
+                self.sent_count += 1
+
+
+    def stop(self):
+        self.run_flag = False
+        self.new_record.set()
+
+
+class PreviewThread(threading.Thread):
+    """A thread to send low-resolution previews to a client.
+
+    The DataThread offers every frame it sends; frames arriving faster
+    than max_rate are dropped with a single time comparison, and the
+    downsampling and send happen on this thread, so the preview client
+    cannot slow acquisition.
+    """
+    def __init__(self, cam, client, binning=4, method='mean', scale=True,
+                 max_rate=10.):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cam = weakref.proxy(cam)
+        self.client = client
+        self.binning = int(binning)
+        self.method = method
+        self.scale = scale
+        self.interval = 1. / max_rate if max_rate else 0.
+        self.next_time = 0.
+        # Latest frame offered, and a flag to indicate that it is new.
+        self.frame = None
+        self.timestamp = None
+        self.frame_lock = threading.Lock()
+        self.new_frame = threading.Event()
+        self.sent_count = 0
+        self.run_flag = True
+
+
+    def offer(self, image, timestamp):
+        """Take a copy of image if a preview is due."""
+        now = time.time()
+        if now < self.next_time:
+            return
+        self.next_time = now + self.interval
+        with self.frame_lock:
+            self.frame = image.copy()
+            self.timestamp = timestamp
+        self.new_frame.set()
+
+
+    def run(self):
+        while self.run_flag:
+            if not self.new_frame.wait(0.5):
+                continue
+            self.new_frame.clear()
+            with self.frame_lock:
+                frame, timestamp = self.frame, self.timestamp
+                self.frame = None
+            if frame is None:
+                continue
+            preview = pipeline.make_preview(frame, self.binning, self.method,
+                                            self.scale)
+            try:
+                self.client.receiveData('new preview', preview, timestamp)
+            except Pyro4.errors.CommunicationError:
+                self.cam.logger.count('    PreviewThread: previews not sent')
+            else:
+                self.sent_count += 1
+
+
+    def stop(self):
+        self.run_flag = False
+        self.new_frame.set()
+        self.cam.logger.log('    PreviewThread: sent %d previews.'
+                            % self.sent_count)
+
+
 class CameraManager(object):
     """A class to manage Camera instances in a single process.
 
@@ -900,8 +2590,7 @@ class CameraManager(object):
         Camera instances are tracked in the class variables
         Camera.cameralist and Camera.handle_to_camera.
         """
-        for cam in self.cameras:
-            self.cameras.remove(cam)
+        self.cameras = []
 
         num_cameras = c_long()
         sdk.GetAvailableCameras(num_cameras)
@@ -913,9 +2602,18 @@ class CameraManager(object):
             self.handle_to_camera.update({handle.value: i})
 
 
+    def serve_metrics(self, port, host='127.0.0.1'):
+        """Serve metrics for all cameras over HTTP, and return the server."""
+        for cam in self.cameras:
+            cam.enable_metrics()
+        server = metrics.MetricsServer(host, port)
+        server.start()
+        return server
+
+
 class SingleCameraServer(Process):
     """A process to serve a single Camera object over Pyro."""
-    def __init__(self, index, serial_to_host, serial_to_port):
+    def __init__(self, index, serial_to_host, serial_to_port, ring=None):
         super(SingleCameraServer, self).__init__()
         # Camera index.
         self.index = index
@@ -929,6 +2627,10 @@ class SingleCameraServer(Process):
         self.cam = None
         # A thread to run the Pyro daemon.
         self.pyro_thread = None
+        # FrameRing to publish frames to an Aggregator, or None.
+        self.ring = ring
+        # HTTP server for this camera's metrics, or None.
+        self.metrics_server = None
 
 
     def run(self):
@@ -966,6 +2668,11 @@ class SingleCameraServer(Process):
         serial = self.cam.get_camera_serial_number()
         self.cam.logger.open(serial)
 
+        if self.ring is not None:
+            # Let the aggregator know whose frames are in the ring.
+            self.ring.serial.value = serial
+            self.cam.ring = self.ring
+
         if not self.serial_to_host.has_key(serial):
             raise Exception("No host found for camera with serial number %s."
                                 % serial)
@@ -977,6 +2684,12 @@ class SingleCameraServer(Process):
         host = self.serial_to_host[serial]
         port = self.serial_to_port[serial]
 
+        if metrics_port_offset is not None:
+            self.cam.enable_metrics()
+            self.metrics_server = metrics.MetricsServer(
+                host, port + metrics_port_offset)
+            self.metrics_server.start()
+
         daemon = Pyro4.Daemon(port=port, host=host)
 
         self.pyro_thread = threading.Thread(
@@ -1003,11 +2716,14 @@ class SingleCameraServer(Process):
 
 
 class Server(object):
-    def __init__(self):
+    def __init__(self, aggregator_port=aggregator_port):
         self.serial_to_host = {}
         self.serial_to_port = {}
         self.cam_processes = []
         self.run_flag = True
+        # Port to serve all cameras from one Aggregator, or None.
+        self.aggregator_port = aggregator_port
+        self.aggregator = None
 
 
     def run(self):
@@ -1017,10 +2733,19 @@ class Server(object):
 
         self.cam_preocesses = []
 
+        rings = None
+        if self.aggregator_port is not None:
+            # Rings must exist before the processes that share them.
+            rings = [FrameRing() for i in range(len(self.serial_to_host))]
+            host = self.serial_to_host.values()[0]
+            self.aggregator = Aggregator(rings, host, self.aggregator_port)
+            self.aggregator.start()
+
         for i in range(len(self.serial_to_host)):
             self.cam_processes.append(SingleCameraServer(i, 
                                                        self.serial_to_host, 
-                                                       self.serial_to_port))
+                                                       self.serial_to_port,
+                                                       rings and rings[i]))
             self.cam_processes[i].start()
 
         while self.run_flag:
@@ -1032,6 +2757,9 @@ class Server(object):
             proc.stop()
             proc.join()
             del(proc)
+        if self.aggregator is not None:
+            self.aggregator.stop()
+            self.aggregator.join()
         self.run_flag = 0
  
 
@@ -0,0 +1,717 @@
+"""Benchmarks for the camera server data path.
+
+These run without the Andor SDK or camera hardware.
+
+Usage:
+    python benchmark.py [name ...] [--json FILE]
+Run with no arguments to list the available benchmarks, or 'all' to
+run every one. With --json, results are also written to FILE.
+"""
+
+import argparse
+import cPickle
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from multiprocessing import Pipe, Process, Value, cpu_count
+from timeit import default_timer as timer
+
+import numpy
+import psutil
+import Pyro4
+import framecodec
+import pipeline
+from cameralog import CameraLogger
+
+# Full-frame rates of iXon Ultra sensors, in frames per second.
+IXON_ULTRA_RATES = [((512, 512), 56.), ((1024, 1024), 26.)]
+
+# End-to-end cases: (label, (nx, ny), exposure, pathTransform, singleton).
+# Arm always reads the full detector, so ROIs run as smaller detectors.
+END_TO_END_CASES = [
+    ('512 full frame',     (512, 512),   0.018, (0, 0, 0), True),
+    ('1024 full frame',    (1024, 1024), 0.038, (0, 0, 0), True),
+    ('512 fast',           (512, 512),   0.005, (0, 0, 0), True),
+    ('512 transformed',    (512, 512),   0.018, (1, 1, 1), True),
+    ('256 ROI',            (256, 256),   0.002, (0, 0, 0), True),
+    ('128 ROI',            (128, 128),   0.001, (0, 0, 0), True),
+    ('512 DLL lock',       (512, 512),   0.005, (0, 0, 0), False),
+    ]
+
+
+def import_andor():
+    """Import andor against the simulated SDK, and return both modules."""
+    import simsdk
+    simsdk.install()
+    import andor
+    return andor, simsdk
+
+
+class CountingClient(object):
+    """A stand-in for a Pyro client that counts the frames it receives."""
+    def __init__(self):
+        self.count = 0
+
+    def receiveData(self, action, data, timestamp):
+        self.count += 1
+
+
+class BytesClient(CountingClient):
+    """A client that counts the frames and bytes it receives."""
+    def __init__(self):
+        CountingClient.__init__(self)
+        self.bytes = 0
+
+    def receiveData(self, action, data, timestamp):
+        self.count += 1
+        self.bytes += data.nbytes
+
+
+class SlowClient(CountingClient):
+    """A client that takes delay s to handle each frame."""
+    def __init__(self, delay):
+        CountingClient.__init__(self)
+        self.delay = delay
+
+    def receiveData(self, action, data, timestamp):
+        time.sleep(self.delay)
+        self.count += 1
+
+
+class AcknowledgingClient(SlowClient):
+    """A Pyro client that takes delay s per frame, then acknowledges it."""
+    def __init__(self, delay, cam):
+        SlowClient.__init__(self, delay)
+        self.cam = cam
+
+    def receiveData(self, action, data, timestamp):
+        SlowClient.receiveData(self, action, data, timestamp)
+        self.cam.acknowledge()
+
+if hasattr(Pyro4, 'expose'):
+    AcknowledgingClient = Pyro4.expose(AcknowledgingClient)
+
+
+class ReadLatencyClient(object):
+    """A client that records how long after its exposure each frame was read.
+
+    Needs frame headers, and the simulated camera's timing.
+    """
+    def __init__(self, sim):
+        self.sim = sim
+        self.latencies = []
+
+    def receiveData(self, action, data, timestamp):
+        header = framecodec.unpack_header(data[0])
+        available = (self.sim.start_time
+                     + self.sim.frame_end(header.image_index))
+        self.latencies.append(header.wall_time - available)
+
+
+def burn(run_flag):
+    """Spin until run_flag is cleared: synthetic CPU load."""
+    while run_flag.value:
+        pass
+
+
+def churn(run_flag, live=200000):
+    """Allocate reference cycles against a large live heap until run_flag
+    is cleared, so that the garbage collector has work to do."""
+    heap = [{'n': [i]} for i in range(live)]
+    while run_flag.value:
+        for i in range(1000):
+            cycle = []
+            cycle.append(cycle)
+        time.sleep(0.001)
+    del heap
+
+
+class LatencyClient(object):
+    """A Pyro client that records the latency of each frame it receives."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.latencies = []
+        self.start = time.time()
+
+    def receiveData(self, action, data, timestamp):
+        self.latencies.append(time.time() - timestamp)
+
+    def get_results(self):
+        """Return frames received, seconds since reset and latencies."""
+        latencies = numpy.array(self.latencies)
+        results = {'frames': len(latencies),
+                   'seconds': time.time() - self.start,
+                   'client_rss_mb': psutil.Process().memory_info().rss / 1e6}
+        if len(latencies):
+            for p in (50, 90, 99):
+                results['latency_p%d_ms' % p] = 1e3 * numpy.percentile(latencies, p)
+            results['latency_max_ms'] = 1e3 * latencies.max()
+        return results
+
+if hasattr(Pyro4, 'expose'):
+    LatencyClient = Pyro4.expose(LatencyClient)
+
+
+def serve_client(conn):
+    """Serve a LatencyClient from a separate process, as a cockpit would."""
+    daemon = Pyro4.Daemon(host='127.0.0.1')
+    conn.send(str(daemon.register(LatencyClient())))
+    thread = threading.Thread(target=daemon.requestLoop)
+    thread.daemon = True
+    thread.start()
+    # Run until told to stop.
+    conn.recv()
+    daemon.shutdown()
+
+
+def make_frames(shape, n=4, mean=500, seed=0):
+    """Return n synthetic uint16 frames of EMCCD-like background."""
+    rng = numpy.random.RandomState(seed)
+    frames = rng.poisson(mean, (n,) + tuple(shape))
+    return frames.astype(numpy.uint16)
+
+
+def time_per_call(func, args_list, repeats):
+    """Return mean seconds per call of func, cycling through args_list."""
+    n = len(args_list)
+    # Warm up caches and any lazily-allocated buffers.
+    func(*args_list[0])
+    t0 = timer()
+    for i in range(repeats):
+        func(*args_list[i % n])
+    return (timer() - t0) / repeats
+
+
+def report(label, seconds, required_fps=None, per='frame'):
+    if seconds < 1e-4:
+        line = '  %-26s %8.3f us/%-5s' % (label, 1e6 * seconds, per)
+    else:
+        line = '  %-26s %8.3f ms/%-5s' % (label, 1e3 * seconds, per)
+    line += ' %9.0f %s' % (1. / seconds, 'fps' if per == 'frame' else per + '/s')
+    if required_fps is not None:
+        ok = 'ok' if 1. / seconds >= required_fps else 'TOO SLOW'
+        line += '   (need %3.0f fps: %s)' % (required_fps, ok)
+    print line
+
+
+def bench_correction(repeats=200):
+    """Dark subtraction and flat-field correction."""
+    for shape, fps in IXON_ULTRA_RATES:
+        frames = make_frames(shape)
+        dark = make_frames(shape, 1, mean=100, seed=1)[0]
+        flat = make_frames(shape, 1, mean=10000, seed=2)[0]
+        stage = pipeline.DarkFlatCorrection(shape, dark, flat)
+        t = time_per_call(stage.process, [(f,) for f in frames], repeats)
+        report('%dx%d dark+flat' % shape, t, fps)
+
+
+def bench_accumulation(repeats=200):
+    """Rolling and block accumulation: per-frame cost against window size."""
+    shape, fps = IXON_ULTRA_RATES[0]
+    frames = make_frames(shape)
+    for mode in ('block', 'rolling'):
+        for n in (4, 16, 64):
+            stage = pipeline.FrameAccumulator(n, mode)
+            t = time_per_call(stage.process, [(f,) for f in frames], repeats)
+            report('%dx%d %s n=%d' % (shape + (mode, n)), t, fps)
+
+
+def bench_statistics(repeats=200):
+    """Per-frame statistics record."""
+    for shape, fps in IXON_ULTRA_RATES:
+        frames = make_frames(shape)
+        t = time_per_call(pipeline.frame_statistics,
+                          [(f, 16383) for f in frames], repeats)
+        report('%dx%d statistics' % shape, t, fps)
+
+
+def bench_photon_counting(repeats=200):
+    """Count conversion and photon counting, per frame and in batches."""
+    for shape, fps in IXON_ULTRA_RATES:
+        frames = make_frames(shape)
+        convert = pipeline.CountConverter(100, 300, 4.5, 0.9, 'photons')
+        t = time_per_call(convert.process, [(f,) for f in frames], repeats)
+        report('%dx%d photons' % shape, t, fps)
+        counter = pipeline.PhotonCounter([550, 700, 900])
+        t = time_per_call(counter.process, [(f,) for f in frames], repeats)
+        report('%dx%d 3-level counting' % shape, t, fps)
+        stack = make_frames(shape, 16)
+        counter = pipeline.PhotonCounter([550], 4)
+        t = time_per_call(counter.count_stack, [(stack,)], repeats // 16)
+        report('%dx%d batch of 16' % shape, t / 16, fps)
+
+
+def bench_hdr(repeats=60, exposures=(0.001, 0.01, 0.1)):
+    """HDR fusion of ring-exposure groups: time and accuracy."""
+    rng = numpy.random.RandomState(0)
+    results = []
+    for shape, fps in IXON_ULTRA_RATES:
+        # Count rates over five decades, so the longest exposure saturates.
+        rate = numpy.logspace(1, 6, shape[0] * shape[1]).reshape(shape)
+        frames = [numpy.minimum(100 + rng.poisson(rate * t), 65535)
+                  .astype(numpy.uint16) for t in exposures]
+        fusion = pipeline.HDRFusion(len(exposures), 65535, 100)
+        args = [(frame, t) for frame, t in zip(frames, exposures)]
+        t = time_per_call(fusion.process, args, repeats * len(args))
+        report('%dx%d fuse %d' % (shape + (len(exposures),)), t, fps)
+        for frame, t_exp in args:
+            fused = fusion.process(frame, t_exp)
+        longest = (frames[-1] - 100.) / exposures[-1]
+        result = {'shape': shape, 'ms_per_frame': 1e3 * t,
+                  'bytes_ratio': fused.nbytes / float(sum(f.nbytes for f in frames)),
+                  'hdr_error': numpy.median(numpy.abs(fused / fusion.reference - rate) / rate),
+                  'longest_error': numpy.median(numpy.abs(longest - rate) / rate)}
+        results.append(result)
+        print ('  %dx%d sent %.0f%% of group bytes; median rate error %.3f '
+               '(longest exposure alone %.3f)'
+               % (shape + (100 * result['bytes_ratio'], result['hdr_error'],
+                           result['longest_error'])))
+    return results
+
+
+def bench_hardware_accumulation(duration=3., n=10, exposure=0.002,
+                                copy_time=0.001):
+    """Summing n exposures on the camera against summing them on the host."""
+    andor, simsdk = import_andor()
+    mode = andor.AMPLIFIER_MODES[simsdk.AC_CAMERATYPE_IXONULTRA][0]
+    process = psutil.Process()
+    results = []
+    # Accumulate mode restarts acquisition after each sum; kinetic series
+    # of 50 sums restart less often.
+    for label in ('host', 'camera', 'kinetics'):
+        simsdk.configure([9146], exposure=exposure, copy_time=copy_time)
+        manager = andor.CameraManager()
+        manager.update_cameras()
+        cam = manager.cameras[0]
+        cam.client = BytesClient()
+        settings = {'amplifierMode': mode, 'exposureTime': exposure}
+        if label == 'host':
+            cam.set_accumulation(n)
+        elif label == 'camera':
+            settings['accumulate'] = {'number': n}
+        else:
+            settings['accumulate'] = {'number': n, 'kinetics': 50}
+        cam.enable(settings)
+        cpu = sum(process.cpu_times()[:2])
+        time.sleep(duration)
+        cpu = sum(process.cpu_times()[:2]) - cpu
+        read = cam.count
+        cam.disable()
+        pixels = cam.nx * cam.ny
+        # Sums are read as the SDK's 32-bit type.
+        item = label == 'host' and 2 or numpy.dtype(simsdk.at_32).itemsize
+        result = {'case': label, 'frames_read': read,
+                  'bytes_read': read * pixels * item,
+                  'frames_sent': cam.client.count,
+                  'bytes_sent': cam.client.bytes,
+                  'cpu_fraction': cpu / duration,
+                  'lost': simsdk.cameras[0].lost}
+        results.append(result)
+        print ('  %-8s read %4d frames (%6.1f MB), sent %3d sums, '
+               'CPU %3.0f%%, %d frames lost'
+               % (label, read, result['bytes_read'] / 1e6, result['frames_sent'],
+                  100 * result['cpu_fraction'], result['lost']))
+    return results
+
+
+def bench_planner(duration=1., repeats=2000):
+    """Frame-rate plans: call cost, and predicted against simulated rates."""
+    andor, simsdk = import_andor()
+    mode = andor.AMPLIFIER_MODES[simsdk.AC_CAMERATYPE_IXONULTRA][0]
+    simsdk.configure([9146], nx=128, ny=128, readout_time=0.01)
+    manager = andor.CameraManager()
+    manager.update_cameras()
+    cam = manager.cameras[0]
+    cam.client = CountingClient()
+    cam.enable({'amplifierMode': mode, 'exposureTime': 0.01})
+    t0 = timer()
+    cam.measure_timings()
+    report('measure timings', timer() - t0, per='model')
+    targets = [(50, 0.01), (200, 0.002), (400, 0.002), (800, 0.001)]
+    t = time_per_call(cam.plan_frame_rate, targets, repeats)
+    report('plan', t, per='call')
+    results = []
+    for fps, exposure in targets:
+        plan = cam.plan_frame_rate(fps, exposure, apply=True)
+        cam.client.count = 0
+        time.sleep(duration)
+        measured = cam.client.count / duration
+        result = {'target_fps': fps, 'exposure': exposure,
+                  'amplifierMode': plan['settings']['amplifierMode']['label'],
+                  'frameTransfer': plan['settings']['frameTransfer'],
+                  'predicted_fps': plan['fps'], 'measured_fps': measured,
+                  'meets_target': plan['meetsTarget']}
+        results.append(result)
+        print ('  %4d fps at %5.3fs: %-10s FT %d  predicted %6.1f fps, '
+               'measured %6.1f fps%s'
+               % (fps, exposure, result['amplifierMode'],
+                  result['frameTransfer'], plan['fps'], measured,
+                  '' if plan['meetsTarget'] else '  (target not reachable)'))
+    cam.disable()
+    return results
+
+
+def bench_logging(repeats=20000):
+    """Hot-path logging cost per call, against a synchronous write."""
+    path = tempfile.mkdtemp()
+    try:
+        fh = open(os.path.join(path, 'sync.txt'), 'w')
+        def log_sync(message):
+            fh.write(time.strftime('%Y-%m-%d %H:%M:%S:  '))
+            fh.write(message + '\n')
+            fh.flush()
+        t = time_per_call(log_sync, [('Skipping image (every N).',)], repeats)
+        report('synchronous write+flush', t, per='call')
+        fh.close()
+
+        logger = CameraLogger()
+        logger.open('buffered', path)
+        t = time_per_call(logger.log, [('Skipping image (every N).',)],
+                          repeats)
+        report('queued log', t, per='call')
+        t = time_per_call(logger.count, [('skipped images (every N)',)],
+                          repeats)
+        report('counted event', t, per='call')
+        t = time_per_call(logger.log, [('Debug message.', logger.DEBUG)],
+                          repeats)
+        report('log below level', t, per='call')
+        logger.close()
+        print '  logger stats: %s' % logger.get_stats()
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_multicamera(duration=3., exposure=0.002, copy_time=0.0005):
+    """Aggregate throughput of one and two cameras in one CameraManager."""
+    andor, simsdk = import_andor()
+    mode = andor.AMPLIFIER_MODES[simsdk.AC_CAMERATYPE_IXONULTRA][0]
+    single_rate = None
+    for serials in ([9146], [9146, 9145]):
+        simsdk.configure(serials, exposure=exposure, copy_time=copy_time)
+        manager = andor.CameraManager()
+        manager.update_cameras()
+        clients = []
+        for cam in manager.cameras:
+            cam.client = CountingClient()
+            clients.append(cam.client)
+            cam.enable({'amplifierMode': mode, 'exposureTime': exposure})
+        time.sleep(duration)
+        received = sum(client.count for client in clients)
+        lost = sum(cam.lost for cam in simsdk.cameras)
+        for cam in manager.cameras:
+            cam.disable()
+        rate = received / duration
+        single_rate = single_rate or rate
+        print ('  %d camera(s): %6.0f fps aggregate (%.2fx one camera), '
+               '%d frames lost' % (len(serials), rate, rate / single_rate, lost))
+
+
+def bench_serialization(repeats=100):
+    """Frame pickling against the raw frame encoding, as sent by Pyro."""
+    results = []
+    transforms = [('plain', lambda m: m), ('flipud', numpy.flipud),
+                  ('rot90', numpy.rot90)]
+    for shape, fps in IXON_ULTRA_RATES:
+        frame = make_frames(shape, 1)[0]
+        for name, transform in transforms:
+            image = transform(frame)
+            encoder = framecodec.FrameEncoder()
+            for encoding, encode in (('pickle', lambda: image),
+                                     ('raw', lambda: encoder.encode(image))):
+                dumps = lambda: cPickle.dumps(encode(), 2)
+                data = dumps()
+                t_dumps = time_per_call(dumps, [()], repeats)
+                t_loads = time_per_call(cPickle.loads, [(data,)], repeats)
+                result = {'shape': shape, 'transform': name,
+                          'encoding': encoding, 'bytes': len(data),
+                          'dumps_ms': 1e3 * t_dumps,
+                          'loads_ms': 1e3 * t_loads}
+                results.append(result)
+                print ('  %dx%d %-6s %-6s %8d bytes  dumps %6.3f ms  '
+                       'loads %6.3f ms'
+                       % (shape + (name, encoding, len(data),
+                                   1e3 * t_dumps, 1e3 * t_loads)))
+    return results
+
+
+def bench_compression(repeats=10):
+    """Lossless zlib frame encoding: ratio and added latency per frame."""
+    results = []
+    shape, fps = IXON_ULTRA_RATES[0]
+    # Dim background, and a smooth bright image with the same noise.
+    y, x = numpy.mgrid[:shape[0], :shape[1]]
+    smooth = (2000 * numpy.exp(-((x - 256.) ** 2 + (y - 256.) ** 2) / 2e4))
+    images = [('background', make_frames(shape, 1, mean=100)[0]),
+              ('smooth', (make_frames(shape, 1, mean=100)[0]
+                          + smooth.astype(numpy.uint16)))]
+    for name, image in images:
+        for delta in (False, True):
+            for level in (1, 6):
+                for threads in sorted(set([1, min(4, cpu_count())])):
+                    encoder = framecodec.CompressingEncoder(level, threads,
+                                                            delta=delta)
+                    t_encode = time_per_call(encoder.encode, [(image,)], repeats)
+                    data = cPickle.dumps(encoder.encode(image), 2)
+                    t_decode = time_per_call(cPickle.loads, [(data,)], repeats)
+                    result = {'image': name, 'shape': shape, 'delta': delta,
+                              'level': level, 'threads': threads,
+                              'ratio': float(image.nbytes) / len(data),
+                              'encode_ms': 1e3 * t_encode,
+                              'decode_ms': 1e3 * t_decode}
+                    results.append(result)
+                    print ('  %-10s delta %-5s level %d  %d thread(s)  ratio %4.2f'
+                           '  encode %6.2f ms  decode %6.2f ms  (need %3.0f fps: %s)'
+                           % (name, delta, level, threads, result['ratio'],
+                              result['encode_ms'], result['decode_ms'], fps,
+                              'ok' if t_encode * fps < 1 else 'TOO SLOW'))
+    return results
+
+
+def bench_packing(repeats=50):
+    """Bit-depth packing: size and time per frame for 8, 12 and 16 bits."""
+    results = []
+    for shape, fps in IXON_ULTRA_RATES:
+        # Backgrounds whose maxima need 8, 12 and 16 bits.
+        for mean in (100, 500, 5000):
+            image = make_frames(shape, 1, mean=mean)[0]
+            encoder = framecodec.PackingEncoder()
+            t_encode = time_per_call(encoder.encode, [(image,)], repeats)
+            frame = encoder.encode(image)
+            data = cPickle.dumps(frame, 2)
+            t_decode = time_per_call(cPickle.loads, [(data,)], repeats)
+            result = {'shape': shape, 'mean': mean, 'bits': frame.bits,
+                      'size': float(len(data)) / image.nbytes,
+                      'encode_ms': 1e3 * t_encode,
+                      'decode_ms': 1e3 * t_decode}
+            results.append(result)
+            print ('  %dx%d mean %4d  %2d bits  %3.0f%% of raw  encode %5.2f ms'
+                   '  decode %5.2f ms'
+                   % (shape + (mean, frame.bits, 100 * result['size'],
+                               result['encode_ms'], result['decode_ms'])))
+    return results
+
+
+def bench_end_to_end(duration=3., warmup=0.5):
+    """Camera, DataThread and Pyro to a client process, per case."""
+    andor, simsdk = import_andor()
+    mode = andor.AMPLIFIER_MODES[simsdk.AC_CAMERATYPE_IXONULTRA][0]
+    conn, child_conn = Pipe()
+    client_process = Process(target=serve_client, args=(child_conn,))
+    client_process.start()
+    uri = conn.recv()
+    client = Pyro4.Proxy(uri)
+    server = psutil.Process()
+    results = []
+    try:
+        for label, shape, exposure, transform, singleton in END_TO_END_CASES:
+            simsdk.configure([9146], nx=shape[0], ny=shape[1],
+                             exposure=exposure)
+            sim = simsdk.cameras[0]
+            simsdk.SetCurrentCamera(sim.handle)
+            cam = andor.Camera(sim.handle, singleton=singleton)
+            cam.receiveClient(uri)
+            cam.enable({'amplifierMode': mode, 'exposureTime': exposure,
+                        'pathTransform': transform})
+            time.sleep(warmup)
+            client.reset()
+            lost = sim.lost
+            cpu = sum(server.cpu_times()[:2])
+            time.sleep(duration)
+            cpu = sum(server.cpu_times()[:2]) - cpu
+            result = client.get_results()
+            result['lost'] = sim.lost - lost
+            cam.disable()
+            result.update({'case': label, 'shape': shape,
+                           'exposure': exposure, 'transform': transform,
+                           'singleton': singleton,
+                           'target_fps': 1. / sim.period(),
+                           'fps': result['frames'] / result['seconds'],
+                           'server_rss_mb': server.memory_info().rss / 1e6})
+            if result['frames']:
+                result['server_cpu_ms_per_frame'] = 1e3 * cpu / result['frames']
+            results.append(result)
+            print ('  %-16s %6.0f/%4.0f fps  latency p50 %6.2f p99 %6.2f ms'
+                   '  cpu %5.2f ms/frame  rss %4.0f MB  lost %d'
+                   % (label, result['fps'], result['target_fps'],
+                      result.get('latency_p50_ms', 0),
+                      result.get('latency_p99_ms', 0),
+                      result.get('server_cpu_ms_per_frame', 0),
+                      result['server_rss_mb'], result['lost']))
+    finally:
+        conn.send('stop')
+        client_process.join()
+    return results
+
+
+def bench_slow_client(exposure=0.01, duration=3.):
+    """Acquisition rate with a client slower than the camera."""
+    andor, simsdk = import_andor()
+    mode = andor.AMPLIFIER_MODES[simsdk.AC_CAMERATYPE_IXONULTRA][0]
+    results = []
+    for delay in (0., 0.02, 0.05, 0.2):
+        simsdk.configure([9146], exposure=exposure)
+        sim = simsdk.cameras[0]
+        manager = andor.CameraManager()
+        manager.update_cameras()
+        cam = manager.cameras[0]
+        cam.client = SlowClient(delay)
+        cam.enable({'amplifierMode': mode, 'exposureTime': exposure})
+        time.sleep(duration)
+        stats = cam.data_thread.sender.get_stats()
+        result = {'delay_ms': 1e3 * delay,
+                  'read_fps': cam.count / duration,
+                  'delivered_fps': cam.client.count / duration,
+                  'dropped': stats['dropped'], 'lost': sim.lost}
+        cam.disable()
+        results.append(result)
+        print ('  client %3.0f ms/frame  read %5.1f fps  delivered %5.1f fps'
+               '  dropped %4d  lost %d'
+               % (result['delay_ms'], result['read_fps'],
+                  result['delivered_fps'], result['dropped'], result['lost']))
+    # Over Pyro, a oneway client should have frames in flight while it
+    # works: more than one means the calls did not wait for it.
+    daemon = Pyro4.Daemon(host='127.0.0.1')
+    thread = threading.Thread(target=daemon.requestLoop)
+    thread.daemon = True
+    thread.start()
+    delay = 0.02
+    try:
+        for oneway in (False, True):
+            simsdk.configure([9146], exposure=exposure)
+            manager = andor.CameraManager()
+            manager.update_cameras()
+            cam = manager.cameras[0]
+            client = AcknowledgingClient(delay, cam)
+            uri = daemon.register(client)
+            cam.receiveClient(str(uri), oneway=oneway)
+            cam.enable({'amplifierMode': mode, 'exposureTime': exposure})
+            sender = cam.data_thread.sender
+            in_flight = 0
+            end = time.time() + duration
+            while time.time() < end:
+                in_flight = max(in_flight, sender.sent_count - client.count)
+                time.sleep(0.002)
+            stats = sender.get_stats()
+            result = {'delay_ms': 1e3 * delay, 'oneway': oneway,
+                      'delivered_fps': client.count / duration,
+                      'max_in_flight': in_flight,
+                      'dropped': stats['dropped'],
+                      'failed': stats['failed']}
+            cam.disable()
+            cam.receiveClient(None)
+            daemon.unregister(client)
+            results.append(result)
+            print ('  Pyro client %3.0f ms/frame %-7s  delivered %5.1f fps'
+                   '  max in flight %d  dropped %4d  failed %d'
+                   % (result['delay_ms'], 'oneway' if oneway else 'call',
+                      result['delivered_fps'], result['max_in_flight'],
+                      result['dropped'], result['failed']))
+    finally:
+        daemon.shutdown()
+    return results
+
+
+def bench_real_time(exposure=0.002, shape=(256, 256), duration=3.):
+    """Read latency and overruns under CPU and allocation load."""
+    andor, simsdk = import_andor()
+    mode = andor.AMPLIFIER_MODES[simsdk.AC_CAMERATYPE_IXONULTRA][0]
+    results = []
+    for label, load, real_time in (('idle', False, False),
+                                   ('loaded', True, False),
+                                   ('loaded, realTime', True, True)):
+        simsdk.configure([9146], nx=shape[0], ny=shape[1], exposure=exposure,
+                         buffer_size=16)
+        sim = simsdk.cameras[0]
+        manager = andor.CameraManager()
+        manager.update_cameras()
+        cam = manager.cameras[0]
+        cam.client = ReadLatencyClient(sim)
+        cam.client_headers = True
+        run_flag = Value('b', True)
+        workers = []
+        if load:
+            workers = [Process(target=burn, args=(run_flag,))
+                       for i in range(cpu_count() + 1)]
+            workers.append(threading.Thread(target=churn, args=(run_flag,)))
+            for worker in workers:
+                worker.start()
+        try:
+            cam.enable({'amplifierMode': mode, 'exposureTime': exposure,
+                        'realTime': real_time})
+            time.sleep(duration)
+            lost = sim.lost
+            read = cam.count
+            cam.disable()
+            cam.update_settings({'realTime': False})
+        finally:
+            run_flag.value = False
+            for worker in workers:
+                worker.join()
+        latencies = 1e3 * numpy.array(cam.client.latencies)
+        result = {'case': label, 'frames': read, 'lost': lost,
+                  'target_frames': int(duration / sim.period())}
+        for p in (50, 99):
+            result['latency_p%d_ms' % p] = numpy.percentile(latencies, p)
+        result['latency_max_ms'] = latencies.max()
+        result['jitter_ms'] = latencies.std()
+        results.append(result)
+        print ('  %-18s read %5d/%5d  lost %4d  latency p50 %6.2f p99 %6.2f '
+               'max %6.2f ms  jitter %5.2f ms'
+               % (label, read, result['target_frames'], lost,
+                  result['latency_p50_ms'], result['latency_p99_ms'],
+                  result['latency_max_ms'], result['jitter_ms']))
+    return results
+
+
+BENCHMARKS = [
+    ('correction', bench_correction),
+    ('accumulation', bench_accumulation),
+    ('statistics', bench_statistics),
+    ('photoncounting', bench_photon_counting),
+    ('hdr', bench_hdr),
+    ('hwaccumulation', bench_hardware_accumulation),
+    ('planner', bench_planner),
+    ('logging', bench_logging),
+    ('multicamera', bench_multicamera),
+    ('serialization', bench_serialization),
+    ('compression', bench_compression),
+    ('packing', bench_packing),
+    ('endtoend', bench_end_to_end),
+    ('slowclient', bench_slow_client),
+    ('realtime', bench_real_time),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('names', nargs='*')
+    parser.add_argument('--json', help='File to write results to.')
+    args = parser.parse_args()
+    benchmarks = dict(BENCHMARKS)
+    names = args.names
+    if not names:
+        print __doc__
+        for name, func in BENCHMARKS:
+            print '  %-16s %s' % (name, func.__doc__)
+        return
+    if names == ['all']:
+        names = [name for name, func in BENCHMARKS]
+    results = {}
+    for name in names:
+        print '%s: %s' % (name, benchmarks[name].__doc__)
+        result = benchmarks[name]()
+        if result is not None:
+            results[name] = result
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump({'time': time.time(), 'results': results}, fh,
+                      indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
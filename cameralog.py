@@ -0,0 +1,107 @@
+"""A buffered, level-gated logger for camera servers."""
+
+import os
+import threading
+import time
+from collections import deque
+
+
+class CameraLogger(object):
+    """A buffered, level-gated logger for a Camera.
+
+    log does no formatting or file I/O: it appends to a bounded deque,
+    which needs no lock, and a background thread writes and flushes
+    queued messages every flush_interval seconds. Frequent events on the
+    hot path should use count, which only increments a counter under a
+    short lock, so that no count is lost as a flush takes them: the
+    writer thread logs one summary line per event per interval.
+    """
+    DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+    LEVEL_NAMES = {10: 'DEBUG', 20: 'INFO', 30: 'WARNING', 40: 'ERROR'}
+
+    def __init__(self, level=INFO, flush_interval=1., max_queue=10000):
+        self.fh = None
+        self.level = level
+        self.flush_interval = flush_interval
+        # Queued (time, level, message) tuples. When full, the oldest
+        # messages are dropped.
+        self.queue = deque(maxlen=max_queue)
+        # Counts of hot-path events since the last flush.
+        self.counts = {}
+        self.counts_lock = threading.Lock()
+        self.queued_count = 0
+        self.written_count = 0
+        self.last_flush = time.time()
+        self.writer = None
+        self.stop_event = threading.Event()
+
+
+    def count(self, event):
+        """Count an occurrence of event, to be summarised at the next flush."""
+        with self.counts_lock:
+            self.counts[event] = self.counts.get(event, 0) + 1
+
+
+    def log(self, message, level=INFO):
+        if self.fh is None or level < self.level:
+            return
+        self.queue.append((time.time(), level, message))
+        self.queued_count += 1
+
+
+    def flush(self):
+        """Write queued messages and event summaries to file."""
+        now = time.time()
+        with self.counts_lock:
+            counts, self.counts = self.counts, {}
+        lines = []
+        while self.queue:
+            (t, level, message) = self.queue.popleft()
+            lines.append('%s:  %s%s\n' % (
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)),
+                '' if level == self.INFO else self.LEVEL_NAMES[level] + ': ',
+                message))
+        for event, n in sorted(counts.items()):
+            lines.append('%s:  %s: %d in last %.1fs\n' % (
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)),
+                event, n, now - self.last_flush))
+        self.last_flush = now
+        self.written_count += len(lines) - len(counts)
+        fh = self.fh
+        if fh is not None and lines:
+            fh.writelines(lines)
+            fh.flush()
+
+
+    def get_stats(self):
+        """Return message counts, including those dropped from a full queue."""
+        return {'queued': self.queued_count,
+                'written': self.written_count,
+                'pending': len(self.queue),
+                'dropped': (self.queued_count - self.written_count
+                            - len(self.queue))}
+
+
+    def open(self, filename, path=None):
+        if path is None:
+            path = os.path.dirname(os.path.abspath(__file__))
+        self.fh = open(os.path.join(path, str(filename) + '.txt'), 'w')
+        self.stop_event.clear()
+        self.writer = threading.Thread(target=self._write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+
+    def close(self):
+        self.stop_event.set()
+        if self.writer is not None:
+            self.writer.join(5)
+            self.writer = None
+        self.flush()
+        self.fh.close()
+        self.fh = None
+
+
+    def _write_loop(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
@@ -4,3 +4,11 @@ cameras = [
     ('East', 9145, 1<<1, '192.168.1.2', 7778, 'ixon', ['Cy5', 'FITC'], [670, 518]),
     ]
 camera_keys = ['label', 'serial', 'line', 'ipAddress', 'port', 'model', 'dyes', 'wavelengths']
+
+## Port for an Aggregator serving all cameras from one endpoint, or None
+## for a separate endpoint per camera only.
+aggregator_port = None
+
+## Serve each camera process's metrics over HTTP on its port plus this
+## offset, or None to serve no metrics.
+metrics_port_offset = None
@@ -0,0 +1,421 @@
+"""Compact per-frame headers and frame encodings for clients.
+
+A frame header is a fixed-layout little-endian record:
+    version      uint8   HEADER_VERSION
+    flags        uint8   bit depth the image is packed to: see PACKING_FLAGS
+    size         uint16  header size in bytes
+    generation   uint32  settings generation: incremented on each change
+    sequence     uint64  frames read since the camera was armed, from 1
+    image_index  int64   the SDK's index of the image since acquisition start
+    monotonic    float64 monotonic receive time, in seconds
+    anchor       float64 wall-clock time at monotonic time 0
+    exposure     float64 the frame's exposure time, in seconds (version 2)
+so a frame's wall-clock time is monotonic + anchor. Later versions may
+append fields: readers should use size to find the end of the header.
+
+A frame can also be sent encoded, as an object that pickles as a
+compact buffer header and the frame's bytes, rather than through
+numpy's generic array pickling. The buffer header is
+    dtype        uint8   index into DTYPES
+    ndim         uint8
+    shape        ndim x int64
+    strides      ndim x int64, in bytes
+The client unpickles an encoded frame by calling decode_frame, so it
+needs this module, and gets an ordinary writable ndarray whose memory
+is the received bytes themselves, without a copy.
+
+The 'zlib' encoding is lossless compression for low-entropy frames:
+each row is optionally delta-encoded from its left neighbour (which
+helps bright, smooth images but hurts noise-dominated ones), the bytes
+of each pixel are shuffled into separate planes, and the result is
+compressed with zlib. Frames are split into strips of rows that are
+compressed in parallel on a thread pool, so a frame is complete, and
+frames stay in order, when encode returns.
+
+The 'packed' encoding packs each uint16 frame into the narrowest of 8,
+12 or 16 bits per pixel that holds its maximum value. 12-bit packing
+stores each pair of pixels in three bytes.
+"""
+
+import ctypes
+import ctypes.util
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import namedtuple
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+HEADER_VERSION = 2
+HEADER = struct.Struct('<BBHIQqddd')
+# Headers by version, for reading older headers.
+HEADERS = {1: struct.Struct('<BBHIQqdd'), 2: HEADER}
+
+# Frame dtypes that can be encoded, indexed by code.
+DTYPES = ['<u2', '<u1', '<u4', '<i4', '<f4', '<f8', '<i8']
+DTYPE_CODES = {numpy.dtype(dtype): code for code, dtype in enumerate(DTYPES)}
+BUFFER_HEADER = struct.Struct('<BB')
+# Frame header flags for each packed bit depth.
+PACKING_FLAGS = {16: 0, 8: 1, 12: 2}
+
+# Rows per strip and delta flag, after the buffer header of a
+# compressed frame.
+STRIP_HEADER = struct.Struct('<I?')
+
+
+## A monotonic, high-resolution clock.
+# Python 2 has no time.monotonic. On Windows, time.clock uses
+# QueryPerformanceCounter; elsewhere, use clock_gettime.
+if sys.platform == 'win32':
+    monotonic = time.clock
+else:
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or
+                                     ctypes.util.find_library('c')).clock_gettime
+    except (OSError, AttributeError):
+        monotonic = time.time
+    else:
+        _CLOCK_MONOTONIC = 1
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+        def monotonic():
+            t = _timespec()
+            _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(t))
+            return t.tv_sec + t.tv_nsec * 1e-9
+
+
+def clock_anchor():
+    """Return the wall-clock time at monotonic time 0."""
+    return time.time() - monotonic()
+
+
+class FrameHeader(namedtuple('FrameHeader', ['version', 'flags', 'size',
+                                             'generation', 'sequence',
+                                             'image_index', 'monotonic',
+                                             'anchor', 'exposure'])):
+    """An unpacked frame header. exposure is None before version 2."""
+    __slots__ = ()
+
+    @property
+    def wall_time(self):
+        return self.monotonic + self.anchor
+
+
+def pack_header(generation, sequence, image_index, monotonic, anchor,
+                exposure=0., flags=0):
+    """Return a frame header as a string of HEADER.size bytes."""
+    return HEADER.pack(HEADER_VERSION, flags, HEADER.size, generation,
+                       sequence, image_index, monotonic, anchor, exposure)
+
+
+def unpack_header(data):
+    """Return a FrameHeader from a packed header."""
+    version = ord(data[0])
+    if version < 1:
+        raise Exception('Unknown frame header version %d.' % version)
+    # Newer headers start with the fields of the newest we know.
+    fields = HEADERS[min(version, HEADER_VERSION)].unpack_from(data)
+    return FrameHeader(*(fields + (None,) * (len(FrameHeader._fields)
+                                             - len(fields))))
+
+
+class RawFrame(object):
+    """An encoded frame, which pickles as its buffer header and bytes."""
+    __slots__ = ('header', 'data')
+
+    def __init__(self, header, data):
+        self.header = header
+        self.data = data
+
+    def __reduce__(self):
+        return (decode_frame, (self.header, self.data))
+
+
+class FrameEncoder(object):
+    """Encode frames as RawFrames.
+
+    numpy's own pickling gathers non-contiguous arrays, such as
+    transformed frames, element by element: instead, copy them into a
+    reused contiguous buffer first.
+    """
+    def __init__(self):
+        self.stage = None
+
+
+    def encode(self, image):
+        if not image.flags.c_contiguous:
+            stage = self.stage
+            if (stage is None or stage.shape != image.shape
+                    or stage.dtype != image.dtype):
+                stage = self.stage = numpy.empty(image.shape, image.dtype)
+            numpy.copyto(stage, image)
+            image = stage
+        return RawFrame(encode_buffer_header(image), image.tostring())
+
+
+def encode_buffer_header(image):
+    return (BUFFER_HEADER.pack(DTYPE_CODES[image.dtype], image.ndim)
+            + struct.pack('<%dq' % (2 * image.ndim),
+                          *(image.shape + image.strides)))
+
+
+def c_strides(shape, itemsize):
+    """Return the strides of a C-contiguous array."""
+    strides = []
+    for n in reversed(shape):
+        strides.insert(0, itemsize)
+        itemsize *= n
+    return tuple(strides)
+
+
+def decode_frame(header, data):
+    """Return the ndarray for an encoded frame."""
+    code, ndim = BUFFER_HEADER.unpack_from(header)
+    dims = struct.unpack_from('<%dq' % (2 * ndim), header, BUFFER_HEADER.size)
+    shape, strides = dims[:ndim], dims[ndim:]
+    dtype = numpy.dtype(DTYPES[code])
+    if strides == c_strides(shape, dtype.itemsize):
+        # Adopt data as the array's memory, as numpy's unpickling does:
+        # this gives a writable array without copying.
+        image = numpy.ndarray((0,), dtype)
+        image.__setstate__((1, shape, dtype, False, data))
+        return image
+    return as_strided(numpy.frombuffer(data, dtype), shape, strides).copy()
+
+
+class CompressedFrame(object):
+    """A compressed frame, which pickles as its headers and strips."""
+    __slots__ = ('header', 'strips')
+
+    def __init__(self, header, strips):
+        self.header = header
+        self.strips = strips
+
+    def __reduce__(self):
+        return (decompress_frame, (self.header, self.strips))
+
+
+def _unsigned(image):
+    """Return a view of image as unsigned integers of the same size."""
+    return image.view('<u%d' % image.dtype.itemsize)
+
+
+def compress_strip(strip, level=1, delta=False):
+    """Delta-encode rows, shuffle bytes and compress a 2D C-contiguous strip."""
+    pixels = _unsigned(strip)
+    if delta:
+        pixels = pixels.copy()
+        # Unsigned subtraction wraps, so this is exactly reversible.
+        pixels[:, 1:] -= _unsigned(strip)[:, :-1]
+    planes = pixels.view(numpy.uint8).reshape(-1, pixels.dtype.itemsize).T
+    return zlib.compress(planes.tostring(), level)
+
+
+def decompress_strip(data, dtype, rows, cols, delta=False):
+    """Reverse compress_strip, returning unsigned integers."""
+    itemsize = dtype.itemsize
+    planes = numpy.frombuffer(zlib.decompress(data), numpy.uint8)
+    pixels = planes.reshape(itemsize, -1).T.copy().view('<u%d' % itemsize)
+    pixels = pixels.reshape(rows, cols)
+    if delta:
+        return numpy.cumsum(pixels, axis=1, dtype=pixels.dtype)
+    return pixels
+
+
+def decompress_frame(header, strips):
+    """Return the ndarray for a compressed frame."""
+    code, ndim = BUFFER_HEADER.unpack_from(header)
+    offset = BUFFER_HEADER.size + 16 * ndim
+    shape = struct.unpack_from('<%dq' % ndim, header, BUFFER_HEADER.size)
+    rows_per_strip, delta = STRIP_HEADER.unpack_from(header, offset)
+    dtype = numpy.dtype(DTYPES[code])
+    image = numpy.empty(shape, dtype)
+    pixels = _unsigned(image)
+    for i, data in enumerate(strips):
+        strip = pixels[i * rows_per_strip:(i + 1) * rows_per_strip]
+        strip[:] = decompress_strip(data, dtype, strip.shape[0], shape[1],
+                                    delta)
+    return image
+
+
+# Compression thread pools, by number of threads. Pools are shared and
+# never closed, so an encoder can be replaced while it is in use.
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(threads):
+    with _pools_lock:
+        if threads not in _pools:
+            _pools[threads] = ThreadPool(threads)
+        return _pools[threads]
+
+
+class CompressingEncoder(FrameEncoder):
+    """Encode 2D frames as CompressedFrames, compressing strips in parallel.
+
+    Statistics on compression ratio and time are kept for get_stats.
+    """
+    def __init__(self, level=1, threads=None, strips=None, delta=False):
+        super(CompressingEncoder, self).__init__()
+        self.level = level
+        self.delta = delta
+        self.threads = threads or min(4, cpu_count())
+        # Enough strips to keep every thread busy.
+        self.strips = strips or 2 * self.threads
+        self.pool = get_pool(self.threads)
+        self.frames = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.
+
+
+    def compress(self, strip):
+        return compress_strip(strip, self.level, self.delta)
+
+
+    def encode(self, image):
+        t0 = time.time()
+        if not image.flags.c_contiguous:
+            stage = self.stage
+            if (stage is None or stage.shape != image.shape
+                    or stage.dtype != image.dtype):
+                stage = self.stage = numpy.empty(image.shape, image.dtype)
+            numpy.copyto(stage, image)
+            image = stage
+        rows = -(-image.shape[0] // self.strips)
+        strips = self.pool.map(self.compress,
+                               [image[i:i + rows]
+                                for i in range(0, image.shape[0], rows)])
+        header = (encode_buffer_header(image)
+                  + STRIP_HEADER.pack(rows, self.delta))
+        self.frames += 1
+        self.bytes_in += image.nbytes
+        self.bytes_out += sum(len(strip) for strip in strips)
+        self.seconds += time.time() - t0
+        return CompressedFrame(header, strips)
+
+
+    def get_stats(self):
+        """Return frames compressed, mean ratio and mean time per frame."""
+        if not self.frames:
+            return {'frames': 0}
+        return {'frames': self.frames,
+                'ratio': float(self.bytes_in) / self.bytes_out,
+                'ms_per_frame': 1e3 * self.seconds / self.frames}
+
+
+def pack_12bit(pixels):
+    """Pack a flat uint16 array of values < 4096 into 3 bytes per 2 pixels."""
+    if len(pixels) % 2:
+        pixels = numpy.append(pixels, numpy.uint16(0))
+    a, b = pixels[0::2], pixels[1::2]
+    packed = numpy.empty((len(a), 3), numpy.uint8)
+    packed[:, 0] = a & 0xff
+    packed[:, 1] = (a >> 8) | ((b & 0xf) << 4)
+    packed[:, 2] = b >> 4
+    return packed
+
+
+def unpack_12bit(data, count):
+    """Return count uint16 pixels from data packed by pack_12bit."""
+    packed = numpy.frombuffer(data, numpy.uint8).reshape(-1, 3)
+    packed = packed.astype(numpy.uint16)
+    pixels = numpy.empty(2 * len(packed), numpy.uint16)
+    pixels[0::2] = packed[:, 0] | ((packed[:, 1] & 0xf) << 8)
+    pixels[1::2] = (packed[:, 1] >> 4) | (packed[:, 2] << 4)
+    return pixels[:count]
+
+
+class PackedFrame(object):
+    """A bit-packed frame, which pickles as its header, depth and bytes."""
+    __slots__ = ('header', 'bits', 'data')
+
+    def __init__(self, header, bits, data):
+        self.header = header
+        self.bits = bits
+        self.data = data
+
+    def __reduce__(self):
+        return (unpack_frame, (self.header, self.bits, self.data))
+
+
+def unpack_frame(header, bits, data):
+    """Return the uint16 ndarray for a packed frame."""
+    code, ndim = BUFFER_HEADER.unpack_from(header)
+    shape = struct.unpack_from('<%dq' % ndim, header, BUFFER_HEADER.size)
+    count = int(numpy.prod(shape))
+    if bits == 8:
+        pixels = numpy.frombuffer(data, numpy.uint8).astype(numpy.uint16)
+    elif bits == 12:
+        pixels = unpack_12bit(data, count)
+    else:
+        pixels = numpy.frombuffer(data, numpy.uint16).copy()
+    return pixels.reshape(shape)
+
+
+class PackingEncoder(FrameEncoder):
+    """Encode uint16 frames as PackedFrames of the fewest bits that fit.
+
+    Frames of other dtypes are encoded as RawFrames.
+    """
+    def __init__(self):
+        super(PackingEncoder, self).__init__()
+        # Frames packed to each depth.
+        self.counts = {8: 0, 12: 0, 16: 0}
+
+
+    def encode(self, image):
+        if image.dtype != numpy.uint16:
+            return super(PackingEncoder, self).encode(image)
+        maximum = image.max() if image.size else 0
+        if maximum < 1 << 8:
+            bits, data = 8, image.astype(numpy.uint8).tostring()
+        else:
+            pixels = numpy.ascontiguousarray(image).reshape(-1)
+            if maximum < 1 << 12:
+                bits, data = 12, pack_12bit(pixels).tostring()
+            else:
+                bits, data = 16, pixels.tostring()
+        self.counts[bits] += 1
+        return PackedFrame(encode_buffer_header(image), bits, data)
+
+
+    def get_stats(self):
+        """Return numbers of frames packed to each bit depth."""
+        return dict(self.counts)
+
+
+def frame_flags(frame):
+    """Return frame header flags for an encoded frame."""
+    if isinstance(frame, PackedFrame):
+        return PACKING_FLAGS[frame.bits]
+    return 0
+
+
+# Frame encoders by name, for receiveClient.
+ENCODERS = {'raw': FrameEncoder,
+            'zlib': CompressingEncoder,
+            'packed': PackingEncoder}
+
+
+def get_encoder(encoding, options=None):
+    """Return an encoder for a named encoding, or None for plain arrays.
+
+    options are keyword arguments for the encoder, e.g. level, threads
+    and delta for 'zlib'.
+    """
+    if encoding is None:
+        return None
+    if encoding not in ENCODERS:
+        raise Exception('Unknown frame encoding %s: expected one of %s.'
+                        % (encoding, ', '.join(sorted(ENCODERS))))
+    return ENCODERS[encoding](**(options or {}))
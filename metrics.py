@@ -0,0 +1,307 @@
+"""Live counters, gauges and histograms, served in Prometheus text format.
+
+Metrics are created on a Registry, and each labelled series is a child
+object that is updated with a plain attribute increment: updates take
+no lock, so they are cheap enough for the per-frame hot path, at the
+cost of an occasional lost update when two threads update the same
+series at once. A MetricsServer serves a Registry over HTTP at /metrics.
+
+CameraMetrics creates the standard set of camera server metrics for
+one camera.
+"""
+
+import threading
+from bisect import bisect_left
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from framecodec import monotonic
+
+# Histogram bucket upper bounds for durations, in seconds.
+SECONDS_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005,
+                   0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1., 5.)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('"', r'\"'))
+                             for name, value in zip(names, values))
+
+
+class Metric(object):
+    """A named metric with one series per combination of label values."""
+    TYPE = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+
+
+    def labels(self, *values):
+        """Return the series for these label values, creating it if need be."""
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+
+    def remove(self, *values):
+        with self.lock:
+            self.children.pop(tuple(str(v) for v in values), None)
+
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.TYPE)]
+        for values, child in sorted(self.children.items()):
+            lines.extend(self.render_child(values, child))
+        return lines
+
+
+    def render_child(self, values, child):
+        return ['%s%s %r' % (self.name, format_labels(self.label_names, values),
+                             float(child.get()))]
+
+
+class CounterChild(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def get(self):
+        return self.value
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def new_child(self):
+        return CounterChild()
+
+
+class GaugeChild(object):
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Call function for the value whenever the gauge is read."""
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return float('nan')
+        return self.value
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def new_child(self):
+        return GaugeChild()
+
+
+class HistogramChild(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Counts per bucket, with a final bucket for +Inf.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+
+    def render_child(self, values, child):
+        names = self.label_names + ('le',)
+        lines = []
+        total = 0
+        counts = list(child.counts)
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_bucket%s %d'
+                         % (self.name, format_labels(names, values + (le,)),
+                            total))
+        labels = format_labels(self.label_names, values)
+        lines.append('%s_sum%s %r' % (self.name, labels, child.sum))
+        lines.append('%s_count%s %d' % (self.name, labels, total))
+        return lines
+
+
+class Registry(object):
+    """A collection of metrics, rendered together."""
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = cls(name, help, labels, **kwargs)
+                self.metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise Exception('Metric %s already registered as a %s.'
+                                % (name, metric.TYPE))
+        return metric
+
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+
+    def gauge(self, name, help, labels=()):
+        return self._get(Gauge, name, help, labels)
+
+
+    def histogram(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+
+    def render(self):
+        """Return all metrics in Prometheus text exposition format."""
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+
+# The registry used by camera servers.
+registry = Registry()
+
+
+class CameraMetrics(object):
+    """The metrics for one camera, as series labelled by camera serial."""
+    def __init__(self, camera, registry=registry):
+        self.camera = str(camera)
+        self.registry = registry
+        labels = ('camera',)
+        r = registry
+        self.frames_acquired = r.counter(
+            'andor_frames_acquired_total',
+            'Frames read from the camera.', labels).labels(camera)
+        self.frames_sent = r.counter(
+            'andor_frames_sent_total',
+            'Frames sent to the client.', labels).labels(camera)
+        self.frames_skipped = r.counter(
+            'andor_frames_skipped_total',
+            'Frames skipped on request.', labels).labels(camera)
+        self.frames_dropped = r.counter(
+            'andor_frames_dropped_total',
+            'Frames not sent for want of a client, or on send failure.',
+            labels).labels(camera)
+        self.fps = r.gauge(
+            'andor_frames_per_second',
+            'Frames read per second, over the last second.',
+            labels).labels(camera)
+        self.buffer_images = r.gauge(
+            'andor_buffer_images',
+            'Images waiting in the SDK circular buffer.',
+            labels).labels(camera)
+        self.temperature = r.gauge(
+            'andor_temperature_celsius',
+            'Sensor temperature.', labels).labels(camera)
+        self.send_seconds = r.histogram(
+            'andor_client_send_seconds',
+            'Time to send a frame to the client.', labels).labels(camera)
+        self.lock_wait_seconds = r.histogram(
+            'andor_lock_wait_seconds',
+            'Time spent waiting for the DLL lock.', labels).labels(camera)
+        self.dll_call_metric = r.histogram(
+            'andor_dll_call_seconds',
+            'Duration of SDK DLL calls.', ('camera', 'function'))
+        self.dll_calls = {}
+        self.fps_count = 0
+        self.fps_time = monotonic()
+
+
+    def dll_call(self, function):
+        """Return the DLL call duration series for function."""
+        child = self.dll_calls.get(function)
+        if child is None:
+            child = self.dll_call_metric.labels(self.camera, function)
+            self.dll_calls[function] = child
+        return child
+
+
+    def frame_acquired(self, now):
+        """Count an acquired frame, and update fps once a second.
+
+        now is the frame's framecodec.monotonic time.
+        """
+        self.frames_acquired.inc()
+        self.fps_count += 1
+        elapsed = now - self.fps_time
+        if elapsed >= 1.:
+            self.fps.set(self.fps_count / elapsed)
+            self.fps_count = 0
+            self.fps_time = now
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        # Don't write a line to stderr for every scrape.
+        pass
+
+
+class MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """Serve a Registry over HTTP from a background thread."""
+    def __init__(self, host='127.0.0.1', port=9100, registry=registry):
+        self.server = MetricsHTTPServer((host, port), MetricsHandler)
+        self.server.registry = registry
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+
+    def start(self):
+        self.thread.start()
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,582 @@
+"""Frame-processing stages for the camera data pipeline.
+
+The classes in this module operate on numpy arrays only: they have no
+dependency on the Andor SDK, so they can be used and benchmarked on
+machines without the DLL or camera hardware.
+"""
+
+import numpy
+
+
+class CalibrationCache(object):
+    """A store of master dark and flat frames.
+
+    Calibration frames are only valid for the readout configuration they
+    were taken with, so they are keyed on camera serial number, amplifier
+    mode, exposure time and readout ROI.
+    """
+    def __init__(self):
+        # Map keys to {'dark': array or None, 'flat': array or None}.
+        self.frames = {}
+
+
+    @staticmethod
+    def make_key(serial, amplifier_mode, exposure, roi):
+        # Amplifier modes are passed around as dicts: key on the label.
+        if isinstance(amplifier_mode, dict):
+            amplifier_mode = amplifier_mode.get('label')
+        # Round the exposure so that float noise doesn't cause misses.
+        if exposure is not None:
+            exposure = round(float(exposure), 6)
+        return (serial, amplifier_mode, exposure, tuple(roi or ()))
+
+
+    def keys(self):
+        return self.frames.keys()
+
+
+    def lookup(self, key):
+        return self.frames.get(key)
+
+
+    def remove(self, key):
+        self.frames.pop(key, None)
+
+
+    def store(self, key, dark=None, flat=None):
+        entry = self.frames.setdefault(key, {'dark': None, 'flat': None})
+        if dark is not None:
+            entry['dark'] = numpy.array(dark, dtype=numpy.float32)
+        if flat is not None:
+            entry['flat'] = numpy.array(flat, dtype=numpy.float32)
+        return entry
+
+
+class DarkFlatCorrection(object):
+    """Subtract a master dark and divide by a normalised flat, in place.
+
+    The dark includes the camera's bias, so a fixed pedestal is added
+    back afterwards: corrected background pixels scatter about pedestal
+    rather than about 0, where an unsigned frame would lose the negative
+    half of the read noise. Without a dark, the flat scales only the
+    signal above the pedestal.
+
+    The flat is normalised to unit mean and inverted when the stage is
+    created, so each frame costs a subtract, a multiply, an add, a round,
+    a clip to the range of dtype and a cast, all into preallocated
+    buffers.
+    """
+    def __init__(self, shape, dark=None, flat=None, dtype=numpy.uint16,
+                 pedestal=0):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.pedestal = float(pedestal)
+        info = numpy.iinfo(self.dtype)
+        self.min_value, self.max_value = info.min, info.max
+        # Working buffer for the float intermediate.
+        self.work = numpy.empty(self.shape, dtype=numpy.float32)
+
+        if dark is None:
+            self.offset = None
+        else:
+            self.offset = self._check(dark, 'dark')
+
+        if flat is None:
+            self.gain = None
+        else:
+            flat = self._check(flat, 'flat')
+            good = flat > 0
+            if not good.any():
+                raise Exception('Bad flat: no positive pixels.')
+            # Pixels with no response in the flat are passed unscaled.
+            self.gain = numpy.ones(self.shape, dtype=numpy.float32)
+            self.gain[good] = flat[good].mean() / flat[good]
+
+
+    def _check(self, frame, name):
+        frame = numpy.array(frame, dtype=numpy.float32)
+        if frame.shape != self.shape:
+            raise Exception('Bad %s: expected shape %s, got %s.'
+                            % (name, self.shape, frame.shape))
+        return frame
+
+
+    def process(self, image):
+        """Correct image in place and return it."""
+        work = self.work
+        if self.offset is not None:
+            numpy.subtract(image, self.offset, out=work)
+        elif self.pedestal:
+            numpy.subtract(image, self.pedestal, out=work)
+        else:
+            numpy.copyto(work, image)
+        if self.gain is not None:
+            numpy.multiply(work, self.gain, out=work)
+        if self.pedestal:
+            numpy.add(work, self.pedestal, out=work)
+        numpy.rint(work, out=work)
+        numpy.clip(work, self.min_value, self.max_value, out=work)
+        numpy.copyto(image, work, casting='unsafe')
+        return image
+
+
+def bin_image(image, factor):
+    """Return image binned by factor, as float32, using a reshape-mean.
+
+    Rows and columns that don't fill a complete bin are discarded.
+    """
+    factor = int(factor)
+    ny = image.shape[0] // factor
+    nx = image.shape[1] // factor
+    blocks = image[:ny * factor, :nx * factor].reshape(ny, factor, nx, factor)
+    return blocks.mean(axis=(1, 3), dtype=numpy.float32)
+
+
+def decimate_image(image, factor):
+    """Return a view of every factor'th pixel of image in each axis."""
+    factor = int(factor)
+    return image[::factor, ::factor]
+
+
+def scale_to_8bit(image, low=None, high=None):
+    """Return image linearly scaled to uint8 between low and high.
+
+    If low or high are not given, the image minimum or maximum is used.
+    """
+    image = numpy.asarray(image, dtype=numpy.float32)
+    if low is None:
+        low = image.min()
+    if high is None:
+        high = image.max()
+    scale = 255. / max(float(high) - float(low), 1.)
+    result = numpy.subtract(image, low)
+    numpy.multiply(result, scale, out=result)
+    numpy.clip(result, 0, 255, out=result)
+    return result.astype(numpy.uint8)
+
+
+def make_preview(image, factor=4, method='mean', scale=True,
+                 low=None, high=None):
+    """Return a low-resolution preview of image.
+
+    method is 'mean' to bin factor x factor blocks, or 'decimate' to take
+    every factor'th pixel; scale converts the result to uint8.
+    """
+    if factor <= 1:
+        result = image
+    elif method == 'mean':
+        result = bin_image(image, factor)
+    elif method == 'decimate':
+        result = decimate_image(image, factor)
+    else:
+        raise Exception('Bad preview method: %s.' % method)
+    if scale:
+        return scale_to_8bit(result, low, high)
+    return numpy.ascontiguousarray(result)
+
+
+class FrameView(object):
+    """One client's view of a frame: a region, then a stride, then binning.
+
+    roi is (top, left, height, width) in array indices of the transformed
+    frame, so rows are on axis 0; the region is clipped to the frame.
+    Cropping and striding give a view onto the frame without copying;
+    binning, or copy, gives a new contiguous array. Binned integer frames
+    keep their dtype, with each pixel the rounded mean of its bin.
+    """
+    def __init__(self, roi=None, stride=1, binning=1, copy=False):
+        if roi is not None:
+            roi = tuple(int(x) for x in roi)
+            if len(roi) != 4 or min(roi) < 0 or min(roi[2:]) < 1:
+                raise Exception('Bad roi: expected (top, left, height, width).')
+        if int(stride) < 1 or int(binning) < 1:
+            raise Exception('Bad view: stride and binning must be at least 1.')
+        self.roi = roi
+        self.stride = int(stride)
+        self.binning = int(binning)
+        self.copy = copy
+
+
+    def apply(self, image):
+        if self.roi is not None:
+            top, left, height, width = self.roi
+            image = image[top:top + height, left:left + width]
+        if self.stride > 1:
+            image = image[::self.stride, ::self.stride]
+        if self.binning > 1:
+            binned = bin_image(image, self.binning)
+            if image.dtype.kind in 'iu':
+                numpy.rint(binned, out=binned)
+            return binned.astype(image.dtype)
+        if self.copy:
+            return numpy.ascontiguousarray(image)
+        return image
+
+
+def make_view(roi=None, stride=1, binning=1, copy=False):
+    """Return a FrameView, or None if it would pass frames unchanged."""
+    if roi is None and stride == 1 and binning == 1 and not copy:
+        return None
+    return FrameView(roi, stride, binning, copy)
+
+
+class FrameAccumulator(object):
+    """Sum frames over non-overlapping blocks or a rolling window.
+
+    In 'block' mode, n frames are summed, the result is emitted and the
+    sum is cleared. In 'rolling' mode, the last n frames are kept in a
+    ring alongside their running sum: each new frame is added and the
+    frame it displaces is subtracted, so the update cost is independent
+    of n. The window is emitted every emit_every frames (n by default)
+    once the ring is full.
+
+    Integer frames are summed exactly in uint32, float frames in float64.
+    process returns the sum, or the float32 mean if average is set, when
+    a result is due, and None otherwise.
+    """
+    def __init__(self, n, mode='block', average=False, emit_every=None):
+        if mode not in ('block', 'rolling'):
+            raise Exception('Bad accumulation mode: %s.' % mode)
+        self.n = int(n)
+        if self.n < 1:
+            raise Exception('Bad accumulation: need at least one frame.')
+        self.mode = mode
+        self.average = average
+        self.emit_every = int(emit_every or self.n)
+        self.sum = None
+        self.ring = None
+        self.count = 0
+
+
+    def reset(self):
+        """Discard accumulated frames."""
+        self.sum = None
+        self.ring = None
+        self.count = 0
+
+
+    def _allocate(self, image):
+        if numpy.issubdtype(image.dtype, numpy.integer):
+            sum_dtype = numpy.uint32
+        else:
+            sum_dtype = numpy.float64
+        self.sum = numpy.zeros(image.shape, dtype=sum_dtype)
+        if self.mode == 'rolling':
+            self.ring = numpy.zeros((self.n,) + image.shape, dtype=image.dtype)
+        self.count = 0
+
+
+    def _result(self):
+        if self.average:
+            return numpy.divide(self.sum, self.n, dtype=numpy.float32)
+        return self.sum.copy()
+
+
+    def process(self, image):
+        if self.sum is None or self.sum.shape != image.shape:
+            self._allocate(image)
+        if self.mode == 'block':
+            numpy.add(self.sum, image, out=self.sum, casting='unsafe')
+            self.count += 1
+            if self.count < self.n:
+                return None
+            result = self._result()
+            self.sum.fill(0)
+            self.count = 0
+            return result
+        # Rolling mode.
+        slot = self.ring[self.count % self.n]
+        numpy.subtract(self.sum, slot, out=self.sum, casting='unsafe')
+        slot[...] = image
+        numpy.add(self.sum, slot, out=self.sum, casting='unsafe')
+        self.count += 1
+        if self.count < self.n or (self.count - self.n) % self.emit_every:
+            return None
+        return self._result()
+
+
+class HDRFusion(object):
+    """Fuse groups of frames of different exposures into HDR frames.
+
+    Frames are grouped as they arrive: a group is complete when it holds
+    group frames of different exposure times, and a frame whose exposure
+    is already in the group, as after a dropped frame, starts a new group.
+    Each pixel's count rate is the exposure-weighted mean over the
+    group's frames in which it is below saturation,
+        rate = sum((counts - baseline) * unsaturated) / sum(t * unsaturated)
+    which, for shot-noise-limited frames, weights each frame by its
+    signal to noise. Pixels saturated in every frame take the rate from
+    the shortest exposure. Sums are updated in place as frames arrive.
+
+    process returns the rate times the longest exposure, as float32
+    counts above baseline, when a group is complete, and None otherwise;
+    reference is then that exposure. process takes each frame's
+    exposure, which DataThread passes to stages that set needs_exposure.
+    """
+    needs_exposure = True
+
+    def __init__(self, group, saturation=None, baseline=0.):
+        self.group = int(group)
+        if self.group < 1:
+            raise Exception('Bad HDR fusion: need at least one exposure.')
+        self.saturation = saturation
+        self.baseline = float(baseline)
+        self.reference = None
+        self.exposures = []
+        # Masked count and exposure sums, and the shortest exposure's rate.
+        self.counts = None
+        self.times = None
+        self.fallback = None
+        self.groups = 0
+        self.dropped = 0
+
+
+    def reset(self):
+        """Discard a partial group."""
+        self.exposures = []
+
+
+    def _add(self, image, exposure):
+        if self.saturation is not None:
+            saturation = self.saturation
+        elif image.dtype.kind in 'iu':
+            saturation = numpy.iinfo(image.dtype).max
+        else:
+            saturation = numpy.inf
+        exposure = numpy.float32(exposure)
+        counts = numpy.subtract(image, self.baseline, dtype=numpy.float32)
+        unsaturated = image < saturation
+        first = not self.exposures
+        if first or exposure < min(self.exposures):
+            self.fallback = numpy.divide(counts, exposure)
+        numpy.multiply(counts, unsaturated, out=counts)
+        if first:
+            self.counts = counts
+            self.times = numpy.multiply(unsaturated, exposure)
+        else:
+            numpy.add(self.counts, counts, out=self.counts)
+            numpy.add(self.times, exposure, out=self.times, where=unsaturated)
+        self.exposures.append(exposure)
+
+
+    def process(self, image, exposure):
+        if not exposure > 0:
+            raise Exception('HDR fusion needs frame exposure times.')
+        if self.exposures and (numpy.float32(exposure) in self.exposures
+                               or self.counts.shape != image.shape):
+            # A frame of this group was lost: start a new group.
+            self.dropped += 1
+            self.exposures = []
+        self._add(image, exposure)
+        if len(self.exposures) < self.group:
+            return None
+        self.reference = float(max(self.exposures))
+        self.exposures = []
+        self.groups += 1
+        # Pixels saturated in every frame keep the fallback rate.
+        result = self.fallback
+        numpy.divide(self.counts, self.times, out=result,
+                     where=self.times > 0)
+        numpy.multiply(result, self.reference, out=result)
+        return result
+
+
+def frame_statistics(image, saturation=None, bins=16):
+    """Return a dict of summary statistics for image.
+
+    For 8- and 16-bit integer frames, a single bincount pass over the
+    pixels yields the minimum, maximum, mean, number of pixels at or
+    above saturation, and a coarse histogram of bins equal-width bins up
+    to saturation. saturation defaults to the dtype maximum for these
+    frames, or the frame maximum for others, such as 32-bit sums.
+    """
+    pixels = numpy.ravel(image)
+    n = pixels.size
+    if pixels.dtype.kind in 'iu' and pixels.dtype.itemsize <= 2:
+        if saturation is None:
+            saturation = numpy.iinfo(pixels.dtype).max
+        counts = numpy.bincount(pixels, minlength=saturation + 1)
+        occupied = numpy.flatnonzero(counts)
+        low, high = int(occupied[0]), int(occupied[-1])
+        values = numpy.arange(low, high + 1, dtype=numpy.float64)
+        mean = numpy.dot(counts[low:high + 1], values) / n
+        saturated = int(counts[saturation:].sum())
+        edges = numpy.linspace(0, saturation + 1, bins + 1).astype(numpy.intp)
+        histogram = numpy.add.reduceat(counts[:saturation + 1], edges[:-1])
+        # Saturated pixels above the range belong in the last bin.
+        histogram[-1] += counts[saturation + 1:].sum()
+    else:
+        low, high = float(pixels.min()), float(pixels.max())
+        mean = float(pixels.mean())
+        if saturation is None:
+            saturation = high
+        saturated = int(numpy.count_nonzero(pixels >= saturation))
+        histogram, edges = numpy.histogram(pixels, bins,
+                                           (0, max(saturation, 1)))
+    return {'count': n,
+            'min': low,
+            'max': high,
+            'mean': float(mean),
+            'saturated': saturated,
+            'saturation': saturation,
+            'histogram': [int(c) for c in histogram],
+            'edges': [float(e) for e in edges]}
+
+
+class CountConverter(object):
+    """Convert EMCCD counts to electrons or photons.
+
+    electrons = (counts - baseline) * sensitivity / em_gain
+    photons = electrons / qe
+    where sensitivity is in electrons per count and qe is a fraction.
+    Frames of any shape, including stacks, are converted in one pass.
+    """
+    def __init__(self, baseline, em_gain, sensitivity, qe=1., mode='electrons'):
+        if mode not in ('electrons', 'photons'):
+            raise Exception('Bad count conversion mode: %s.' % mode)
+        self.baseline = float(baseline)
+        self.mode = mode
+        scale = float(sensitivity) / max(float(em_gain), 1.)
+        if mode == 'photons':
+            scale /= float(qe)
+        self.scale = scale
+
+
+    def process(self, image):
+        result = numpy.subtract(image, self.baseline, dtype=numpy.float32)
+        numpy.multiply(result, self.scale, out=result)
+        return result
+
+
+class PhotonCounter(object):
+    """Count photons in EMCCD frames with one or more thresholds.
+
+    Each pixel scores the number of thresholds it reaches, so with a
+    single threshold this is binary photon counting. Scores are summed
+    over num_frames consecutive frames: process returns the summed frame
+    every num_frames frames, and None otherwise. For integer frames, the
+    score is looked up from a table built once for the whole dtype range.
+    """
+    def __init__(self, thresholds, num_frames=1):
+        self.thresholds = numpy.sort(numpy.atleast_1d(
+            numpy.asarray(thresholds, dtype=numpy.float64)))
+        if len(self.thresholds) > 255:
+            raise Exception('Bad photon counting: too many thresholds.')
+        self.num_frames = max(1, int(num_frames))
+        self.tables = {}
+        self.sum = None
+        self.count = 0
+
+
+    def score(self, image):
+        """Return the number of thresholds reached by each pixel."""
+        image = numpy.asarray(image)
+        if image.dtype.kind == 'u' and image.dtype.itemsize <= 2:
+            table = self.tables.get(image.dtype)
+            if table is None:
+                values = numpy.arange(numpy.iinfo(image.dtype).max + 1)
+                table = numpy.searchsorted(self.thresholds, values, 'right')
+                table = table.astype(numpy.uint8)
+                self.tables[image.dtype] = table
+            return table.take(image)
+        scores = numpy.searchsorted(self.thresholds, image, 'right')
+        return scores.astype(numpy.uint8)
+
+
+    def count_stack(self, stack):
+        """Return summed scores for a stack of num_images * num_frames frames."""
+        stack = numpy.asarray(stack)
+        n = stack.shape[0] // self.num_frames
+        scores = self.score(stack[:n * self.num_frames])
+        scores = scores.reshape((n, self.num_frames) + stack.shape[1:])
+        result = scores[:, 0].astype(numpy.uint32)
+        for i in range(1, self.num_frames):
+            numpy.add(result, scores[:, i], out=result)
+        return result
+
+
+    def process(self, image):
+        scores = self.score(image)
+        if self.num_frames == 1:
+            return scores
+        if self.sum is None or self.sum.shape != scores.shape:
+            self.sum = numpy.zeros(scores.shape, dtype=numpy.uint32)
+            self.count = 0
+        numpy.add(self.sum, scores, out=self.sum)
+        self.count += 1
+        if self.count < self.num_frames:
+            return None
+        result = self.sum.copy()
+        self.sum.fill(0)
+        self.count = 0
+        return result
+
+
+def histogram_percentile(image, percentile):
+    """Return the pixel value below which percentile % of pixels fall.
+
+    Integer frames use a cumulative bincount rather than a sort.
+    """
+    pixels = numpy.ravel(image)
+    if not numpy.issubdtype(pixels.dtype, numpy.integer):
+        return float(numpy.percentile(pixels, percentile))
+    cumulative = numpy.cumsum(numpy.bincount(pixels))
+    rank = percentile / 100. * pixels.size
+    return int(numpy.searchsorted(cumulative, rank))
+
+
+class ExposureController(object):
+    """Choose exposure time and EM gain to hold a histogram percentile at target.
+
+    The signal is taken as the percentile value less baseline. At most
+    every min_interval seconds, if the signal is more than tolerance
+    (fractionally) away from target, a correction of at most max_step in
+    either direction is made. Exposure is adjusted first; EM gain takes
+    up what is left once exposure reaches a limit, and is reduced before
+    exposure when the signal is too high.
+    """
+    def __init__(self, target, percentile=99., exposure_limits=(0.001, 1.),
+                 gain_limits=(0, 0), baseline=100, tolerance=0.1,
+                 min_interval=1., max_step=2.):
+        self.target = float(target)
+        self.percentile = float(percentile)
+        self.exposure_limits = tuple(exposure_limits)
+        self.gain_limits = tuple(gain_limits)
+        self.baseline = baseline
+        self.tolerance = tolerance
+        self.min_interval = min_interval
+        self.max_step = max_step
+        self.next_time = 0.
+
+
+    def due(self, now):
+        """Return True if an adjustment may be made at time now."""
+        return now >= self.next_time
+
+
+    def update(self, image, exposure, gain, now):
+        """Return new (exposure, gain), or None if no change is needed."""
+        if not self.due(now):
+            return None
+        signal = max(histogram_percentile(image, self.percentile)
+                     - self.baseline, 1)
+        ratio = self.target / signal
+        if abs(ratio - 1.) <= self.tolerance:
+            return None
+        ratio = min(max(ratio, 1. / self.max_step), self.max_step)
+        gain_min, gain_max = self.gain_limits
+        exp_min, exp_max = self.exposure_limits
+        new_gain = gain
+        if ratio < 1 and gain > gain_min:
+            # Too bright: give up EM gain before exposure.
+            new_gain = max(gain_min, int(gain * ratio))
+            ratio *= float(max(gain, 1)) / max(new_gain, 1)
+        new_exposure = min(max(exposure * ratio, exp_min), exp_max)
+        ratio *= exposure / new_exposure
+        if ratio > 1 + self.tolerance and new_gain < gain_max:
+            # Too dim at the exposure limit: add EM gain.
+            new_gain = min(gain_max, int(max(new_gain, 1) * ratio))
+        if new_exposure == exposure and new_gain == gain:
+            return None
+        self.next_time = now + self.min_interval
+        return (new_exposure, new_gain)
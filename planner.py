@@ -0,0 +1,90 @@
+"""Plan readout configurations for a target frame rate.
+
+A TimingModel holds timings measured once from the SDK for each
+candidate readout configuration: an amplifier mode, with or without
+frame transfer. The frame period at any exposure is predicted from
+these, so that a plan needs no DLL calls.
+
+The SDK's kinetic cycle time grows with the exposure time once the
+exposure is longer than the fixed overheads, and has a floor below
+that, set by readout. Each configuration is measured at a short and a
+long exposure, and the period predicted as
+    period = max(floor, exposure + overhead)
+where floor is the cycle time at the short exposure, and overhead the
+cycle time less the exposure at the long one.
+"""
+
+# Exposure times at which configurations are measured, in seconds.
+SHORT_EXPOSURE = 0.
+LONG_EXPOSURE = 1.
+
+
+class TimingModel(object):
+    """Timings for each candidate readout configuration."""
+    def __init__(self):
+        # Configurations, in the order they were measured.
+        self.entries = []
+
+
+    def add(self, mode, frame_transfer, hs_speed, readout, keep_clean,
+            floor, overhead):
+        """Add the timings measured for a configuration.
+
+        mode is an amplifier mode from andor.AMPLIFIER_MODES, hs_speed its
+        horizontal shift speed in MHz, and the rest times in seconds.
+        """
+        self.entries.append({'amplifierMode': mode,
+                             'frameTransfer': int(frame_transfer),
+                             'hsSpeed': hs_speed,
+                             'readoutTime': readout,
+                             'keepCleanTime': keep_clean,
+                             'floor': floor,
+                             'overhead': overhead})
+
+
+    def clear(self):
+        self.entries = []
+
+
+    def predict(self, entry, exposure):
+        """Return the predicted frame period for entry at exposure."""
+        return max(entry['floor'], exposure + entry['overhead'])
+
+
+    def plan(self, fps, exposure, amplifier=None):
+        """Return the highest-fidelity configuration that reaches fps.
+
+        Fidelity is taken to fall with horizontal shift speed, as read
+        noise rises with it. amplifier limits candidates to EM (0) or
+        conventional (1) modes. The result holds the 'settings' to apply,
+        and predicted timings. If no configuration reaches fps, the
+        fastest is returned, with 'meetsTarget' False.
+        """
+        if not self.entries:
+            raise Exception('No timings measured.')
+        candidates = []
+        for entry in self.entries:
+            mode = entry['amplifierMode']
+            if amplifier is not None and mode['amplifier'] != amplifier:
+                continue
+            period = self.predict(entry, exposure)
+            candidates.append((period, entry))
+        if not candidates:
+            raise Exception('No configurations for amplifier %s.' % amplifier)
+        meeting = [(p, entry) for p, entry in candidates
+                   if p <= 1. / fps]
+        if meeting:
+            # Slowest readout first, then most headroom.
+            period, entry = min(meeting,
+                                key=lambda c: (c[1]['hsSpeed'], c[0]))
+        else:
+            period, entry = min(candidates, key=lambda c: c[0])
+        return {'settings': {'amplifierMode': entry['amplifierMode'],
+                             'frameTransfer': entry['frameTransfer']},
+                'exposureTime': exposure,
+                'hsSpeed': entry['hsSpeed'],
+                'readoutTime': entry['readoutTime'],
+                'keepCleanTime': entry['keepCleanTime'],
+                'period': period,
+                'fps': 1. / period,
+                'meetsTarget': bool(meeting)}
@@ -0,0 +1,197 @@
+"""Real-time scheduling for the acquisition data path.
+
+Raise process and thread priorities, pin threads to CPUs, and hold off
+the cyclic garbage collector while acquiring, collecting only at safe
+points such as between frames. Thread settings apply to the calling
+thread, so each thread applies its own.
+
+Changing priorities may need privileges: functions here raise an
+Exception if a change is refused, and callers should carry on without it.
+"""
+
+import ctypes
+import gc
+import os
+import platform
+import threading
+
+import psutil
+
+WINDOWS = os.name == 'nt'
+
+# gettid syscall numbers, by machine.
+_GETTID = {'x86_64': 186, 'AMD64': 186, 'i386': 224, 'i686': 224,
+           'aarch64': 178, 'armv7l': 224}
+
+if WINDOWS:
+    _kernel32 = ctypes.windll.kernel32
+    _kernel32.GetCurrentThread.restype = ctypes.c_void_p
+    _kernel32.SetThreadAffinityMask.argtypes = [ctypes.c_void_p,
+                                                ctypes.c_size_t]
+    _kernel32.SetThreadAffinityMask.restype = ctypes.c_size_t
+    _kernel32.SetThreadPriority.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    # Thread priorities.
+    THREAD_PRIORITY_NORMAL = 0
+    THREAD_PRIORITY_HIGHEST = 2
+    THREAD_PRIORITY_TIME_CRITICAL = 15
+else:
+    _libc = ctypes.CDLL(None, use_errno=True)
+
+# Nice values for raised priority, where there are no priority classes.
+HIGH_NICE = -10
+NORMAL_NICE = 0
+
+# Settings keys, and their defaults.
+DEFAULTS = {'priority': True,   # Raise process and data path priorities.
+            'readCpus': None,   # CPUs for the thread reading frames.
+            'sendCpus': None,   # CPUs for threads sending frames.
+            'holdGC': True}     # Hold off the garbage collector.
+
+
+def parse_settings(value):
+    """Return real-time settings from a 'realTime' setting, or None.
+
+    value may be False or None for normal scheduling, True for the
+    defaults, or a dict overriding DEFAULTS.
+    """
+    if not value:
+        return None
+    settings = dict(DEFAULTS)
+    if isinstance(value, dict):
+        unknown = set(value) - set(DEFAULTS)
+        if unknown:
+            raise Exception('Unknown realTime settings: %s.'
+                            % ', '.join(sorted(unknown)))
+        settings.update(value)
+    return settings
+
+
+def thread_id():
+    """Return the OS identifier of the calling thread."""
+    if WINDOWS:
+        return _kernel32.GetCurrentThreadId()
+    number = _GETTID.get(platform.machine())
+    if number is None:
+        raise Exception('No gettid on %s.' % platform.machine())
+    return _libc.syscall(number)
+
+
+def set_thread_affinity(cpus=None):
+    """Pin the calling thread to cpus, or free it to run on any CPU."""
+    if cpus is None:
+        cpus = range(psutil.cpu_count())
+    cpus = [int(cpu) for cpu in cpus]
+    if WINDOWS:
+        mask = sum(1 << cpu for cpu in cpus)
+        if not _kernel32.SetThreadAffinityMask(_kernel32.GetCurrentThread(),
+                                               mask):
+            raise Exception('SetThreadAffinityMask failed: error %d.'
+                            % _kernel32.GetLastError())
+    else:
+        # On Linux each thread is a task, with its own affinity.
+        psutil.Process(thread_id()).cpu_affinity(cpus)
+
+
+def set_thread_priority(high=True):
+    """Raise the calling thread's priority, or restore it to normal."""
+    if WINDOWS:
+        priority = high and THREAD_PRIORITY_HIGHEST or THREAD_PRIORITY_NORMAL
+        if not _kernel32.SetThreadPriority(_kernel32.GetCurrentThread(),
+                                           priority):
+            raise Exception('SetThreadPriority failed: error %d.'
+                            % _kernel32.GetLastError())
+    else:
+        _nice(psutil.Process(thread_id()), high)
+
+
+def set_process_priority(high=True):
+    """Raise this process's priority, or restore it to normal."""
+    process = psutil.Process()
+    if WINDOWS:
+        try:
+            process.nice(high and psutil.HIGH_PRIORITY_CLASS
+                         or psutil.NORMAL_PRIORITY_CLASS)
+        except psutil.AccessDenied:
+            raise Exception('Not permitted to change process priority.')
+    else:
+        # This sets the main thread's nice value, which threads started
+        # afterwards inherit.
+        _nice(process, high)
+
+
+def _nice(process, high):
+    try:
+        process.nice(high and HIGH_NICE or NORMAL_NICE)
+    except psutil.AccessDenied:
+        raise Exception('Not permitted to change priority: '
+                        'needs root or CAP_SYS_NICE.')
+
+
+def configure_thread(settings, cpus_key):
+    """Apply settings to the calling thread, with CPUs from cpus_key.
+
+    settings None restores normal scheduling. Return a list of messages
+    for changes that were refused.
+    """
+    if settings is None:
+        settings = {'priority': False, cpus_key: None}
+    errors = []
+    for function, arg in ((set_thread_priority, settings['priority']),
+                          (set_thread_affinity, settings[cpus_key])):
+        try:
+            function(arg)
+        except Exception as e:
+            errors.append(str(e))
+    return errors
+
+
+class GCControl(object):
+    """Hold off the cyclic garbage collector while any holder needs it.
+
+    While held, young generations are collected only at safe_point,
+    when the collector's own thresholds say a collection is due. A full
+    collection can take longer than a frame on a large heap, so is left
+    until the last release, which then restores the collector.
+    """
+    def __init__(self):
+        self.holds = 0
+        self.was_enabled = True
+        self.lock = threading.Lock()
+        self.collections = 0
+
+
+    def hold(self):
+        with self.lock:
+            if self.holds == 0:
+                self.was_enabled = gc.isenabled()
+                gc.disable()
+            self.holds += 1
+
+
+    def release(self):
+        with self.lock:
+            if self.holds == 0:
+                return
+            self.holds -= 1
+            if self.holds == 0:
+                gc.collect()
+                if self.was_enabled:
+                    gc.enable()
+
+
+    def safe_point(self):
+        """Collect if a collection is due: call when a pause is harmless."""
+        if not self.holds:
+            return
+        counts = gc.get_count()
+        thresholds = gc.get_threshold()
+        for generation in (1, 0):
+            if thresholds[generation] and (counts[generation]
+                                           > thresholds[generation]):
+                gc.collect(generation)
+                self.collections += 1
+                return
+
+
+# The collector is per process, so is its control.
+gc_control = GCControl()
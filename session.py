@@ -0,0 +1,316 @@
+"""Record camera sessions, and replay them without hardware.
+
+A SessionRecorder writes a stream of pickled records to a file:
+    a header dict, then (kind, time, payload) tuples, where kind is
+    'frame'     payload (image, timestamp) as sent to the client;
+    'call'      payload (method, args, kwargs) for a client call;
+    'settings'  payload the camera's settings dict after a change;
+    'dropped'   payload the number of records dropped just before.
+Records are queued and written by a background thread, so recording
+does not hold up the data thread. If the disk can't keep up, records
+are dropped rather than queued, and a 'dropped' record marks the gap.
+
+A ReplayCamera serves a recording over the same Pyro interface as
+andor.Camera, at the original frame timing or as fast as possible.
+Recorded settings changes are applied as they are replayed, and
+recorded calls and gaps are reported by get_stats and get_calls.
+It needs neither the Andor SDK nor camera hardware, so can be used
+to load-test clients on any platform. Call from the command line to
+serve a recording:
+    python session.py recording.session [--port 7777] [--fast] [--loop]
+"""
+
+import argparse
+import cPickle
+import threading
+import time
+from collections import deque
+
+import Pyro4
+Pyro4.config.SERIALIZER = 'pickle'
+Pyro4.config.SERIALIZERS_ACCEPTED.add('pickle')
+
+FORMAT = 'pyAndor session'
+VERSION = 2
+
+
+class SessionRecorder(object):
+    """Record frames, client calls and settings changes to a file."""
+    def __init__(self, filename, max_queue=256):
+        self.filename = filename
+        self.fh = open(filename, 'wb')
+        self.pickler = cPickle.Pickler(self.fh, cPickle.HIGHEST_PROTOCOL)
+        self.pickler.dump({'format': FORMAT, 'version': VERSION,
+                           'started': time.time()})
+        # Records are queued here for the writer thread.
+        self.queue = deque()
+        self.max_queue = max_queue
+        self.condition = threading.Condition()
+        self.last_settings = None
+        self.written = 0
+        self.dropped = 0
+        # Records dropped since the last queued: see record.
+        self.gap = 0
+        self.run_flag = True
+        self.writer = threading.Thread(target=self._write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+
+    def record(self, kind, payload):
+        with self.condition:
+            if len(self.queue) >= self.max_queue:
+                # The disk can't keep up: drop rather than block.
+                self.dropped += 1
+                self.gap += 1
+                return
+            now = time.time()
+            if self.gap:
+                # Mark the gap, so that replay can report it.
+                self.queue.append(('dropped', now, self.gap))
+                self.gap = 0
+            self.queue.append((kind, now, payload))
+            self.condition.notify()
+
+
+    def record_call(self, method, args, kwargs):
+        self.record('call', (method, args, kwargs))
+
+
+    def record_frame(self, image, timestamp):
+        # The image is usually a view of a buffer that is about to be reused.
+        self.record('frame', (image.copy(), timestamp))
+
+
+    def record_settings(self, settings):
+        """Record settings if they differ from those last recorded."""
+        if settings != self.last_settings:
+            self.last_settings = dict(settings)
+            self.record('settings', self.last_settings)
+
+
+    def get_stats(self):
+        return {'written': self.written,
+                'pending': len(self.queue),
+                'dropped': self.dropped}
+
+
+    def close(self):
+        with self.condition:
+            if self.gap:
+                self.queue.append(('dropped', time.time(), self.gap))
+                self.gap = 0
+            self.run_flag = False
+            self.condition.notify()
+        self.writer.join()
+        self.fh.close()
+
+
+    def _write_loop(self):
+        while True:
+            with self.condition:
+                while self.run_flag and not self.queue:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                record = self.queue.popleft()
+            self.pickler.dump(record)
+            # Don't let the pickler's memo keep every frame alive.
+            self.pickler.clear_memo()
+            self.written += 1
+
+
+def read_session(filename):
+    """Return a recording's header, and an iterator over its records."""
+    fh = open(filename, 'rb')
+    unpickler = cPickle.Unpickler(fh)
+    header = unpickler.load()
+    if header.get('format') != FORMAT:
+        fh.close()
+        raise Exception('%s is not a session recording.' % filename)
+    def records():
+        try:
+            while True:
+                yield unpickler.load()
+        except EOFError:
+            # A recording that was not closed cleanly may end part-way
+            # through a record: replay what there is.
+            pass
+        finally:
+            fh.close()
+    return header, records()
+
+
+class ReplayCamera(object):
+    """Serve a recorded session as if it were a live camera.
+
+    speed scales the recorded frame timing; speed=None sends frames as
+    fast as the client accepts them. If loop is set, the recording is
+    replayed until the camera is disabled.
+    """
+    def __init__(self, filename, speed=1., loop=False):
+        self.filename = filename
+        self.speed = speed
+        self.loop = loop
+        self.header, records = read_session(filename)
+        self.settings = {}
+        self.image_size = None
+        # Find the initial settings and frame size.
+        for kind, t, payload in records:
+            if kind == 'settings' and not self.settings:
+                self.settings = dict(payload)
+            elif kind == 'frame':
+                self.image_size = payload[0].shape[::-1]
+                break
+        self.client = None
+        self.enabled = False
+        self.replay_thread = None
+        self.sent_count = 0
+        # Recorded calls replayed, as (time, method, args, kwargs).
+        self.calls = deque(maxlen=100)
+        self.call_count = 0
+        # Gaps in the recording, and the records missing from them.
+        self.gap_count = 0
+        self.dropped_count = 0
+
+
+    def disable(self):
+        self.enabled = False
+        if self.replay_thread is not None:
+            self.replay_thread.stop()
+            self.replay_thread.join(5)
+            self.replay_thread = None
+
+
+    def enable(self, settings={}):
+        self.disable()
+        self.settings.update(settings)
+        self.enabled = True
+        self.replay_thread = ReplayThread(self)
+        self.replay_thread.start()
+        return self.enabled
+
+
+    def get_image_size(self):
+        return self.image_size
+
+
+    def get_calls(self):
+        """Return the most recent recorded calls replayed."""
+        return list(self.calls)
+
+
+    def get_settings(self):
+        return self.settings
+
+
+    def get_stats(self):
+        return {'sent': self.sent_count,
+                'calls': self.call_count,
+                'gaps': self.gap_count,
+                'dropped': self.dropped_count,
+                'replaying': self.replay_thread is not None
+                             and self.replay_thread.is_alive()}
+
+
+    def is_enabled(self):
+        return self.enabled
+
+
+    def receiveClient(self, uri):
+        """Handle connection request from cockpit client."""
+        if uri is None:
+            self.client = None
+        else:
+            self.client = Pyro4.Proxy(uri)
+
+
+    def update_settings(self, settings, init=False):
+        """Accept settings: the recording determines the frames sent."""
+        self.settings.update(settings)
+        return self.enabled
+
+if hasattr(Pyro4, 'expose'):
+    ReplayCamera = Pyro4.expose(ReplayCamera)
+
+
+class ReplayThread(threading.Thread):
+    """A thread to send a recording's frames to a ReplayCamera's client,
+    and apply its other records to the camera."""
+    def __init__(self, cam):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cam = cam
+        self.run_flag = True
+
+
+    def run(self):
+        while self.run_flag:
+            self.replay()
+            if not self.cam.loop:
+                break
+
+
+    def replay(self):
+        speed = self.cam.speed
+        header, records = read_session(self.cam.filename)
+        start = None
+        cam = self.cam
+        for kind, t, payload in records:
+            if not self.run_flag:
+                return
+            if kind == 'settings':
+                cam.settings = dict(payload)
+                continue
+            elif kind == 'call':
+                cam.calls.append((t,) + tuple(payload))
+                cam.call_count += 1
+                continue
+            elif kind == 'dropped':
+                cam.gap_count += 1
+                cam.dropped_count += payload
+                continue
+            elif kind != 'frame':
+                continue
+            image, timestamp = payload
+            cam.image_size = image.shape[::-1]
+            if start is None:
+                start = (timestamp, time.time())
+            elif speed:
+                delay = (start[1] + (timestamp - start[0]) / speed
+                         - time.time())
+                if delay > 0:
+                    time.sleep(delay)
+            client = self.cam.client
+            if client is None:
+                continue
+            try:
+                client.receiveData('new image', image, time.time())
+            except Pyro4.errors.CommunicationError:
+                continue
+            self.cam.sent_count += 1
+
+
+    def stop(self):
+        self.run_flag = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('filename')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--speed', type=float, default=1.,
+                        help='Multiple of the recorded frame rate.')
+    parser.add_argument('--fast', action='store_true',
+                        help='Send frames as fast as possible.')
+    parser.add_argument('--loop', action='store_true')
+    args = parser.parse_args()
+    cam = ReplayCamera(args.filename, None if args.fast else args.speed,
+                       args.loop)
+    daemon = Pyro4.Daemon(host=args.host, port=args.port)
+    Pyro4.Daemon.serveSimple({cam: 'pyroCam'}, daemon=daemon, ns=False)
+
+
+if __name__ == '__main__':
+    main()
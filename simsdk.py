@@ -0,0 +1,712 @@
+"""simsdk - a simulated stand-in for andorsdk.
+
+This module mimics the interface of andorsdk closely enough to run
+Camera and DataThread from andor.py on machines without the DLL or
+camera hardware, e.g. for benchmarks. Install it in place of andorsdk
+before andor is imported:
+    import simsdk
+    simsdk.install()
+    import andor
+
+Constants and the list of exported function names are read from the
+andorsdk.py source, so they stay in step with it. Functions that the
+simulation does not implement succeed without doing anything.
+Simulated cameras expose frames at a rate set by their exposure and
+readout times, into a circular buffer of limited size. With ring
+exposures set, frames cycle through the ring's exposure times. Readout
+time scales inversely with the horizontal shift speed, and without
+frame transfer adds to the exposure rather than overlapping it. In
+accumulate and kinetic modes, each frame sums a number of exposures, and
+acquisition stops at the end of each series.
+"""
+
+import ast
+import bisect
+import functools
+import os
+import re
+import sys
+import threading
+import time
+from ctypes import Structure, c_long, c_ulong, c_longlong, c_ulonglong
+
+import numpy
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+SDK_SOURCE = os.path.join(PATH, 'andorsdk.py')
+
+## A reference to this module
+this = sys.modules[__name__]
+
+
+def _read_sdk_source():
+    """Return (constants, function names) defined in andorsdk.py."""
+    with open(SDK_SOURCE) as fh:
+        source = fh.read()
+    constants = {}
+    for name, value in re.findall(r'^([A-Z][A-Z0-9_]*)\s*=\s*(0x[0-9A-Fa-f]+|\d+)\s*$',
+                                  source, re.MULTILINE):
+        constants[name] = int(value, 0)
+    start = source.index('function_list = [') + len('function_list = ')
+    end = source.index('\n    ]', start) + len('\n    ]')
+    function_list = ast.literal_eval(source[start:end])
+    names = [fndef.split('(')[0] for fndef in function_list]
+    return constants, names
+
+_constants, _function_names = _read_sdk_source()
+for _name, _value in _constants.items():
+    setattr(this, _name, _value)
+
+
+class ANDORCAPS(Structure):
+    _fields_ = [
+                ("ulSize", c_ulong),
+                ("ulAcqModes", c_ulong),
+                ("ulReadModes", c_ulong),
+                ("ulTriggerModes", c_ulong),
+                ("ulCameraType", c_ulong),
+                ("ulPixelMode", c_ulong),
+                ("ulSetFunctions", c_ulong),
+                ("ulGetFunctions", c_ulong),
+                ("ulFeatures", c_ulong),
+                ("ulPCICard", c_ulong),
+                ("ulEMGainCapability", c_ulong),
+                ("ulFTReadModes", c_ulong),
+                ]
+
+AndorCapabilities = ANDORCAPS
+
+
+## types
+at_32 = c_long
+at_u32 = c_ulong
+at_64 = c_longlong
+at_u64 = c_ulonglong
+
+
+# Horizontal shift speed at which readout takes readout_time, in MHz.
+REFERENCE_SPEED = 1.
+
+
+class SimulatedCamera(object):
+    """The state of one simulated camera."""
+    def __init__(self, handle, serial, nx=512, ny=512,
+                 camera_type=AC_CAMERATYPE_IXONULTRA):
+        self.handle = handle
+        self.serial = serial
+        self.nx, self.ny = nx, ny
+        self.camera_type = camera_type
+        self.exposure = 0.01
+        # Reported readout time at REFERENCE_SPEED, and keep-clean time,
+        # in seconds.
+        self.readout_time = 0.002
+        self.keep_clean_time = 0.0005
+        # Horizontal shift speeds in MHz, by output amplifier, and the
+        # amplifier and speed index in use.
+        self.hs_speeds = {0: [17., 10., 5., 1.], 1: [3., 1., 0.08]}
+        self.amplifier = 0
+        self.hs_index = 3
+        self.frame_transfer = True
+        # Time each image transfer takes, in seconds: simulates DLL time.
+        self.copy_time = 0.
+        self.buffer_size = 64
+        # Ring exposure times, or None for a single exposure, and limits.
+        self.ring_exposures = None
+        self.max_ring_exposures = 16
+        self.ring_exposure_range = (0.00001, 10.)
+        self.em_gain = 0
+        # Acquisition mode, and accumulate and kinetic series settings.
+        self.acquisition_mode = 5
+        self.accumulations = 1
+        self.accumulation_cycle = 0.
+        self.kinetics = 1
+        self.kinetic_cycle = 0.
+        self.acquiring = False
+        self.start_time = None
+        self.stop_count = 0
+        # Number of times acquisition has started.
+        self.starts = 0
+        # Images retrieved, and lost to buffer overruns, since start.
+        self.retrieved = 0
+        self.lost = 0
+        self.frames = None
+
+
+    def acquired(self):
+        """Return the number of images acquired since StartAcquisition."""
+        if not self.acquiring:
+            return self.stop_count
+        elapsed = time.time() - self.start_time
+        periods = self.periods()
+        ends = numpy.cumsum(periods)
+        cycles = int(elapsed / ends[-1])
+        acquired = (cycles * len(periods)
+                    + bisect.bisect_right(ends, elapsed - cycles * ends[-1]))
+        length = self.series_length()
+        if length is not None and acquired >= length:
+            # The series is complete.
+            self.stop_count = length
+            self.acquiring = False
+            return length
+        return acquired
+
+
+    def accumulation_time(self):
+        """Return the time between accumulated exposures."""
+        return max(self.accumulation_cycle, self.exposure, self.readout())
+
+
+    def kinetic_time(self):
+        """Return the time between frames of a kinetic series."""
+        return max(self.kinetic_cycle,
+                   self.accumulations * self.accumulation_time())
+
+
+    def series_length(self):
+        """Return the number of frames in a series, or None if unending."""
+        if self.acquisition_mode == 2:
+            return 1
+        if self.acquisition_mode == 3:
+            return self.kinetics
+        return None
+
+
+    def frame_end(self, n):
+        """Return the time after start at which n images are complete."""
+        periods = self.periods()
+        cycles, rest = divmod(n, len(periods))
+        return cycles * sum(periods) + sum(periods[:rest])
+
+
+    def periods(self):
+        """Return the time each frame in the exposure cycle takes."""
+        if self.acquisition_mode == 2:
+            return [self.accumulations * self.accumulation_time()]
+        if self.acquisition_mode == 3:
+            return [self.kinetic_time()]
+        readout = self.readout()
+        if not self.frame_transfer:
+            return [t + readout + self.keep_clean_time
+                    for t in self.ring_exposures or [self.exposure]]
+        return [max(t, readout)
+                for t in self.ring_exposures or [self.exposure]]
+
+
+    def readout(self):
+        """Return the readout time at the current horizontal shift speed."""
+        speed = self.hs_speeds[self.amplifier][self.hs_index]
+        return self.readout_time * REFERENCE_SPEED / speed
+
+
+    def period(self):
+        """Return the mean time per frame."""
+        periods = self.periods()
+        return sum(periods) / len(periods)
+
+
+    def next_image(self):
+        """Return the index of the oldest image in the buffer, or None."""
+        acquired = self.acquired()
+        if acquired - self.retrieved > self.buffer_size:
+            self.lost += acquired - self.retrieved - self.buffer_size
+            self.retrieved = acquired - self.buffer_size
+        if acquired > self.retrieved:
+            return self.retrieved
+        return None
+
+
+    def start(self):
+        # Make the synthetic images before the clock starts.
+        self.image(0)
+        self.acquiring = True
+        self.start_time = time.time()
+        self.starts += 1
+        self.retrieved = 0
+        self.lost = 0
+
+
+    def stop(self):
+        self.stop_count = self.acquired()
+        self.acquiring = False
+
+
+    def image(self, index):
+        """Return synthetic image number index, as a flat uint16 array."""
+        if self.frames is None or self.frames.shape[1] != self.nx * self.ny:
+            rng = numpy.random.RandomState(self.serial)
+            self.frames = rng.poisson(500, (8, self.nx * self.ny))
+            self.frames = self.frames.astype(numpy.uint16)
+        return self.frames[index % len(self.frames)]
+
+
+    def frame(self, index):
+        """Return frame number index of a series, as a flat int64 array.
+
+        In accumulate and kinetic modes, a frame sums accumulations
+        consecutive images.
+        """
+        if self.acquisition_mode not in (2, 3):
+            return self.image(index).astype(numpy.int64)
+        self.image(0)
+        n = len(self.frames)
+        first = (self.starts * self.series_length() + index) * self.accumulations
+        cycles, rest = divmod(self.accumulations, n)
+        total = cycles * self.frames.sum(axis=0, dtype=numpy.int64)
+        for i in range(rest):
+            total += self.frames[(first + i) % n]
+        return total
+
+
+    def time_to_next(self):
+        """Return seconds until a new image is available."""
+        if not self.acquiring:
+            return None
+        elapsed = time.time() - self.start_time
+        return self.frame_end(self.retrieved + 1) - elapsed
+
+
+## Simulated hardware.
+cameras = []
+current = [None]
+
+
+def configure(serials=None, **kwargs):
+    """Create simulated cameras, one per serial number.
+
+    kwargs set SimulatedCamera attributes, e.g. nx, ny, exposure,
+    copy_time.
+    """
+    if serials is None:
+        try:
+            from cameras import cameras as _cameras
+            serials = [camera[1] for camera in _cameras]
+        except ImportError:
+            serials = [1]
+    del cameras[:]
+    for i, serial in enumerate(serials):
+        cam = SimulatedCamera(100 + i, serial)
+        for key, value in kwargs.items():
+            setattr(cam, key, value)
+        cameras.append(cam)
+    current[0] = cameras[0] if cameras else None
+
+
+def _set(pointer, value):
+    """Set the value of a ctypes object passed directly or by reference."""
+    getattr(pointer, '_obj', pointer).value = value
+
+
+def _camera(handle=None):
+    if handle is None:
+        return current[0]
+    handle = getattr(handle, 'value', handle)
+    for cam in cameras:
+        if cam.handle == handle:
+            return cam
+    raise Exception('Simulated camera with handle %s not found.' % handle)
+
+
+def lookup_status(code):
+    key = code[0] if type(code) is list else code
+    if key in status_codes:
+        return status_codes[key]
+    else:
+        return "Unknown status code %s." % key
+
+
+## Function wrapper
+# As andorsdk: raise exceptions if returned status is not DRV_SUCCESS.
+def sdk_wrapper(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        status = func(*args, **kwargs)
+        if status in [DRV_SUCCESS, DRV_IDLE, DRV_NO_NEW_DATA]:
+            return (status, lookup_status(status), args)
+        elif status in range(DRV_TEMP_CODES, DRV_GENERAL_ERRORS):
+            return (status, lookup_status(status), args)
+        else:
+            msg = "Andor function %s returned status %s:  %s." % (
+                func.__name__, status, lookup_status(status))
+            raise Exception(msg)
+    return wrapper
+
+
+## Simulated DLL functions.
+def AbortAcquisition():
+    cam = _camera()
+    if not cam.acquiring:
+        return DRV_IDLE
+    cam.stop()
+    return DRV_SUCCESS
+
+
+def GetAcquisitionTimings(exposure, accumulate, kinetic):
+    cam = _camera()
+    _set(exposure, cam.exposure)
+    if cam.acquisition_mode in (2, 3):
+        _set(accumulate, cam.accumulation_time())
+        _set(kinetic, cam.kinetic_time())
+    else:
+        _set(accumulate, cam.period())
+        _set(kinetic, cam.period())
+    return DRV_SUCCESS
+
+
+def GetAcquiredData(arr, size):
+    cam = _camera()
+    # Finite series stop once acquired.
+    cam.acquired()
+    if cam.acquiring:
+        return DRV_ACQUIRING
+    if not cam.stop_count:
+        return DRV_NO_NEW_DATA
+    out = arr.reshape(-1)
+    pixels = cam.nx * cam.ny
+    for i in range(min(cam.stop_count, size // pixels)):
+        out[i * pixels:(i + 1) * pixels] = cam.frame(i)
+    if cam.copy_time:
+        time.sleep(cam.copy_time * cam.stop_count)
+    cam.retrieved = cam.stop_count
+    return DRV_SUCCESS
+
+
+def GetAdjustedRingExposureTimes(n, times):
+    cam = _camera()
+    ring = cam.ring_exposures or [cam.exposure]
+    for i in range(min(n, len(ring))):
+        times[i] = ring[i]
+    return DRV_SUCCESS
+
+
+def GetAvailableCameras(total):
+    _set(total, len(cameras))
+    return DRV_SUCCESS
+
+
+def GetBitDepth(channel, depth):
+    _set(depth, 16)
+    return DRV_SUCCESS
+
+
+def GetCameraHandle(index, handle):
+    _set(handle, cameras[index].handle)
+    return DRV_SUCCESS
+
+
+def GetCameraSerialNumber(serial):
+    _set(serial, _camera().serial)
+    return DRV_SUCCESS
+
+
+def GetCapabilities(caps):
+    caps = getattr(caps, '_obj', caps)
+    caps.ulCameraType = _camera().camera_type
+    caps.ulSetFunctions = AC_SETFUNCTION_EMCCDGAIN
+    return DRV_SUCCESS
+
+
+def GetCurrentCamera(handle):
+    _set(handle, _camera().handle)
+    return DRV_SUCCESS
+
+
+def GetDetector(nx, ny):
+    cam = _camera()
+    _set(nx, cam.nx)
+    _set(ny, cam.ny)
+    return DRV_SUCCESS
+
+
+def GetEMCCDGain(gain):
+    _set(gain, _camera().em_gain)
+    return DRV_SUCCESS
+
+
+def GetEMGainRange(low, high):
+    _set(low, 0)
+    _set(high, 300)
+    return DRV_SUCCESS
+
+
+def GetFastestRecommendedVSSpeed(index, speed):
+    _set(index, 0)
+    _set(speed, 0.3)
+    return DRV_SUCCESS
+
+
+def GetHeadModel(name):
+    getattr(name, '_obj', name).value = 'SIMULATED'
+    return DRV_SUCCESS
+
+
+def GetKeepCleanTime(t):
+    _set(t, _camera().keep_clean_time)
+    return DRV_SUCCESS
+
+
+def GetNumberNewImages(first, last):
+    cam = _camera()
+    index = cam.next_image()
+    if index is None:
+        return DRV_NO_NEW_DATA
+    # SDK image indices count from 1.
+    _set(first, index + 1)
+    _set(last, cam.acquired())
+    return DRV_SUCCESS
+
+
+def GetHSSpeed(channel, typ, index, speed):
+    _set(speed, _camera().hs_speeds[typ][index])
+    return DRV_SUCCESS
+
+
+def GetImages(first, last, arr, size, validfirst, validlast):
+    cam = _camera()
+    n = last - first + 1
+    pixels = cam.nx * cam.ny
+    out = arr.reshape(-1)
+    for i in range(n):
+        out[i * pixels:(i + 1) * pixels] = cam.frame(first - 1 + i)
+    if cam.copy_time:
+        time.sleep(cam.copy_time * n)
+    cam.retrieved = max(cam.retrieved, last)
+    _set(validfirst, first)
+    _set(validlast, last)
+    return DRV_SUCCESS
+
+
+def GetImages16(first, last, arr, size, validfirst, validlast):
+    cam = _camera()
+    n = last - first + 1
+    pixels = cam.nx * cam.ny
+    out = arr.reshape(-1)
+    for i in range(n):
+        out[i * pixels:(i + 1) * pixels] = cam.image(first - 1 + i)
+    if cam.copy_time:
+        time.sleep(cam.copy_time * n)
+    cam.retrieved = max(cam.retrieved, last)
+    _set(validfirst, first)
+    _set(validlast, last)
+    return DRV_SUCCESS
+
+
+def GetOldestImage16(arr, size):
+    cam = _camera()
+    index = cam.next_image()
+    if index is None:
+        return DRV_NO_NEW_DATA
+    arr.reshape(-1)[:size] = cam.image(index)[:size]
+    if cam.copy_time:
+        time.sleep(cam.copy_time)
+    cam.retrieved = index + 1
+    return DRV_SUCCESS
+
+
+def GetNumberRingExposureTimes(n):
+    _set(n, _camera().max_ring_exposures)
+    return DRV_SUCCESS
+
+
+def GetReadOutTime(t):
+    _set(t, _camera().readout())
+    return DRV_SUCCESS
+
+
+def GetRingExposureRange(t_min, t_max):
+    cam = _camera()
+    _set(t_min, cam.ring_exposure_range[0])
+    _set(t_max, cam.ring_exposure_range[1])
+    return DRV_SUCCESS
+
+
+def GetSensitivity(channel, horzShift, amplifier, pa, sensitivity):
+    _set(sensitivity, 4.5)
+    return DRV_SUCCESS
+
+
+def GetStatus(status):
+    cam = _camera()
+    # Finite series stop once acquired.
+    cam.acquired()
+    _set(status, DRV_ACQUIRING if cam.acquiring else DRV_IDLE)
+    return DRV_SUCCESS
+
+
+def GetTemperature(temperature):
+    _set(temperature, -80)
+    return DRV_TEMP_STABILIZED
+
+
+def GetTemperatureRange(t_min, t_max):
+    _set(t_min, -100)
+    _set(t_max, 20)
+    return DRV_SUCCESS
+
+
+def GetTotalNumberImagesAcquired(index):
+    _set(index, _camera().acquired())
+    return DRV_SUCCESS
+
+
+def SetAccumulationCycleTime(t):
+    cam = _camera()
+    if cam.acquiring:
+        return DRV_ACQUIRING
+    cam.accumulation_cycle = t
+    return DRV_SUCCESS
+
+
+def SetAcquisitionMode(mode):
+    cam = _camera()
+    if cam.acquiring:
+        return DRV_ACQUIRING
+    if mode not in (1, 2, 3, 5, 7):
+        return DRV_P1INVALID
+    cam.acquisition_mode = mode
+    return DRV_SUCCESS
+
+
+def SetCurrentCamera(handle):
+    current[0] = _camera(handle)
+    return DRV_SUCCESS
+
+
+def SetEMCCDGain(gain):
+    _camera().em_gain = gain
+    return DRV_SUCCESS
+
+
+def SetExposureTime(t):
+    cam = _camera()
+    if cam.acquiring:
+        return DRV_ACQUIRING
+    cam.exposure = t
+    cam.ring_exposures = None
+    return DRV_SUCCESS
+
+
+def SetFrameTransferMode(mode):
+    cam = _camera()
+    if cam.acquiring:
+        return DRV_ACQUIRING
+    cam.frame_transfer = bool(mode)
+    return DRV_SUCCESS
+
+
+def SetHSSpeed(typ, index):
+    cam = _camera()
+    if cam.acquiring:
+        return DRV_ACQUIRING
+    if not 0 <= index < len(cam.hs_speeds[typ]):
+        return DRV_P2INVALID
+    cam.amplifier = typ
+    cam.hs_index = index
+    return DRV_SUCCESS
+
+
+def SetKineticCycleTime(t):
+    cam = _camera()
+    if cam.acquiring:
+        return DRV_ACQUIRING
+    cam.kinetic_cycle = t
+    return DRV_SUCCESS
+
+
+def SetNumberAccumulations(n):
+    cam = _camera()
+    if cam.acquiring:
+        return DRV_ACQUIRING
+    if n < 1:
+        return DRV_P1INVALID
+    cam.accumulations = n
+    return DRV_SUCCESS
+
+
+def SetNumberKinetics(n):
+    cam = _camera()
+    if cam.acquiring:
+        return DRV_ACQUIRING
+    if n < 1:
+        return DRV_P1INVALID
+    cam.kinetics = n
+    return DRV_SUCCESS
+
+
+def SetRingExposureTimes(n, times):
+    cam = _camera()
+    if cam.acquiring:
+        return DRV_ACQUIRING
+    if not 0 < n <= cam.max_ring_exposures:
+        return DRV_P1INVALID
+    # The camera holds single-precision times.
+    ring = [numpy.float32(times[i]).item() for i in range(n)]
+    if not all(cam.ring_exposure_range[0] <= t <= cam.ring_exposure_range[1]
+               for t in ring):
+        return DRV_P2INVALID
+    cam.exposure = ring[0]
+    cam.ring_exposures = ring if n > 1 else None
+    return DRV_SUCCESS
+
+
+def StartAcquisition():
+    cam = _camera()
+    if cam.acquiring:
+        return DRV_ACQUIRING
+    cam.start()
+    return DRV_SUCCESS
+
+
+def WaitForAcquisitionByHandleTimeOut(handle, timeout_ms):
+    cam = _camera(handle)
+    wait = cam.time_to_next()
+    if wait is None:
+        time.sleep(timeout_ms / 1000.)
+        return DRV_NO_NEW_DATA
+    if wait > timeout_ms / 1000.:
+        time.sleep(timeout_ms / 1000.)
+        return DRV_NO_NEW_DATA
+    if wait > 0:
+        time.sleep(wait)
+    return DRV_SUCCESS
+
+
+def WaitForAcquisitionByHandle(handle):
+    return WaitForAcquisitionByHandleTimeOut(handle, 1000)
+
+
+def WaitForAcquisitionTimeOut(timeout_ms):
+    return WaitForAcquisitionByHandleTimeOut(_camera().handle, timeout_ms)
+
+
+def WaitForAcquisition():
+    return WaitForAcquisitionTimeOut(1000)
+
+
+def _no_op(name):
+    def func(*args):
+        return DRV_SUCCESS
+    func.__name__ = name
+    return func
+
+
+## Export simulated functions under the names andorsdk exports.
+camerafuncs = []
+for fnstr in _function_names:
+    f = getattr(this, fnstr, None) or _no_op(fnstr)
+    setattr(this, fnstr, sdk_wrapper(f))
+    camerafuncs.append(sdk_wrapper(f))
+
+
+## We need a mapping to enable lookup of status codes to meaning.
+status_codes = {}
+for attrib_name in dir(this):
+    if attrib_name.startswith('DRV_'):
+        status_codes.update({getattr(this, attrib_name): attrib_name})
+
+
+def install():
+    """Make 'import andorsdk' import this module instead."""
+    sys.modules['andorsdk'] = this
+
+
+configure()
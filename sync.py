@@ -0,0 +1,309 @@
+"""Synchronised acquisition across several camera servers.
+
+A SyncCoordinator arms a set of cameras together, receives frames with
+headers from each of them and matches frames across cameras by their
+timestamps, which must agree within a tolerance. Cameras armed on
+internal triggers start at slightly different times, so their frame
+sequence numbers need not agree. When the cameras share an external
+trigger, frames can also be matched by the sequence numbers in their
+headers: see FrameMatcher. Matched sets are sent to a single client, in order
+and from a thread of their own, as
+    receiveData('new image set', {label: image}, timestamp)
+and frames that cannot be matched are counted per camera.
+
+Call from the command line to serve a coordinator for the cameras in
+cameras.py.
+"""
+
+import argparse
+import threading
+from collections import deque
+
+import Pyro4
+import framecodec
+Pyro4.config.SERIALIZER = 'pickle'
+Pyro4.config.SERIALIZERS_ACCEPTED.add('pickle')
+
+try:
+    from cameras import camera_keys as _camera_keys
+    from cameras import cameras as _cameras
+except:
+    CAMERAS = {}
+else:
+    CAMERAS = {camera[0]: dict(zip(_camera_keys, camera)) for camera in _cameras}
+
+
+class FrameMatcher(object):
+    """Match frames from several cameras by timestamp, and optionally
+    sequence number.
+
+    Frames are queued per camera. Whenever every camera has a frame
+    queued, the oldest frames are compared, and returned as a set when
+    their timestamps all lie within tolerance; otherwise the earliest
+    frame can never be matched, and is discarded and counted.
+
+    Sequence numbers count frames from when each camera was armed, so
+    they only agree across cameras that start on the same trigger: set
+    sequences only when the cameras share an external trigger. Then,
+    if the oldest frames' sequence numbers differ, frames with the lowest
+    are discarded, as the other cameras have moved past them, before
+    timestamps are compared. Queues are bounded by max_queue, so a camera
+    that stops delivering cannot exhaust memory.
+    """
+    def __init__(self, labels, tolerance=0.005, max_queue=32,
+                 sequences=False):
+        self.labels = list(labels)
+        self.tolerance = tolerance
+        self.sequences = sequences
+        self.queues = {label: deque() for label in self.labels}
+        self.max_queue = max_queue
+        self.unmatched = {label: 0 for label in self.labels}
+        self.matched = 0
+        self.lock = threading.Lock()
+
+
+    def reset(self):
+        with self.lock:
+            for queue in self.queues.values():
+                queue.clear()
+
+
+    def add(self, label, sequence, timestamp, image):
+        """Queue a frame and return a list of any completed matched sets.
+
+        Each set is a dict mapping label to (sequence, timestamp, image).
+        """
+        matches = []
+        with self.lock:
+            queue = self.queues[label]
+            queue.append((sequence, timestamp, image))
+            if len(queue) > self.max_queue:
+                queue.popleft()
+                self.unmatched[label] += 1
+            while all(self.queues.values()):
+                sequences = [self.queues[l][0][0] for l in self.labels]
+                lowest = min(sequences)
+                if self.sequences and lowest != max(sequences):
+                    for l, sequence in zip(self.labels, sequences):
+                        if sequence == lowest:
+                            self.queues[l].popleft()
+                            self.unmatched[l] += 1
+                    continue
+                heads = [(self.queues[l][0][1], l) for l in self.labels]
+                earliest, first = min(heads)
+                latest = max(heads)[0]
+                if latest - earliest <= self.tolerance:
+                    matches.append({l: self.queues[l].popleft()
+                                    for l in self.labels})
+                    self.matched += 1
+                else:
+                    self.queues[first].popleft()
+                    self.unmatched[first] += 1
+        return matches
+
+
+class FrameReceiver(object):
+    """A Pyro client object that passes one camera's frames to a coordinator.
+
+    Frames with headers are passed on with the camera's sequence number,
+    and frames without, with the number received since the last reset.
+    """
+    def __init__(self, coordinator, label):
+        self.coordinator = coordinator
+        self.label = label
+        self.count = 0
+
+
+    def receiveData(self, action, data, timestamp):
+        if action == 'new frame':
+            header, image = data
+            sequence = framecodec.unpack_header(header).sequence
+        elif action == 'new image':
+            self.count += 1
+            sequence, image = self.count, data
+        else:
+            return
+        self.coordinator.add_frame(self.label, sequence, image, timestamp)
+
+
+class SyncCoordinator(object):
+    """Arm several cameras together and serve matched frame sets.
+
+    cameras maps a label to the Pyro URI of that camera's server. Set
+    sequences to match frames by sequence number as well as timestamp,
+    if the cameras share an external trigger. Matched sets are queued, at most max_queue of them, and sent by a single
+    thread, so that they reach the client in order, and a slow client
+    holds up no camera: when the queue is full, the oldest set is dropped.
+    """
+    def __init__(self, cameras, tolerance=0.005, max_queue=8,
+                 sequences=False):
+        self.uris = dict(cameras)
+        self.cameras = {}
+        self.receivers = {}
+        self.matcher = FrameMatcher(sorted(self.uris), tolerance,
+                                    sequences=sequences)
+        self.client = None
+        self.daemon = None
+        # Matched sets to send, as (images, timestamp).
+        self.queue = deque(maxlen=max_queue)
+        self.condition = threading.Condition()
+        self.sent_count = 0
+        self.dropped_count = 0
+        self.run_flag = True
+        self.sender = threading.Thread(target=self.send_sets)
+        self.sender.daemon = True
+        self.sender.start()
+
+
+    def add_frame(self, label, sequence, image, timestamp):
+        matches = self.matcher.add(label, sequence, timestamp, image)
+        if not matches:
+            return
+        with self.condition:
+            for match in matches:
+                images = {l: m[2] for l, m in match.items()}
+                timestamp = min(m[1] for m in match.values())
+                if len(self.queue) == self.queue.maxlen:
+                    self.dropped_count += 1
+                self.queue.append((images, timestamp))
+            self.condition.notify()
+
+
+    def send_sets(self):
+        """Send queued matched sets to the client, oldest first."""
+        while True:
+            with self.condition:
+                while self.run_flag and not self.queue:
+                    self.condition.wait()
+                if not self.run_flag:
+                    return
+                images, timestamp = self.queue.popleft()
+            client = self.client
+            if client is None:
+                self.dropped_count += 1
+                continue
+            try:
+                client.receiveData('new image set', images, timestamp)
+            except Pyro4.errors.CommunicationError:
+                self.dropped_count += 1
+            else:
+                self.sent_count += 1
+
+
+    def stop(self):
+        with self.condition:
+            self.run_flag = False
+            self.condition.notify()
+
+
+    def connect(self, daemon):
+        """Register a receiver per camera with daemon, and set camera clients."""
+        self.daemon = daemon
+        for label, uri in self.uris.items():
+            receiver = FrameReceiver(self, label)
+            receiver_uri = daemon.register(receiver)
+            self.receivers[label] = receiver
+            self.cameras[label] = Pyro4.Proxy(uri)
+            # Headers carry the sequence numbers that frames may be matched by.
+            self.cameras[label].receiveClient(str(receiver_uri), True)
+
+
+    def _call_all(self, method, args_by_label):
+        """Call method on every camera at once, and wait for all of them."""
+        results = {}
+        errors = {}
+        def call(label):
+            # Pyro proxies must not be shared between threads.
+            proxy = Pyro4.Proxy(self.uris[label])
+            try:
+                results[label] = getattr(proxy, method)(*args_by_label[label])
+            except Exception as e:
+                errors[label] = e
+        threads = [threading.Thread(target=call, args=(label,))
+                   for label in self.uris]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise Exception('%s failed on %s.' % (method, errors))
+        return results
+
+
+    def disable(self):
+        return self._call_all('disable', {label: () for label in self.uris})
+
+
+    def enable(self, settings=None):
+        """Enable and arm all cameras together.
+
+        settings is either one settings dict for every camera, or a dict
+        mapping labels to settings dicts.
+        """
+        settings = self._settings_by_label(settings)
+        self.matcher.reset()
+        with self.condition:
+            self.queue.clear()
+        for receiver in self.receivers.values():
+            receiver.count = 0
+        return self._call_all('enable',
+                              {label: (settings[label],) for label in self.uris})
+
+
+    def get_stats(self):
+        """Return numbers of matched, sent and dropped sets, and of
+        unmatched frames per camera."""
+        return {'matched': self.matcher.matched,
+                'sent': self.sent_count,
+                'dropped': self.dropped_count,
+                'unmatched': dict(self.matcher.unmatched)}
+
+
+    def receiveClient(self, uri):
+        """Handle connection request from a client for matched sets."""
+        if uri is None:
+            self.client = None
+        else:
+            self.client = Pyro4.Proxy(uri)
+
+
+    def update_settings(self, settings):
+        settings = self._settings_by_label(settings)
+        return self._call_all('update_settings',
+                              {label: (settings[label],) for label in self.uris})
+
+
+    def _settings_by_label(self, settings):
+        settings = settings or {}
+        if set(settings.keys()) <= set(self.uris.keys()) and settings:
+            return {label: settings.get(label, {}) for label in self.uris}
+        return {label: settings for label in self.uris}
+
+
+if hasattr(Pyro4, 'expose'):
+    FrameReceiver = Pyro4.expose(FrameReceiver)
+    SyncCoordinator = Pyro4.expose(SyncCoordinator)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7779)
+    parser.add_argument('--tolerance', type=float, default=0.005,
+                        help='Maximum timestamp difference in a set (s).')
+    parser.add_argument('--sequences', action='store_true',
+                        help='Also match by sequence number: only for '
+                             'cameras on a shared external trigger.')
+    args = parser.parse_args()
+    uris = {label: 'PYRO:pyroCam@%s:%d' % (cam['ipAddress'], cam['port'])
+            for label, cam in CAMERAS.iteritems()}
+    coordinator = SyncCoordinator(uris, args.tolerance,
+                                  sequences=args.sequences)
+    daemon = Pyro4.Daemon(host=args.host, port=args.port)
+    coordinator.connect(daemon)
+    Pyro4.Daemon.serveSimple({coordinator: 'pyroSync'},
+                             daemon=daemon, ns=False)
+
+
+if __name__ == '__main__':
+    main()
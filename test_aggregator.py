@@ -0,0 +1,57 @@
+"""Tests for the shared-memory FrameRing in aggregator.py."""
+
+import unittest
+
+import numpy
+
+from aggregator import FrameRing
+
+
+class FrameRingTest(unittest.TestCase):
+    def frame(self, value, shape=(3, 5), dtype=numpy.uint16):
+        return numpy.full(shape, value, dtype)
+
+
+    def test_write_and_read(self):
+        ring = FrameRing(slots=4, slot_bytes=64)
+        self.assertIsNone(ring.read(0))
+        self.assertTrue(ring.write(self.frame(7), 1.5, 0.01))
+        image, timestamp, exposure = ring.read(0)
+        self.assertEqual(image.tolist(), self.frame(7).tolist())
+        self.assertEqual((timestamp, exposure), (1.5, 0.01))
+        self.assertIsNone(ring.read(1))
+
+
+    def test_dtypes_and_shapes(self):
+        ring = FrameRing(slots=3, slot_bytes=64)
+        ring.write(self.frame(1.5, (2, 3), numpy.float32), 0.)
+        ring.write(self.frame(9, (1, 7), numpy.uint32), 0.)
+        self.assertEqual(ring.read(0)[0].dtype, numpy.float32)
+        self.assertEqual(ring.read(0)[0].shape, (2, 3))
+        self.assertEqual(ring.read(1)[0].dtype, numpy.uint32)
+        self.assertEqual(ring.read(1)[0].shape, (1, 7))
+
+
+    def test_lapped_frames_are_invalid(self):
+        ring = FrameRing(slots=4, slot_bytes=64)
+        for i in range(6):
+            ring.write(self.frame(i), float(i))
+        # Frames 0 and 1 were overwritten, and frame 2's slot is next.
+        self.assertIsNone(ring.read(0))
+        self.assertIsNone(ring.read(1))
+        self.assertFalse(ring.is_valid(2))
+        self.assertIsNone(ring.read(2))
+        for i in (3, 4, 5):
+            self.assertEqual(ring.read(i)[0][0, 0], i)
+        self.assertIsNone(ring.read(6))
+
+
+    def test_too_large_for_slot(self):
+        ring = FrameRing(slots=2, slot_bytes=16)
+        self.assertFalse(ring.write(self.frame(1, (3, 3)), 0.))
+        self.assertEqual(ring.written.value, 0)
+        self.assertTrue(ring.write(self.frame(1, (2, 4)), 0.))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""Tests for frame headers and encodings in framecodec.py."""
+
+import cPickle
+import unittest
+
+import numpy
+
+import framecodec
+
+
+def round_trip(frame):
+    return cPickle.loads(cPickle.dumps(frame, cPickle.HIGHEST_PROTOCOL))
+
+
+class HeaderTest(unittest.TestCase):
+    def test_round_trip(self):
+        data = framecodec.pack_header(3, 7, 42, 1.5, 1000., 0.01, flags=2)
+        header = framecodec.unpack_header(data)
+        self.assertEqual(header.version, framecodec.HEADER_VERSION)
+        self.assertEqual((header.generation, header.sequence,
+                          header.image_index, header.flags), (3, 7, 42, 2))
+        self.assertEqual(header.wall_time, 1001.5)
+        self.assertEqual(header.exposure, 0.01)
+
+
+    def test_version_1(self):
+        data = framecodec.HEADERS[1].pack(1, 0, framecodec.HEADERS[1].size,
+                                          1, 2, 3, 4., 5.)
+        self.assertIsNone(framecodec.unpack_header(data).exposure)
+
+
+    def test_monotonic(self):
+        t0 = framecodec.monotonic()
+        self.assertTrue(framecodec.monotonic() >= t0)
+
+
+class EncodingTest(unittest.TestCase):
+    # Odd sizes, so that strips and 12-bit pairs don't divide evenly.
+    SHAPES = [(1, 1), (3, 5), (17, 13), (64, 63)]
+
+    def frames(self, maximum, dtype=numpy.uint16):
+        rng = numpy.random.RandomState(0)
+        for shape in self.SHAPES:
+            yield rng.randint(0, maximum + 1, shape).astype(dtype)
+
+
+    def check(self, encoder, image):
+        decoded = round_trip(encoder.encode(image))
+        self.assertEqual(decoded.dtype, image.dtype)
+        self.assertEqual(decoded.shape, image.shape)
+        self.assertTrue(numpy.array_equal(decoded, image))
+        return decoded
+
+
+    def test_raw(self):
+        encoder = framecodec.get_encoder('raw')
+        for dtype in framecodec.DTYPES:
+            for image in self.frames(200, dtype):
+                decoded = self.check(encoder, image)
+                decoded[0, 0] = 1
+        # Non-contiguous frames, such as transformed views.
+        image = numpy.arange(35, dtype=numpy.uint16).reshape(5, 7)
+        self.check(encoder, image.T)
+        self.check(encoder, image[::2, ::-1])
+
+
+    def test_zlib(self):
+        for delta in (False, True):
+            encoder = framecodec.get_encoder('zlib', {'threads': 2,
+                                                     'delta': delta})
+            for image in self.frames(65535):
+                self.check(encoder, image)
+            self.check(encoder, numpy.arange(-20, 15, dtype='<i4')
+                       .reshape(5, 7).T)
+            self.check(encoder, numpy.linspace(0, 1, 35, dtype='<f4')
+                       .reshape(7, 5))
+        self.assertEqual(encoder.get_stats()['frames'], 6)
+
+
+    def test_packed(self):
+        encoder = framecodec.get_encoder('packed')
+        for maximum, bits in ((255, 8), (4095, 12), (65535, 16)):
+            for image in self.frames(maximum):
+                image.flat[-1] = maximum
+                frame = encoder.encode(image)
+                self.assertEqual(frame.bits, bits)
+                self.assertEqual(framecodec.frame_flags(frame),
+                                 framecodec.PACKING_FLAGS[bits])
+                self.check(encoder, image)
+        self.check(encoder, numpy.ones((3, 3), numpy.float32))
+
+
+    def test_12bit_odd_count(self):
+        pixels = numpy.array([1, 4095, 2048], numpy.uint16)
+        data = framecodec.pack_12bit(pixels).tostring()
+        self.assertEqual(len(data), 6)
+        self.assertEqual(framecodec.unpack_12bit(data, 3).tolist(),
+                         pixels.tolist())
+
+
+    def test_unknown_encoding(self):
+        self.assertIsNone(framecodec.get_encoder(None))
+        self.assertRaises(Exception, framecodec.get_encoder, 'jpeg')
+
+
+if __name__ == '__main__':
+    unittest.main()
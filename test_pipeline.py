@@ -0,0 +1,227 @@
+"""Tests for the frame-processing stages in pipeline.py.
+
+Run with
+    python -m unittest discover -p 'test_*.py'
+"""
+
+import unittest
+
+import numpy
+
+import pipeline
+
+
+class DarkFlatCorrectionTest(unittest.TestCase):
+    def test_dark_keeps_noise_about_pedestal(self):
+        rng = numpy.random.RandomState(0)
+        raw = (100 + rng.normal(0, 5, (32, 32))).round().astype(numpy.uint16)
+        dark = numpy.full(raw.shape, 100.)
+        stage = pipeline.DarkFlatCorrection(raw.shape, dark, pedestal=100)
+        out = stage.process(raw.copy())
+        self.assertEqual(out.dtype, numpy.uint16)
+        self.assertEqual(out.mean(), raw.mean())
+        self.assertTrue(out.min() > 0)
+
+
+    def test_flat_scales_signal_above_pedestal(self):
+        flat = numpy.ones((4, 4))
+        flat[0] = 0.5
+        stage = pipeline.DarkFlatCorrection(flat.shape, flat=flat, pedestal=100)
+        out = stage.process(numpy.full(flat.shape, 200, numpy.uint16))
+        gain = flat.mean()
+        self.assertEqual(out[0, 0], round(100 * gain / 0.5 + 100))
+        self.assertEqual(out[1, 0], round(100 * gain + 100))
+
+
+    def test_clips_to_dtype(self):
+        dark = numpy.full((2, 2), 1000.)
+        stage = pipeline.DarkFlatCorrection((2, 2), dark)
+        out = stage.process(numpy.full((2, 2), 10, numpy.uint16))
+        self.assertEqual(out.tolist(), [[0, 0], [0, 0]])
+
+
+    def test_bad_shape(self):
+        self.assertRaises(Exception, pipeline.DarkFlatCorrection,
+                          (4, 4), numpy.zeros((4, 5)))
+
+
+class FrameViewTest(unittest.TestCase):
+    def test_roi_stride_and_binning(self):
+        image = numpy.arange(64, dtype=numpy.uint16).reshape(8, 8)
+        view = pipeline.FrameView(roi=(1, 2, 4, 4))
+        self.assertEqual(view.apply(image).tolist(),
+                         image[1:5, 2:6].tolist())
+        view = pipeline.FrameView(stride=3)
+        self.assertEqual(view.apply(image).shape, (3, 3))
+        view = pipeline.FrameView(binning=3)
+        binned = view.apply(image)
+        self.assertEqual(binned.shape, (2, 2))
+        self.assertEqual(binned.dtype, numpy.uint16)
+        self.assertEqual(binned[0, 0], image[:3, :3].mean())
+
+
+    def test_make_view_passes_through(self):
+        self.assertIsNone(pipeline.make_view())
+
+
+class FrameAccumulatorTest(unittest.TestCase):
+    def test_block(self):
+        stage = pipeline.FrameAccumulator(3)
+        frames = [numpy.full((2, 3), i, numpy.uint16) for i in (1, 2, 3, 4)]
+        self.assertIsNone(stage.process(frames[0]))
+        self.assertIsNone(stage.process(frames[1]))
+        result = stage.process(frames[2])
+        self.assertEqual(result.dtype, numpy.uint32)
+        self.assertEqual(result.tolist(), [[6] * 3] * 2)
+        self.assertIsNone(stage.process(frames[3]))
+
+
+    def test_block_sum_does_not_overflow(self):
+        stage = pipeline.FrameAccumulator(2)
+        frame = numpy.full((2, 2), 65535, numpy.uint16)
+        stage.process(frame)
+        self.assertEqual(stage.process(frame)[0, 0], 2 * 65535)
+
+
+    def test_rolling(self):
+        stage = pipeline.FrameAccumulator(3, 'rolling', emit_every=1)
+        results = [stage.process(numpy.full((2, 2), i, numpy.uint16))
+                   for i in range(1, 6)]
+        self.assertEqual(results[:2], [None, None])
+        self.assertEqual([r[0, 0] for r in results[2:]], [6, 9, 12])
+
+
+    def test_average(self):
+        stage = pipeline.FrameAccumulator(2, average=True)
+        stage.process(numpy.full((2, 2), 1, numpy.uint16))
+        result = stage.process(numpy.full((2, 2), 2, numpy.uint16))
+        self.assertEqual(result.dtype, numpy.float32)
+        self.assertEqual(result[0, 0], 1.5)
+
+
+class HDRFusionTest(unittest.TestCase):
+    def test_fuses_unsaturated_frames(self):
+        rate = 1000.
+        stage = pipeline.HDRFusion(2, saturation=4000, baseline=100)
+        short = numpy.array([[100 + rate * 0.001, 100 + rate * 0.001]])
+        long = numpy.array([[100 + rate * 0.01, 4000]])
+        self.assertIsNone(stage.process(short.astype(numpy.uint16), 0.001))
+        result = stage.process(long.astype(numpy.uint16), 0.01)
+        self.assertEqual(stage.reference, numpy.float32(0.01))
+        # Unsaturated: both frames; saturated: the short frame only.
+        self.assertAlmostEqual(result[0, 0], rate * 0.01, places=3)
+        self.assertAlmostEqual(result[0, 1], rate * 0.01, places=3)
+
+
+    def test_saturated_everywhere_falls_back_to_shortest(self):
+        stage = pipeline.HDRFusion(2, saturation=1000)
+        frame = numpy.full((1, 1), 1000, numpy.uint16)
+        stage.process(frame, 0.01)
+        result = stage.process(frame, 0.001)
+        self.assertAlmostEqual(result[0, 0], 1000 / 0.001 * 0.01, places=1)
+
+
+    def test_repeated_exposure_starts_new_group(self):
+        stage = pipeline.HDRFusion(2)
+        frame = numpy.ones((1, 1), numpy.uint16)
+        stage.process(frame, 0.001)
+        self.assertIsNone(stage.process(frame, 0.001))
+        self.assertEqual(stage.dropped, 1)
+        self.assertIsNotNone(stage.process(frame, 0.01))
+
+
+class FrameStatisticsTest(unittest.TestCase):
+    def test_integer_frame(self):
+        image = numpy.array([[0, 10], [20, 65535]], numpy.uint16)
+        stats = pipeline.frame_statistics(image, bins=4)
+        self.assertEqual((stats['min'], stats['max']), (0, 65535))
+        self.assertAlmostEqual(stats['mean'], image.mean())
+        self.assertEqual(stats['saturated'], 1)
+        self.assertEqual(sum(stats['histogram']), 4)
+        self.assertEqual(stats['histogram'][-1], 1)
+
+
+    def test_float_frame(self):
+        image = numpy.array([[0., 0.5], [1., 2.]], numpy.float32)
+        stats = pipeline.frame_statistics(image, saturation=1., bins=2)
+        self.assertEqual(stats['saturated'], 2)
+        self.assertEqual(stats['max'], 2.)
+
+
+class CountConverterTest(unittest.TestCase):
+    def test_photons(self):
+        stage = pipeline.CountConverter(100, 10, 5., qe=0.5, mode='photons')
+        result = stage.process(numpy.array([[120]], numpy.uint16))
+        self.assertAlmostEqual(result[0, 0], 20 * 5. / 10 / 0.5)
+
+
+    def test_bad_mode(self):
+        self.assertRaises(Exception, pipeline.CountConverter, 0, 1, 1,
+                          mode='volts')
+
+
+class PhotonCounterTest(unittest.TestCase):
+    def test_scores_against_thresholds(self):
+        stage = pipeline.PhotonCounter([100, 200])
+        image = numpy.array([[99, 100, 199, 200, 65535]], numpy.uint16)
+        self.assertEqual(stage.process(image).tolist(), [[0, 1, 1, 2, 2]])
+        floats = image.astype(numpy.float32)
+        self.assertEqual(stage.score(floats).tolist(), [[0, 1, 1, 2, 2]])
+
+
+    def test_sums_over_frames(self):
+        stage = pipeline.PhotonCounter(100, num_frames=2)
+        frame = numpy.array([[50, 150]], numpy.uint16)
+        self.assertIsNone(stage.process(frame))
+        self.assertEqual(stage.process(frame).tolist(), [[0, 2]])
+        stack = numpy.array([frame, frame, frame, frame])
+        self.assertEqual(stage.count_stack(stack).tolist(),
+                         [[[0, 2]], [[0, 2]]])
+
+
+class ExposureControllerTest(unittest.TestCase):
+    def frame(self, value):
+        return numpy.full((4, 4), value, numpy.uint16)
+
+
+    def test_histogram_percentile(self):
+        image = numpy.arange(100, dtype=numpy.uint16)
+        self.assertEqual(pipeline.histogram_percentile(image, 50), 49)
+
+
+    def test_within_tolerance(self):
+        controller = pipeline.ExposureController(1000, baseline=100)
+        self.assertIsNone(controller.update(self.frame(1100), 0.01, 0, 0.))
+
+
+    def test_adjusts_exposure_by_at_most_max_step(self):
+        controller = pipeline.ExposureController(1000, baseline=100,
+                                                 min_interval=1.)
+        exposure, gain = controller.update(self.frame(350), 0.01, 0, 0.)
+        self.assertAlmostEqual(exposure, 0.04 * 0.5)
+        self.assertEqual(gain, 0)
+        # Not due again until min_interval has passed.
+        self.assertIsNone(controller.update(self.frame(350), exposure, 0, 0.5))
+        self.assertIsNotNone(controller.update(self.frame(350), exposure, 0,
+                                               1.))
+
+
+    def test_gain_after_exposure_limit(self):
+        controller = pipeline.ExposureController(
+            1000, exposure_limits=(0.001, 0.01), gain_limits=(0, 100),
+            baseline=100)
+        exposure, gain = controller.update(self.frame(600), 0.01, 10, 0.)
+        self.assertEqual(exposure, 0.01)
+        self.assertEqual(gain, 20)
+
+
+    def test_gain_reduced_first_when_bright(self):
+        controller = pipeline.ExposureController(
+            1000, gain_limits=(0, 100), baseline=100)
+        exposure, gain = controller.update(self.frame(2100), 0.01, 100, 0.)
+        self.assertEqual(exposure, 0.01)
+        self.assertEqual(gain, 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
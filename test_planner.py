@@ -0,0 +1,61 @@
+"""Tests for readout planning in planner.py."""
+
+import unittest
+
+import planner
+
+
+def mode(label, amplifier):
+    return {'label': label, 'amplifier': amplifier, 'channel': 0, 'index': 0}
+
+
+class TimingModelTest(unittest.TestCase):
+    def setUp(self):
+        self.model = planner.TimingModel()
+        # A slow, low-noise EM mode, a fast EM mode and a conventional
+        # mode that reads out faster than the slow one.
+        self.slow = mode('EM 1MHz', 0)
+        self.fast = mode('EM 10MHz', 0)
+        self.conv = mode('Conv 3MHz', 1)
+        self.model.add(self.slow, 0, 1., 0.5, 0.001, 0.5, 0.5)
+        self.model.add(self.slow, 1, 1., 0.5, 0.001, 0.5, 0.001)
+        self.model.add(self.fast, 1, 10., 0.05, 0.001, 0.05, 0.001)
+        self.model.add(self.conv, 1, 3., 0.4, 0.001, 0.4, 0.001)
+
+
+    def test_predict(self):
+        entry = self.model.entries[0]
+        self.assertEqual(self.model.predict(entry, 0.01), 0.51)
+        entry = self.model.entries[1]
+        self.assertEqual(self.model.predict(entry, 0.01), 0.5)
+        self.assertEqual(self.model.predict(entry, 1.), 1.001)
+
+
+    def test_slowest_readout_that_meets_target(self):
+        plan = self.model.plan(1., 0.1)
+        self.assertTrue(plan['meetsTarget'])
+        self.assertEqual(plan['settings'], {'amplifierMode': self.slow,
+                                            'frameTransfer': 1})
+        self.assertEqual(plan['period'], 0.5)
+
+
+    def test_fastest_when_target_unreachable(self):
+        plan = self.model.plan(100., 0.001)
+        self.assertFalse(plan['meetsTarget'])
+        self.assertEqual(plan['settings']['amplifierMode'], self.fast)
+        self.assertEqual(plan['fps'], 20.)
+
+
+    def test_amplifier_filter(self):
+        plan = self.model.plan(1., 0.1, amplifier=1)
+        self.assertEqual(plan['settings']['amplifierMode'], self.conv)
+        self.assertRaises(Exception, self.model.plan, 1., 0.1, 2)
+
+
+    def test_no_timings(self):
+        self.model.clear()
+        self.assertRaises(Exception, self.model.plan, 1., 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
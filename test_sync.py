@@ -0,0 +1,59 @@
+"""Tests for multi-camera frame matching in sync.py."""
+
+import unittest
+
+from sync import FrameMatcher
+
+
+class FrameMatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.matcher = FrameMatcher(['a', 'b'], tolerance=0.005, max_queue=4,
+                                    sequences=True)
+
+
+    def test_matches_equal_sequences(self):
+        self.assertEqual(self.matcher.add('a', 1, 10.000, 'a1'), [])
+        matches = self.matcher.add('b', 1, 10.002, 'b1')
+        self.assertEqual(matches, [{'a': (1, 10.000, 'a1'),
+                                    'b': (1, 10.002, 'b1')}])
+        self.assertEqual(self.matcher.matched, 1)
+
+
+    def test_discards_frames_other_cameras_have_passed(self):
+        self.matcher.add('a', 1, 10.00, 'a1')
+        self.matcher.add('a', 2, 10.01, 'a2')
+        matches = self.matcher.add('b', 2, 10.01, 'b2')
+        self.assertEqual([m['a'][2] for m in matches], ['a2'])
+        self.assertEqual(self.matcher.unmatched, {'a': 1, 'b': 0})
+
+
+    def test_discards_earliest_when_out_of_step(self):
+        self.matcher.add('a', 1, 10.00, 'a1')
+        self.assertEqual(self.matcher.add('b', 1, 10.10, 'b1'), [])
+        self.assertEqual(self.matcher.unmatched, {'a': 1, 'b': 0})
+        matches = self.matcher.add('a', 2, 10.10, 'a2')
+        self.assertEqual(matches, [])
+        self.assertEqual(self.matcher.unmatched, {'a': 1, 'b': 1})
+
+
+    def test_timestamps_only_by_default(self):
+        matcher = FrameMatcher(['a', 'b'], tolerance=0.005)
+        matcher.add('a', 5, 10.00, 'a5')
+        matcher.add('a', 6, 10.01, 'a6')
+        matches = matcher.add('b', 1, 10.011, 'b1')
+        self.assertEqual(matches, [{'a': (6, 10.01, 'a6'),
+                                    'b': (1, 10.011, 'b1')}])
+        self.assertEqual(matcher.unmatched, {'a': 1, 'b': 0})
+
+
+    def test_queues_are_bounded(self):
+        for i in range(6):
+            self.matcher.add('a', i, float(i), i)
+        self.assertEqual(len(self.matcher.queues['a']), 4)
+        self.assertEqual(self.matcher.unmatched['a'], 2)
+        self.matcher.reset()
+        self.assertEqual(len(self.matcher.queues['a']), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+"""Span tracing and sampling profiling for a running camera server.
+
+A Tracer collects timed spans from any thread, for a bounded time, and
+exports them in Chrome trace format, which chrome://tracing and
+Perfetto can load. A SamplingProfiler samples the stacks of every
+thread at intervals, for a bounded time, and exports the samples as
+pstats data. Both are driven from Camera over Pyro, so a live server
+can be examined without a restart.
+"""
+
+import json
+import marshal
+import os
+import pstats
+import sys
+import tempfile
+import thread
+import threading
+import time
+from collections import deque
+
+from framecodec import monotonic
+
+
+class Tracer(object):
+    """Collect (name, category, thread, start, end) spans for duration s.
+
+    Span times are on the framecodec.monotonic clock, which resolves
+    the short spans that time.time() does not on Windows. add is cheap:
+    it appends a tuple to a bounded deque, which needs no lock. Once
+    duration has passed, or max_events have been collected, the oldest
+    spans are kept.
+    """
+    def __init__(self, duration=10., max_events=100000):
+        self.start = monotonic()
+        # Wall-clock time at monotonic time start.
+        self.wall_start = time.time()
+        self.deadline = self.start + duration
+        self.events = deque(maxlen=max_events)
+        self.active = True
+
+
+    def add(self, name, start, end, category='camera'):
+        if not self.active:
+            return
+        if end > self.deadline:
+            self.active = False
+            return
+        self.events.append((name, category, thread.get_ident(), start, end))
+
+
+    def to_chrome_trace(self):
+        """Return the spans as a Chrome trace JSON string."""
+        pid = os.getpid()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        events = list(self.events)
+        trace = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                  'args': {'name': names.get(tid, str(tid))}}
+                 for tid in set(event[2] for event in events)]
+        for name, category, tid, start, end in events:
+            trace.append({'name': name, 'cat': category, 'ph': 'X',
+                          'pid': pid, 'tid': tid,
+                          'ts': 1e6 * (start - self.start),
+                          'dur': 1e6 * (end - start)})
+        return json.dumps({'traceEvents': trace,
+                           'displayTimeUnit': 'ms',
+                           'otherData': {'wallStart': self.wall_start}})
+
+
+class SamplingProfiler(threading.Thread):
+    """Sample the stacks of all other threads every interval s, for duration s.
+
+    Samples are converted to pstats data: a function's own time is
+    interval times the samples in which it was running, and its
+    cumulative time interval times the samples in which it was on the
+    stack.
+    """
+    def __init__(self, duration=10., interval=0.001):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.duration = duration
+        self.interval = interval
+        # Per function key: samples on top of the stack, and anywhere on it.
+        self.own = {}
+        self.total = {}
+        # Per (caller, callee) key pair: samples.
+        self.calls = {}
+        self.samples = 0
+        self.run_flag = True
+
+
+    def run(self):
+        me = thread.get_ident()
+        deadline = time.time() + self.duration
+        while self.run_flag and time.time() < deadline:
+            for tid, frame in sys._current_frames().items():
+                if tid != me:
+                    self.sample(frame)
+            self.samples += 1
+            time.sleep(self.interval)
+
+
+    def sample(self, frame):
+        callee = None
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            if callee is None:
+                self.own[key] = self.own.get(key, 0) + 1
+            else:
+                pair = (key, callee)
+                self.calls[pair] = self.calls.get(pair, 0) + 1
+            if key not in seen:
+                # Count recursive functions once per sample.
+                seen.add(key)
+                self.total[key] = self.total.get(key, 0) + 1
+            callee = key
+            frame = frame.f_back
+
+
+    def stop(self):
+        self.run_flag = False
+
+
+    def get_stats(self):
+        """Return the samples as a pstats stats dict."""
+        callers = {}
+        for (caller, callee), n in self.calls.items():
+            callers.setdefault(callee, {})[caller] = n
+        stats = {}
+        for key, n in self.total.items():
+            stats[key] = (n, n, self.own.get(key, 0) * self.interval,
+                          n * self.interval, callers.get(key, {}))
+        return stats
+
+
+    def dumps(self):
+        """Return the samples in the format read by pstats.Stats."""
+        return marshal.dumps(self.get_stats())
+
+
+def load_stats(data):
+    """Return a pstats.Stats for data from SamplingProfiler.dumps."""
+    fd, filename = tempfile.mkstemp(suffix='.pstats')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        return pstats.Stats(filename)
+    finally:
+        os.remove(filename)